@@ -5,27 +5,34 @@ __all__ = [
     'Browser',
     'BrowserStateError',
     'CacheFTPHandler',
+    'ConnectionCache',
     'ContentTooShortError',
     'Cookie',
     'CookieJar',
     'CookiePolicy',
     'DefaultCookiePolicy',
     'DefaultFactory',
+    'DirectoryResponseCache',
+    'DocumentFactory',
     'FTPHandler',
     'Factory',
     'FileCookieJar',
     'FileHandler',
     'FormNotFoundError',
     'FormsFactory',
+    'Future',
     'HTTPBasicAuthHandler',
+    'HTTPCacheHandler',
     'HTTPCookieProcessor',
     'HTTPDefaultErrorHandler',
     'HTTPDigestAuthHandler',
     'HTTPEquivProcessor',
     'HTTPError',
     'HTTPErrorProcessor',
+    'HTTPGzipProcessor',
     'HTTPHandler',
     'HTTPPasswordMgr',
+    'HTTPRateLimitHandler',
     'HTTPPasswordMgrWithDefaultRealm',
     'HTTPProxyPasswordMgr',
     'HTTPRedirectDebugProcessor',
@@ -45,6 +52,7 @@ __all__ = [
     'LinksFactory',
     'LoadError',
     'MSIECookieJar',
+    'MemoryResponseCache',
     'MozillaCookieJar',
     'OpenerDirector',
     'OpenerFactory',
@@ -52,13 +60,16 @@ __all__ = [
     'ProxyBasicAuthHandler',
     'ProxyDigestAuthHandler',
     'ProxyHandler',
+    'RateLimiter',
     'Request',
     'ResponseUpgradeProcessor',
     'RobotExclusionError',
+    'RobotRulesCache',
     'RobustFactory',
     'RobustFormsFactory',
     'RobustLinksFactory',
     'RobustTitleFactory',
+    'SQLiteResponseCache',
     'SeekableProcessor',
     'SeekableResponseOpener',
     'TitleFactory',
@@ -96,7 +107,7 @@ from _html import \
      ParseError, \
      Link, \
      Factory, DefaultFactory, RobustFactory, \
-     FormsFactory, LinksFactory, TitleFactory, \
+     FormsFactory, LinksFactory, TitleFactory, DocumentFactory, \
      RobustFormsFactory, RobustLinksFactory, RobustTitleFactory
 
 # urllib2 work-alike interface (part from mechanize, part from urllib2)
@@ -104,6 +115,8 @@ from _html import \
 from _urllib2 import *
 
 # misc
+from _conncache import ConnectionCache
+from _workerpool import Future
 from _opener import ContentTooShortError, OpenerFactory, urlretrieve
 from _util import http2time as str2time
 from _response import \
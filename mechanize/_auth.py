@@ -158,18 +158,19 @@ class HTTPPasswordMgr:
         # uri could be a single URI or a sequence
         if isinstance(uri, basestring):
             uri = [uri]
-        if not realm in self.passwd:
-            self.passwd[realm] = {}
+        passwd_by_domain = self.passwd.setdefault(realm, {})
         for default_port in True, False:
             reduced_uri = tuple(
                 [self.reduce_uri(u, default_port) for u in uri])
-            self.passwd[realm][reduced_uri] = (user, passwd)
+            passwd_by_domain[reduced_uri] = (user, passwd)
 
     def find_user_password(self, realm, authuri):
         domains = self.passwd.get(realm, {})
         for default_port in True, False:
             reduced_authuri = self.reduce_uri(authuri, default_port)
-            for uris, authinfo in domains.iteritems():
+            # .items(), not .iteritems(): another thread may be adding
+            # passwords (see UserAgentBase.open_many())
+            for uris, authinfo in domains.items():
                 for uri in uris:
                     if self.is_suburi(uri, reduced_authuri):
                         return authinfo
@@ -490,7 +491,7 @@ class HTTPProxyPasswordMgr(HTTPPasswordMgr):
                 authinfo_by_domain = self.passwd.get(realm, {})
                 for default_port in True, False:
                     reduced_authuri = self.reduce_uri(authuri, default_port)
-                    for uri, authinfo in authinfo_by_domain.iteritems():
+                    for uri, authinfo in authinfo_by_domain.items():
                         if uri is None and not default_uri:
                             continue
                         if self.is_suburi(uri, reduced_authuri):
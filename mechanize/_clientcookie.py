@@ -32,7 +32,7 @@ COPYING.txt included with the distribution).
 
 """
 
-import sys, re, copy, time, urllib, types, logging
+import sys, re, copy, time, urllib, types, logging, heapq
 try:
     import threading
     _threading = threading; del threading
@@ -1030,11 +1030,28 @@ class CookieJar:
             policy = DefaultCookiePolicy()
         self._policy = policy
 
+        self._cookies_lock = _threading.RLock()
         self._cookies = {}
+        # ._nr_cookies and ._expiry_heap are kept in step with ._cookies by
+        # .set_cookie() and .clear(); ._expiry_heap holds (expires, domain,
+        # path, name) tuples, some of which may refer to cookies that have
+        # since been replaced or removed
+        self._nr_cookies = 0
+        self._expiry_heap = []
 
         # for __getitem__ iteration in pre-2.2 Pythons
         self._prev_getitem_index = 0
 
+    def __getstate__(self):
+        # locks can't be pickled or copied
+        state = self.__dict__.copy()
+        del state["_cookies_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cookies_lock = _threading.RLock()
+
     def get_policy(self):
         return self._policy
 
@@ -1071,8 +1088,12 @@ class CookieJar:
         New in version 0.1.10
 
         """
-        self._policy._now = self._now = int(time.time())
-        cookies = self._cookies_for_request(request)
+        self._cookies_lock.acquire()
+        try:
+            self._policy._now = self._now = int(time.time())
+            cookies = self._cookies_for_request(request)
+        finally:
+            self._cookies_lock.release()
         # add cookies in order of most specific (i.e. longest) path first
         def decreasing_size(a, b): return cmp(len(b.path), len(a.path))
         cookies.sort(decreasing_size)
@@ -1085,10 +1106,47 @@ class CookieJar:
         # XXX document that implied interface, or provide another way of
         # implementing cookiejars than subclassing
         cookies = []
-        for domain in self._cookies.keys():
+        for domain in self._domains_for_request(self._cookies, request):
             cookies.extend(self._cookies_for_domain(domain, request))
         return cookies
 
+    def _domains_for_request(self, domains, request):
+        """Return those keys of dict domains that might match request.
+
+        Rather than checking every domain in a large jar, look up each domain
+        that .domain_return_ok() might accept (if that is known).
+
+        """
+        suffixes = self._domain_suffixes(request)
+        if suffixes is None:
+            return domains.keys()
+        found = []
+        for suffix in suffixes:
+            if domains.has_key(suffix):
+                found.append(suffix)
+        return found
+
+    def _domain_suffixes(self, request):
+        """Return a list of the domains the policy might accept for request.
+
+        DefaultCookiePolicy.domain_return_ok() only accepts domains that are
+        suffixes of the request-host or effective request-host (with a dot
+        prepended).  For other policies, None is returned, meaning any domain
+        might be accepted.
+
+        """
+        domain_return_ok = getattr(self._policy.domain_return_ok, "im_func",
+                                   None)
+        if domain_return_ok is not DefaultCookiePolicy.domain_return_ok.im_func:
+            return None
+        suffixes = {}
+        for host in eff_request_host_lc(request):
+            if not host.startswith("."):
+                host = "."+host
+            for ii in range(len(host)+1):
+                suffixes[host[ii:]] = None
+        return suffixes.keys()
+
     def _cookie_attrs(self, cookies):
         """Return a list of cookie-attributes to be returned to server.
 
@@ -1173,21 +1231,28 @@ class CookieJar:
 
         """
         debug("add_cookie_header")
-        cookies = self.cookies_for_request(request)
-
-        attrs = self._cookie_attrs(cookies)
-        if attrs:
-            if not request.has_header("Cookie"):
-                request.add_unredirected_header("Cookie", "; ".join(attrs))
-
-        # if necessary, advertise that we know RFC 2965
-        if self._policy.rfc2965 and not self._policy.hide_cookie2:
-            for cookie in cookies:
-                if cookie.version != 1 and not request.has_header("Cookie2"):
-                    request.add_unredirected_header("Cookie2", '$Version="1"')
-                    break
+        self._cookies_lock.acquire()
+        try:
+            cookies = self.cookies_for_request(request)
+
+            attrs = self._cookie_attrs(cookies)
+            if attrs:
+                if not request.has_header("Cookie"):
+                    request.add_unredirected_header(
+                        "Cookie", "; ".join(attrs))
+
+            # if necessary, advertise that we know RFC 2965
+            if self._policy.rfc2965 and not self._policy.hide_cookie2:
+                for cookie in cookies:
+                    if (cookie.version != 1 and
+                        not request.has_header("Cookie2")):
+                        request.add_unredirected_header(
+                            "Cookie2", '$Version="1"')
+                        break
 
-        self.clear_expired_cookies()
+            self._expire_cookies(time.time())
+        finally:
+            self._cookies_lock.release()
 
     def _normalized_cookie_tuples(self, attrs_set):
         """Return list of tuples containing normalised cookie information.
@@ -1454,9 +1519,14 @@ class CookieJar:
         response and request arguments.
 
         """
-        self._policy._now = self._now = int(time.time())
-        return [cookie for cookie in self._make_cookies(response, request)
-                if cookie.expires is None or not cookie.expires <= self._now]
+        self._cookies_lock.acquire()
+        try:
+            self._policy._now = self._now = int(time.time())
+            return [cookie for cookie in self._make_cookies(response, request)
+                    if cookie.expires is None or
+                    not cookie.expires <= self._now]
+        finally:
+            self._cookies_lock.release()
 
     def set_cookie_if_ok(self, cookie, request):
         """Set a cookie if policy says it's OK to do so.
@@ -1465,22 +1535,66 @@ class CookieJar:
         request: see extract_cookies.__doc__ for the required interface
 
         """
-        self._policy._now = self._now = int(time.time())
+        self._cookies_lock.acquire()
+        try:
+            self._policy._now = self._now = int(time.time())
 
-        if self._policy.set_ok(cookie, request):
-            self.set_cookie(cookie)
+            if self._policy.set_ok(cookie, request):
+                self.set_cookie(cookie)
+        finally:
+            self._cookies_lock.release()
 
     def set_cookie(self, cookie):
         """Set a cookie, without checking whether or not it should be set.
 
         cookie: mechanize.Cookie instance
         """
-        c = self._cookies
-        if not c.has_key(cookie.domain): c[cookie.domain] = {}
-        c2 = c[cookie.domain]
-        if not c2.has_key(cookie.path): c2[cookie.path] = {}
-        c3 = c2[cookie.path]
-        c3[cookie.name] = cookie
+        self._cookies_lock.acquire()
+        try:
+            c = self._cookies
+            if not c.has_key(cookie.domain): c[cookie.domain] = {}
+            c2 = c[cookie.domain]
+            if not c2.has_key(cookie.path): c2[cookie.path] = {}
+            c3 = c2[cookie.path]
+            if not c3.has_key(cookie.name): self._nr_cookies += 1
+            c3[cookie.name] = cookie
+            if cookie.expires is not None:
+                heap = self._expiry_heap
+                if len(heap) > 2*self._nr_cookies + 100:
+                    # too many entries for cookies that are no longer here
+                    self._reindex()
+                else:
+                    heapq.heappush(heap, (cookie.expires, cookie.domain,
+                                          cookie.path, cookie.name))
+        finally:
+            self._cookies_lock.release()
+
+    def _reindex(self):
+        # Recompute ._nr_cookies and ._expiry_heap from ._cookies (which
+        # must be called after assigning to ._cookies).
+        nr_cookies = 0
+        heap = []
+        for cookie in MappingIterator(self._cookies):
+            nr_cookies += 1
+            if cookie.expires is not None:
+                heap.append((cookie.expires, cookie.domain,
+                             cookie.path, cookie.name))
+        heapq.heapify(heap)
+        self._nr_cookies = nr_cookies
+        self._expiry_heap = heap
+
+    def _expire_cookies(self, now):
+        # Discard cookies that expired at or before time now, taking them
+        # from the front of ._expiry_heap rather than looking at every cookie.
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            expires, domain, path, name = heapq.heappop(heap)
+            try:
+                cookie = self._cookies[domain][path][name]
+            except KeyError:
+                continue
+            if cookie.is_expired(now):
+                self.clear(domain, path, name)
 
     def extract_cookies(self, response, request):
         """Extract cookies from response, where allowable given the request.
@@ -1503,21 +1617,28 @@ class CookieJar:
 
         """
         debug("extract_cookies: %s", response.info())
-        self._policy._now = self._now = int(time.time())
+        self._cookies_lock.acquire()
+        try:
+            self._policy._now = self._now = int(time.time())
 
-        for cookie in self._make_cookies(response, request):
-            if cookie.expires is not None and cookie.expires <= self._now:
-                # Expiry date in past is request to delete cookie.  This can't be
-                # in DefaultCookiePolicy, because can't delete cookies there.
-                try:
-                    self.clear(cookie.domain, cookie.path, cookie.name)
-                except KeyError:
-                    pass
-                debug("Expiring cookie, domain='%s', path='%s', name='%s'",
-                      cookie.domain, cookie.path, cookie.name)
-            elif self._policy.set_ok(cookie, request):
-                debug(" setting cookie: %s", cookie)
-                self.set_cookie(cookie)
+            for cookie in self._make_cookies(response, request):
+                if cookie.expires is not None and cookie.expires <= self._now:
+                    # Expiry date in past is request to delete cookie.  This
+                    # can't be in DefaultCookiePolicy, because can't delete
+                    # cookies there.
+                    try:
+                        self.clear(cookie.domain, cookie.path, cookie.name)
+                    except KeyError:
+                        pass
+                    debug("Expiring cookie, domain='%s', path='%s', "
+                          "name='%s'", cookie.domain, cookie.path, cookie.name)
+                elif self._policy.set_ok(cookie, request):
+                    debug(" setting cookie: %s", cookie)
+                    self.set_cookie(cookie)
+
+            self._expire_cookies(time.time())
+        finally:
+            self._cookies_lock.release()
 
     def clear(self, domain=None, path=None, name=None):
         """Clear some cookies.
@@ -1536,15 +1657,24 @@ class CookieJar:
                 raise ValueError(
                     "domain and path must be given to remove a cookie by name")
             del self._cookies[domain][path][name]
+            self._nr_cookies -= 1
         elif path is not None:
             if domain is None:
                 raise ValueError(
                     "domain must be given to remove cookies by path")
+            nr_cookies = len(self._cookies[domain][path])
             del self._cookies[domain][path]
+            self._nr_cookies -= nr_cookies
         elif domain is not None:
+            nr_cookies = 0
+            for cookies_by_name in self._cookies[domain].values():
+                nr_cookies += len(cookies_by_name)
             del self._cookies[domain]
+            self._nr_cookies -= nr_cookies
         else:
             self._cookies = {}
+            self._nr_cookies = 0
+            self._expiry_heap = []
 
     def clear_session_cookies(self):
         """Discard all session cookies.
@@ -1559,9 +1689,13 @@ class CookieJar:
         ask otherwise by passing a true ignore_discard argument.
 
         """
-        for cookie in self:
-            if cookie.discard:
-                self.clear(cookie.domain, cookie.path, cookie.name)
+        self._cookies_lock.acquire()
+        try:
+            for cookie in self:
+                if cookie.discard:
+                    self.clear(cookie.domain, cookie.path, cookie.name)
+        finally:
+            self._cookies_lock.release()
 
     def clear_expired_cookies(self):
         """Discard all expired cookies.
@@ -1573,10 +1707,11 @@ class CookieJar:
         passing a true ignore_expires argument).
 
         """
-        now = time.time()
-        for cookie in self:
-            if cookie.is_expired(now):
-                self.clear(cookie.domain, cookie.path, cookie.name)
+        self._cookies_lock.acquire()
+        try:
+            self._expire_cookies(time.time())
+        finally:
+            self._cookies_lock.release()
 
     def __getitem__(self, i):
         if i == 0:
@@ -1594,9 +1729,7 @@ class CookieJar:
 
     def __len__(self):
         """Return number of contained cookies."""
-        i = 0
-        for cookie in self: i = i + 1
-        return i
+        return self._nr_cookies
 
     def __repr__(self):
         r = []
@@ -1698,10 +1831,16 @@ class FileCookieJar(CookieJar):
             if self.filename is not None: filename = self.filename
             else: raise ValueError(MISSING_FILENAME_TEXT)
 
-        old_state = copy.deepcopy(self._cookies)
-        self._cookies = {}
+        self._cookies_lock.acquire()
         try:
-            self.load(filename, ignore_discard, ignore_expires)
-        except (LoadError, IOError):
-            self._cookies = old_state
-            raise
+            old_state = copy.deepcopy(self._cookies)
+            self._cookies = {}
+            self._reindex()
+            try:
+                self.load(filename, ignore_discard, ignore_expires)
+            except (LoadError, IOError):
+                self._cookies = old_state
+                self._reindex()
+                raise
+        finally:
+            self._cookies_lock.release()
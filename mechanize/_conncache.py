@@ -0,0 +1,270 @@
+"""Cache of persistent (keep-alive) HTTP connections.
+
+Used by mechanize.HTTPHandler and mechanize.HTTPSHandler when a connection
+cache has been set (see UserAgentBase.set_http_connection_cache()).
+
+"""
+
+import logging, select, socket, time
+try:
+    import threading as _threading
+except ImportError:
+    import dummy_threading as _threading
+
+import _sockettimeout
+
+debug = logging.getLogger("mechanize.connections").debug
+
+# requests with these methods (and no body) may safely be sent again when a
+# reused connection turns out to have been closed by the server
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "TRACE", "DELETE")
+
+
+def connection_is_stale(conn):
+    """Return true if an idle connection can no longer be used.
+
+    An idle HTTP connection should have nothing to read: if the socket is
+    readable, the server has either closed it or sent junk, and either way
+    it's not safe to send another request on it.
+
+    """
+    sock = getattr(conn, "sock", None)
+    if sock is None:
+        return True
+    try:
+        readable = select.select([sock], [], [], 0)[0]
+    except (select.error, socket.error, ValueError, TypeError):
+        return True
+    return bool(readable)
+
+
+def set_timeout(conn, timeout):
+    """Set the socket timeout of an already-connected connection."""
+    if timeout is _sockettimeout._GLOBAL_DEFAULT_TIMEOUT:
+        timeout = socket.getdefaulttimeout()
+    conn.timeout = timeout
+    sock = getattr(conn, "sock", None)
+    if sock is not None:
+        sock.settimeout(timeout)
+
+
+class ConnectionCache:
+    """Pool of persistent HTTP connections.
+
+    Connections are keyed by (scheme, host:port, proxy tunnel host, ...), as
+    computed by the handler that uses the cache.  Instances are safe to share
+    between threads and between UserAgent / Browser instances.
+
+    Constructor arguments / public attributes:
+
+    max_idle_per_host: maximum number of idle connections kept per key;
+     connections released beyond this are closed
+    max_per_host: maximum number of connections (idle and in use) per key, or
+     None for no limit; .get_connection() blocks while the limit is reached
+     (a connection stays in use until its response is read to the end,
+     closed, or garbage collected)
+    idle_timeout: idle connections older than this many seconds are closed
+     rather than reused (None for no timeout)
+    max_drain: when a response is closed before its body has been read, up to
+     this many bytes of body are read and discarded so that the connection
+     can be reused; if there is more left than that, the connection is closed
+     instead
+
+    """
+
+    def __init__(self, max_idle_per_host=4, max_per_host=None,
+                 idle_timeout=60., max_drain=64*1024):
+        self.max_idle_per_host = max_idle_per_host
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.max_drain = max_drain
+        self._time = time.time
+        self._lock = _threading.Lock()
+        self._released = _threading.Condition(self._lock)
+        # key --> list of (connection, time released); most recent last
+        self._idle = {}
+        # key --> number of connections handed out and not yet released
+        self._in_use = {}
+
+    def get_connection(self, key, factory):
+        """Return (connection, reused).
+
+        If no usable idle connection is cached under key, factory() is called
+        to make a new one.
+
+        """
+        self._lock.acquire()
+        try:
+            while True:
+                conn = self._pop_idle(key)
+                if conn is not None:
+                    self._in_use[key] = self._in_use.get(key, 0) + 1
+                    debug("reusing connection for %r", key)
+                    return conn, True
+                if (self.max_per_host is None or
+                    self._in_use.get(key, 0) < self.max_per_host):
+                    break
+                self._released.wait()
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+        finally:
+            self._lock.release()
+
+        try:
+            conn = factory()
+        except:
+            self._forget(key)
+            raise
+        debug("new connection for %r", key)
+        return conn, False
+
+    def _pop_idle(self, key):
+        # must hold lock
+        idle = self._idle.get(key)
+        now = self._time()
+        while idle:
+            conn, released = idle.pop()
+            if (self.idle_timeout is not None and
+                now - released > self.idle_timeout):
+                debug("discarding timed-out connection for %r", key)
+                conn.close()
+            elif connection_is_stale(conn):
+                debug("discarding stale connection for %r", key)
+                conn.close()
+            else:
+                return conn
+        return None
+
+    def _forget(self, key):
+        self._lock.acquire()
+        try:
+            self._in_use[key] -= 1
+            self._released.notify()
+        finally:
+            self._lock.release()
+
+    def release(self, key, conn, reusable=True):
+        """Hand a connection back to the cache.
+
+        If reusable is false, or there are already enough idle connections,
+        the connection is closed.
+
+        """
+        self._lock.acquire()
+        try:
+            self._in_use[key] -= 1
+            idle = self._idle.setdefault(key, [])
+            if reusable and len(idle) < self.max_idle_per_host:
+                idle.append((conn, self._time()))
+                conn = None
+            self._released.notify()
+        finally:
+            self._lock.release()
+        if conn is not None:
+            conn.close()
+
+    def nr_idle(self, key=None):
+        self._lock.acquire()
+        try:
+            if key is not None:
+                return len(self._idle.get(key, []))
+            nr = 0
+            for idle in self._idle.itervalues():
+                nr += len(idle)
+            return nr
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Close all idle connections."""
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+        for conns in idle.itervalues():
+            for conn, released in conns:
+                conn.close()
+
+
+class _ConnectionSlot:
+    # An in-use connection.  If it is garbage collected before being
+    # released (because a response was dropped without being read or
+    # closed), the connection is closed and its place in the cache freed.
+    # Kept separate from connection_releasing_response so that reference
+    # cycles through the response don't stop .__del__() from being called.
+
+    def __init__(self, cache, key, conn):
+        self.cache = cache
+        self.key = key
+        self.conn = conn
+
+    def release(self, reusable=True):
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            self.cache.release(self.key, conn, reusable)
+
+    def __del__(self):
+        if self.conn is not None:
+            debug("discarding unreleased connection for %r", self.key)
+            self.release(False)
+
+
+class connection_releasing_response:
+    """Wraps an httplib.HTTPResponse read from a cached connection.
+
+    Returns the connection to the cache once the response body has been
+    completely read, or when the response is closed (draining any unread
+    body first, within the limit set by the cache's .max_drain attribute).
+    If the response is garbage collected first, the connection is closed.
+
+    """
+
+    def __init__(self, response, cache, key, conn):
+        self._response = response
+        self._cache = cache
+        self._slot = _ConnectionSlot(cache, key, conn)
+        self.msg = response.msg
+        self.status = response.status
+        self.reason = response.reason
+
+    def _maybe_release(self):
+        if self._slot.conn is not None and self._response.isclosed():
+            self._slot.release()
+
+    def read(self, amt=None):
+        try:
+            data = self._response.read(amt)
+        except:
+            self._discard()
+            raise
+        self._maybe_release()
+        return data
+    recv = read
+
+    def _discard(self):
+        self._slot.release(False)
+
+    def _drain(self):
+        length = self._response.length
+        if length is not None and length > self._cache.max_drain:
+            return
+        left = self._cache.max_drain
+        while left > 0 and not self._response.isclosed():
+            data = self._response.read(min(left, 8192))
+            if not data:
+                break
+            left -= len(data)
+
+    def close(self):
+        if self._slot.conn is not None:
+            try:
+                self._drain()
+            except (socket.error, IOError, ValueError):
+                pass
+            self._maybe_release()
+            self._discard()
+        self._response.close()
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
@@ -16,6 +16,11 @@ from _clientcookie import CookieJar, Cookie, MappingIterator
 from _util import isstringlike, experimental
 debug = logging.getLogger("mechanize.cookies").debug
 
+# lists of hosts in queries are padded to a multiple of this length, so that
+# only a few distinct statements are made (and they stay in sqlite3's
+# statement cache)
+HOST_LIST_STEP = 16
+
 
 class Firefox3CookieJar(CookieJar):
 
@@ -31,9 +36,20 @@ class Firefox3CookieJar(CookieJar):
      Firefox3CookieJar construction time (default True)
     policy: an object satisfying the mechanize.CookiePolicy interface
 
+    flush_interval: if None (the default), changes are committed to the
+     database after each public method call; otherwise, changes are committed
+     at most once every flush_interval seconds (and by .flush() and .close()),
+     which saves a lot of disk syncing for a busy cookiejar.  Note that
+     uncommitted changes are lost if a database error occurs, and that other
+     processes can't write to the database while changes are uncommitted.
+    expire_interval: expired cookies are deleted from the database at most
+     once every expire_interval seconds (and whenever .clear_expired_cookies()
+     is called); in between, they are kept but never returned
+
     Note that this is NOT a FileCookieJar, and there are no .load(),
-    .save() or .restore() methods.  The database is in sync with the
-    cookiejar object's state after each public method call.
+    .save() or .restore() methods.  Unless flush_interval is set, the
+    database is in sync with the cookiejar object's state after each public
+    method call.
 
     Following Firefox's own behaviour, session cookies are never saved to
     the database.
@@ -47,12 +63,17 @@ class Firefox3CookieJar(CookieJar):
     # handle DatabaseError exceptions
     # add a FileCookieJar (explicit .save() / .revert() / .load() methods)
 
-    def __init__(self, filename, autoconnect=True, policy=None):
+    def __init__(self, filename, autoconnect=True, policy=None,
+                 flush_interval=None, expire_interval=60):
         experimental("Firefox3CookieJar is experimental code")
         CookieJar.__init__(self, policy)
         if filename is not None and not isstringlike(filename):
             raise ValueError("filename must be string-like")
         self.filename = filename
+        self.flush_interval = flush_interval
+        self.expire_interval = expire_interval
+        self._time = time.time
+        self._last_flush = self._last_expire = None
         self._conn = None
         if autoconnect:
             self.connect()
@@ -60,11 +81,18 @@ class Firefox3CookieJar(CookieJar):
     def connect(self):
         self._conn = sqlite3.connect(self.filename)
         self._conn.isolation_level = "DEFERRED"
+        self._last_flush = self._time()
         self._create_table_if_necessary()
 
     def close(self):
+        self.flush()
         self._conn.close()
 
+    def flush(self):
+        """Commit any uncommitted changes to the database."""
+        self._conn.commit()
+        self._last_flush = self._time()
+
     def _transaction(self, func):
         try:
             cur = self._conn.cursor()
@@ -76,7 +104,9 @@ class Firefox3CookieJar(CookieJar):
             self._conn.rollback()
             raise
         else:
-            self._conn.commit()
+            if (self.flush_interval is None or
+                self._time() - self._last_flush >= self.flush_interval):
+                self.flush()
         return result
 
     def _execute(self, query, params=()):
@@ -93,10 +123,19 @@ class Firefox3CookieJar(CookieJar):
             cur.close()
 
     def _create_table_if_necessary(self):
-        self._execute("""\
+        def create(cur):
+            cur.execute("""\
 CREATE TABLE IF NOT EXISTS moz_cookies (id INTEGER PRIMARY KEY, name TEXT,
     value TEXT, host TEXT, path TEXT,expiry INTEGER,
     lastAccessed INTEGER, isSecure INTEGER, isHttpOnly INTEGER)""")
+            # for looking up cookies by host (and path and name), and for
+            # deleting expired cookies
+            cur.execute("""\
+CREATE INDEX IF NOT EXISTS mechanize_host_path_name
+    ON moz_cookies (host, path, name)""")
+            cur.execute("""\
+CREATE INDEX IF NOT EXISTS mechanize_expiry ON moz_cookies (expiry)""")
+        self._transaction(create)
 
     def _cookie_from_row(self, row):
         (pk, name, value, domain, path, expires,
@@ -176,10 +215,8 @@ CREATE TABLE IF NOT EXISTS moz_cookies (id INTEGER PRIMARY KEY, name TEXT,
         last_accessed = int(time.time())
         http_only = cookie.has_nonstandard_attr("HttpOnly")
 
-        query = cur.execute("""SELECT MAX(id) + 1 from moz_cookies""")
-        pk = query.fetchone()[0]
-        if pk is None:
-            pk = 1
+        # SQLite picks the next free id
+        pk = None
 
         return (pk, name, value, domain, path, expires,
                 last_accessed, secure, http_only)
@@ -212,34 +249,57 @@ INSERT INTO moz_cookies VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
 SELECT * FROM moz_cookies ORDER BY name, path, host"""):
             yield self._cookie_from_row(row)
 
+    def __len__(self):
+        rows = list(self._query("SELECT COUNT(*) FROM moz_cookies"))
+        return CookieJar.__len__(self) + rows[0][0]
+
+    def clear_expired_cookies(self):
+        self._last_expire = None
+        CookieJar.clear_expired_cookies(self)
+
+    def _expire_cookies(self, now):
+        CookieJar._expire_cookies(self, now)
+        if (self._last_expire is not None and
+            now - self._last_expire < self.expire_interval):
+            return
+        self._last_expire = now
+        # in SQLite, the empty expiry of discard cookies (see
+        # ._row_from_cookie()) never compares less than a number
+        self._execute("DELETE FROM moz_cookies WHERE expiry <= ?", (now,))
+
     def _cookies_for_request(self, request):
         session_cookies = CookieJar._cookies_for_request(self, request)
-        def get_cookies(cur):
-            query = cur.execute("SELECT host from moz_cookies")
-            domains = [row[0] for row in query.fetchmany()]
-            cookies = []
-            for domain in domains:
-                cookies += self._persistent_cookies_for_domain(domain,
-                                                               request, cur)
-            return cookies
-        persistent_coookies = self._transaction(get_cookies)
-        return session_cookies + persistent_coookies
-
-    def _persistent_cookies_for_domain(self, domain, request, cur):
-        cookies = []
-        if not self._policy.domain_return_ok(domain, request):
-            return []
-        debug("Checking %s for cookies to return", domain)
-        query = cur.execute("""\
-SELECT * from moz_cookies WHERE host = ? ORDER BY path""",
-                            (domain,))
-        cookies = [self._cookie_from_row(row) for row in query.fetchmany()]
-        last_path = None
+        domains = self._domain_suffixes(request)
+        if domains is None:
+            rows = self._query(
+                "SELECT * FROM moz_cookies ORDER BY host, path")
+        else:
+            # a single indexed query for all the candidate domains
+            domains = domains + domains[-1:]*(-len(domains) % HOST_LIST_STEP)
+            rows = self._query("""\
+SELECT * FROM moz_cookies WHERE host IN (%s) ORDER BY host, path""" %
+                               ", ".join(["?"]*len(domains)), domains)
+        return session_cookies + self._persistent_cookies_for_request(
+            rows, request)
+
+    def _persistent_cookies_for_request(self, rows, request):
         r = []
-        for cookie in cookies:
-            if (cookie.path != last_path and
-                not self._policy.path_return_ok(cookie.path, request)):
+        last_domain = last_path = None
+        for row in rows:
+            cookie = self._cookie_from_row(row)
+            if cookie.domain != last_domain:
+                last_domain = cookie.domain
+                last_path = None
+                domain_ok = self._policy.domain_return_ok(cookie.domain,
+                                                          request)
+                if domain_ok:
+                    debug("Checking %s for cookies to return", cookie.domain)
+            if not domain_ok:
+                continue
+            if cookie.path != last_path:
                 last_path = cookie.path
+                path_ok = self._policy.path_return_ok(cookie.path, request)
+            if not path_ok:
                 continue
             if not self._policy.return_ok(cookie, request):
                 debug("   not returning cookie")
@@ -1,7 +1,10 @@
-import urllib2
+import mimetools, urllib2, zlib
 from cStringIO import StringIO
+
 import _response
 
+CHUNK = 8192  # size of chunks of encoded data read at a time, in bytes
+
 # GzipConsumer was taken from Fredrik Lundh's effbot.org-0.1-20041009 library
 class GzipConsumer:
 
@@ -61,43 +64,233 @@ class GzipConsumer:
 # the rest of this module is John Lee's stupid code, not
 # Fredrik's nice code :-)
 
-class stupid_gzip_consumer:
+class DeflateConsumer:
+    """Like GzipConsumer, but for the "deflate" content-coding.
+
+    RFC 2616 says "deflate" means zlib format (RFC 1950), but some servers
+    send raw deflate data (RFC 1951) instead, so accept both.
+
+    """
+
+    def __init__(self, consumer):
+        self._consumer = consumer
+        self._decoder = None
+        self._data = ""
+
+    def feed(self, data):
+        if self._decoder is None:
+            # look at the first two bytes to see if there's a zlib header
+            data = self._data + data
+            if len(data) < 2:
+                self._data = data
+                return
+            self._data = ""
+            cmf, flg = ord(data[0]), ord(data[1])
+            if cmf & 0x0f == 8 and (cmf << 8 | flg) % 31 == 0:
+                self._decoder = zlib.decompressobj()
+            else:
+                self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+        data = self._decoder.decompress(data)
+        if data:
+            self._consumer.feed(data)
+
+    def close(self):
+        if self._decoder:
+            data = self._decoder.flush()
+            if data:
+                self._consumer.feed(data)
+        self._consumer.close()
+
+
+class list_consumer:
     def __init__(self): self.data = []
     def feed(self, data): self.data.append(data)
+    def close(self): pass
+
+def decoded_headers(headers, encodings):
+    """Return a copy of headers, for a response body that has been decoded.
+
+    encodings is the list of content-codings still applied to the body (in
+    the order they were applied).  Content-Length is dropped, since the
+    length of the decoded body isn't known.
+
+    """
+    lines = []
+    keep = True
+    for line in headers.headers:
+        if line[:1] not in " \t":  # not a continuation line
+            name = line.split(":", 1)[0].strip().lower()
+            keep = name not in ("content-encoding", "content-length")
+        if keep:
+            lines.append(line.rstrip("\r\n"))
+    if encodings:
+        lines.append("Content-Encoding: %s" % ", ".join(encodings))
+    return mimetools.Message(StringIO("\n".join(lines)))
+
+class decoded_response(_response.closeable_response):
+    """Response whose body is decoded (decompressed) lazily, as it is read.
 
-class stupid_gzip_wrapper(_response.closeable_response):
-    def __init__(self, response):
+    decoder_class is GzipConsumer or DeflateConsumer (or anything else with
+    the same interface).  headers are returned by .info() (by default, those
+    of the wrapped response).
+
+    """
+
+    def __init__(self, response, decoder_class=GzipConsumer, headers=None):
         self._response = response
+        if headers is None:
+            headers = response.info()
+        self._headers = headers
+        self._decoded = list_consumer()
+        self._decoder = decoder_class(self._decoded)
+        # decoded data not yet returned is ._buffer[._pos:]
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
 
-        c = stupid_gzip_consumer()
-        gzc = GzipConsumer(c)
-        gzc.feed(response.read())
-        self.__data = StringIO("".join(c.data))
+    def _available(self):
+        return len(self._buffer) - self._pos
+
+    def _fill(self):
+        # decode another chunk; return false at end of body
+        if self._eof:
+            return False
+        data = self._response.read(CHUNK)
+        if data:
+            self._decoder.feed(data)
+        else:
+            self._decoder.close()
+            self._eof = True
+        decoded = self._decoded.data
+        if decoded:
+            decoded.insert(0, self._buffer[self._pos:])
+            self._buffer = "".join(decoded)
+            self._pos = 0
+            del decoded[:]
+        return True
 
     def read(self, size=-1):
-        return self.__data.read(size)
+        if size is None or size < 0:
+            while self._fill():
+                pass
+            size = self._available()
+        else:
+            while self._available() < size and self._fill():
+                pass
+        pos = self._pos
+        self._pos = min(pos + size, len(self._buffer))
+        return self._buffer[pos:self._pos]
+
     def readline(self, size=-1):
-        return self.__data.readline(size)
+        searched = 0  # how much of the available data has no newline
+        while True:
+            ii = self._buffer.find("\n", self._pos + searched)
+            if ii != -1:
+                end = ii + 1
+                break
+            searched = self._available()
+            if 0 <= size <= searched or not self._fill():
+                end = len(self._buffer)
+                break
+        if 0 <= size < end - self._pos:
+            end = self._pos + size
+        pos = self._pos
+        self._pos = end
+        return self._buffer[pos:end]
+
     def readlines(self, sizehint=-1):
-        return self.__data.readlines(sizehint)
+        lines = []
+        total = 0
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+            total += len(line)
+            if 0 < sizehint <= total:
+                break
+        return lines
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration()
+        return line
+
+    def fileno(self):
+        # the file descriptor would give the encoded data
+        return None
+
+    def close(self):
+        self._response.close()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = True
+
+    def __repr__(self):
+        return "<%s at %s whose wrapped object = %r>" % (
+            self.__class__.__name__, hex(abs(id(self))), self._response)
+
+    # seeking in the wrapped response would mean seeking in the encoded data
+    _not_delegated = ("seek", "tell", "get_data", "set_data", "wrapped",
+                      "read_complete")
 
     def __getattr__(self, name):
         # delegate unknown methods/attributes
+        if name in self._not_delegated:
+            raise AttributeError(name)
         return getattr(self._response, name)
 
+
+decoder_classes = {
+    "gzip": GzipConsumer,
+    "x-gzip": GzipConsumer,
+    "deflate": DeflateConsumer,
+    }
+
 class HTTPGzipProcessor(urllib2.BaseHandler):
+    """Decode gzip and deflate content-codings.
+
+    Response bodies are decompressed incrementally as they are read.  The
+    decoded response's headers have the decoded content-codings removed from
+    Content-Encoding, and have no Content-Length.
+
+    Responses to requests with "Accept-Encoding: identity" are left alone
+    (a Content-Encoding header there most likely describes a compressed file,
+    such as a .tar.gz, that should be kept as it is).  OpenerDirector.retrieve()
+    makes such requests.
+
+    """
     handler_order = 200  # response processing before HTTPEquivProcessor
 
     def http_request(self, request):
-        request.add_header("Accept-Encoding", "gzip")
+        if not request.has_header("Accept-encoding"):
+            request.add_unredirected_header("Accept-encoding", "gzip, deflate")
         return request
 
     def http_response(self, request, response):
         # post-process response
-        enc_hdrs = response.info().getheaders("Content-encoding")
-        for enc_hdr in enc_hdrs:
-            if ("gzip" in enc_hdr) or ("compress" in enc_hdr):
-                return stupid_gzip_wrapper(response)
+        accept = request.get_header("Accept-encoding", "")
+        if accept.strip().lower() == "identity":
+            return response
+        encodings = []
+        for enc_hdr in response.info().getheaders("Content-encoding"):
+            for encoding in enc_hdr.split(","):
+                encoding = encoding.strip().lower()
+                if encoding and encoding != "identity":
+                    encodings.append(encoding)
+        # decode in the reverse of the order the encodings were applied
+        while encodings:
+            decoder_class = decoder_classes.get(encodings[-1])
+            if decoder_class is None:
+                break
+            del encodings[-1]
+            headers = decoded_headers(response.info(), encodings)
+            response = decoded_response(response, decoder_class, headers)
         return response
 
+    https_request = http_request
     https_response = http_response
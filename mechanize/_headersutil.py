@@ -45,9 +45,12 @@ def unmatched(match):
     start, end = match.span(0)
     return match.string[:start]+match.string[end:]
 
-token_re =        re.compile(r"^\s*([^=\s;,]+)")
-quoted_value_re = re.compile(r"^\s*=\s*\"([^\"\\]*(?:\\.[^\"\\]*)*)\"")
-value_re =        re.compile(r"^\s*=\s*([^\s;,]*)")
+# these are matched at a position in the header value (not searched)
+token_re =        re.compile(r"\s*([^=\s;,]+)")
+quoted_value_re = re.compile(r"\s*=\s*\"([^\"\\]*(?:\\.[^\"\\]*)*)\"")
+value_re =        re.compile(r"\s*=\s*([^\s;,]*)")
+comma_re =        re.compile(r"\s*,")
+junk_re =         re.compile(r"[=\s;]*")
 escape_re = re.compile(r"\\(.)")
 def split_header_words(header_values):
     r"""Parse header values into a list of lists containing key,value pairs.
@@ -95,42 +98,51 @@ def split_header_words(header_values):
 
     """
     assert type(header_values) not in STRING_TYPES
+    match_token = token_re.match
+    match_quoted_value = quoted_value_re.match
+    match_value = value_re.match
+    match_comma = comma_re.match
+    match_junk = junk_re.match
     result = []
     for text in header_values:
-        orig_text = text
+        # one pass along text: pos is the start of the unparsed remainder
+        pos = 0
+        end = len(text)
         pairs = []
-        while text:
-            m = token_re.search(text)
+        while pos < end:
+            m = match_token(text, pos)
             if m:
-                text = unmatched(m)
+                pos = m.end()
                 name = m.group(1)
-                m = quoted_value_re.search(text)
+                m = match_quoted_value(text, pos)
                 if m:  # quoted value
-                    text = unmatched(m)
+                    pos = m.end()
                     value = m.group(1)
-                    value = escape_re.sub(r"\1", value)
+                    if "\\" in value:
+                        value = escape_re.sub(r"\1", value)
                 else:
-                    m = value_re.search(text)
+                    m = match_value(text, pos)
                     if m:  # unquoted value
-                        text = unmatched(m)
+                        pos = m.end()
                         value = m.group(1)
-                        value = value.rstrip()
                     else:
                         # no value, a lone token
                         value = None
                 pairs.append((name, value))
-            elif text.lstrip().startswith(","):
+                continue
+            m = match_comma(text, pos)
+            if m:
                 # concatenated headers, as per RFC 2616 section 4.2
-                text = text.lstrip()[1:]
+                pos = m.end()
                 if pairs: result.append(pairs)
                 pairs = []
             else:
                 # skip junk
-                non_junk, nr_junk_chars = re.subn("^[=\s;]*", "", text)
-                assert nr_junk_chars > 0, (
+                m = match_junk(text, pos)
+                assert m.end() > pos, (
                     "split_header_words bug: '%s', '%s', %s" %
-                    (orig_text, text, pairs))
-                text = non_junk
+                    (text, text[pos:], pairs))
+                pos = m.end()
         if pairs: result.append(pairs)
     return result
 
@@ -193,16 +205,19 @@ def parse_ns_headers(ns_headers):
     for ns_header in ns_headers:
         pairs = []
         version_set = False
-        params = re.split(r";\s*", ns_header)
+        params = ns_header.split(";")
         for ii in range(len(params)):
             param = params[ii]
+            if ii != 0:
+                param = param.lstrip()
             param = param.rstrip()
             if param == "": continue
-            if "=" not in param:
+            eq = param.find("=")
+            if eq == -1:
                 k, v = param, None
             else:
-                k, v = re.split(r"\s*=\s*", param, 1)
-                k = k.lstrip()
+                k = param[:eq].strip()
+                v = param[eq+1:].lstrip()
             if ii != 0:
                 lc = k.lower()
                 if lc in known_attrs:
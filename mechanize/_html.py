@@ -12,13 +12,21 @@ import re, copy, htmlentitydefs
 import sgmllib, ClientForm
 
 import _request
-from _headersutil import split_header_words, is_html as _is_html
+from _sniff import content_info
 import _rfc3986
 
 DEFAULT_ENCODING = "latin-1"
 
 COMPRESS_RE = re.compile(r"\s+")
 
+# element name --> name of HTML attribute holding link URL
+URLTAGS = {
+    "a": "href",
+    "area": "href",
+    "frame": "src",
+    "iframe": "src",
+    }
+
 
 # the base classe is purely for backwards compatibility
 class ParseError(ClientForm.ParseError): pass
@@ -48,21 +56,15 @@ class EncodingFinder:
     def encoding(self, response):
         # HTTPEquivProcessor may be in use, so both HTTP and HTTP-EQUIV
         # headers may be in the response.  HTTP-EQUIV headers come last,
-        # so try in order from first to last.
-        for ct in response.info().getheaders("content-type"):
-            for k, v in split_header_words([ct])[0]:
-                if k == "charset":
-                    return v
-        return self._default_encoding
+        # so HTTP charset wins; failing that, try BOM and META charset.
+        return content_info(response).encoding(self._default_encoding)
 
 class ResponseTypeFinder:
     def __init__(self, allow_xhtml):
         self._allow_xhtml = allow_xhtml
     def is_html(self, response, encoding):
-        ct_hdrs = response.info().getheaders("content-type")
-        url = response.geturl()
         # XXX encoding
-        return _is_html(ct_hdrs, url, self._allow_xhtml)
+        return content_info(response).is_html(self._allow_xhtml)
 
 
 # idea for this argument-processing trick is from Peter Otten
@@ -84,12 +86,33 @@ def form_parser_args(
     return Args(locals())
 
 
-class Link:
+class Link(object):
+    # pages may have tens of thousands of links: don't give each a __dict__
+    __slots__ = ("base_url", "url", "text", "tag", "attrs", "_absolute_url")
+
     def __init__(self, base_url, url, text, tag, attrs):
         assert None not in [url, tag, attrs]
         self.base_url = base_url
-        self.absolute_url = _rfc3986.urljoin(base_url, url)
         self.url, self.text, self.tag, self.attrs = url, text, tag, attrs
+        self._absolute_url = None
+
+    def _get_absolute_url(self):
+        # computed on first use: most links are never followed
+        if self._absolute_url is None:
+            self._absolute_url = _rfc3986.resolver(self.base_url).resolve(
+                self.url)
+        return self._absolute_url
+    def _set_absolute_url(self, absolute_url):
+        self._absolute_url = absolute_url
+    absolute_url = property(_get_absolute_url, _set_absolute_url)
+
+    def __getstate__(self):
+        return (self.base_url, self.url, self.text, self.tag, self.attrs,
+                self._absolute_url)
+    def __setstate__(self, state):
+        (self.base_url, self.url, self.text, self.tag, self.attrs,
+         self._absolute_url) = state
+
     def __cmp__(self, other):
         try:
             for name in "url", "text", "tag", "attrs":
@@ -105,12 +128,14 @@ class Link:
 
 class LinksFactory:
 
+    # .links() accepts tag, url and url_regex arguments (see Factory.links())
+    filters_links = True
+
     def __init__(self,
                  link_parser_class=None,
                  link_class=Link,
                  urltags=None,
                  ):
-        import _pullparser
         if link_parser_class is None:
             link_parser_class = _pullparser.TolerantPullParser
         self.link_parser_class = link_parser_class
@@ -131,15 +156,28 @@ class LinksFactory:
         self._encoding = encoding
         self._base_url = base_url
 
-    def links(self):
-        """Return an iterator that provides links of the document."""
+    def links(self, tag=None, url=None, url_regex=None):
+        """Return an iterator that provides links of the document.
+
+        If tag, url or url_regex (a compiled regular expression) are given,
+        only links that match them are returned (see Browser.find_link()).
+        Link text is not extracted for other links.
+
+        """
         response = self._response
         encoding = self._encoding
         base_url = self._base_url
+        if tag is None:
+            tags = self.urltags.keys()
+        elif tag in self.urltags:
+            tags = [tag]
+        else:
+            return
         p = self.link_parser_class(response, encoding=encoding)
+        clean_url = _rfc3986.URLCleaner(encoding).clean
 
         try:
-            for token in p.tags(*(self.urltags.keys()+["base"])):
+            for token in p.tags(*(tags+["base"])):
                 if token.type == "endtag":
                     continue
                 if token.data == "base":
@@ -154,26 +192,62 @@ class LinksFactory:
                 # XXX use attr_encoding for ref'd doc if that doc does not
                 #  provide one by other means
                 #attr_encoding = attrs.get("charset")
-                url = attrs.get(self.urltags[tag])  # XXX is "" a valid URL?
-                if not url:
+                url_ = attrs.get(self.urltags[tag])  # XXX is "" a valid URL?
+                if not url_:
                     # Probably an <A NAME="blah"> link or <AREA NOHREF...>.
                     # For our purposes a link is something with a URL, so
                     # ignore this.
                     continue
 
-                url = _rfc3986.clean_url(url, encoding)
+                url_ = clean_url(url_)
+                wanted = url_matches(url_, url, url_regex)
                 if tag == "a":
                     if token.type != "startendtag":
-                        # hmm, this'd break if end tag is missing
-                        text = p.get_compressed_text(("endtag", tag))
+                        if wanted:
+                            # hmm, this'd break if end tag is missing
+                            text = p.get_compressed_text(("endtag", tag))
+                        else:
+                            # skip the link text, as .get_compressed_text()
+                            # would
+                            skip_to_tag(p, ("endtag", tag))
                     # but this doesn't work for eg.
                     # <a href="blah"><b>Andy</b></a>
                     #text = p.get_compressed_text()
 
-                yield Link(base_url, url, text, tag, token.attrs)
+                if wanted:
+                    yield self.link_class(base_url, url_, text, tag,
+                                          token.attrs)
         except sgmllib.SGMLParseError, exc:
             raise ParseError(exc)
 
+
+def url_matches(url, want_url=None, url_regex=None):
+    """Return true if Link URL url passes Browser.find_link()'s url and
+    url_regex tests (url_regex must be a compiled regular expression)."""
+    if want_url is not None and want_url != url:
+        return False
+    if url_regex is not None and not url_regex.search(url):
+        return False
+    return True
+
+def skip_to_tag(parser, endat):
+    """Discard pull parser tokens as .get_text(endat) would read them.
+
+    endat is a (token type, element name) tuple.
+
+    """
+    tok = None
+    while 1:
+        try:
+            tok = parser.get_token()
+        except _pullparser.NoMoreTokensError:
+            # like .get_text(), unget the last token
+            if tok: parser.unget_token(tok)
+            return
+        if (tok.type, tok.data) == endat:
+            parser.unget_token(tok)
+            return
+
 class FormsFactory:
 
     """Makes a sequence of objects satisfying ClientForm.HTMLForm interface.
@@ -238,7 +312,6 @@ class TitleFactory:
         self._encoding = encoding
 
     def _get_title_text(self, parser):
-        import _pullparser
         text = []
         tok = None
         while 1:
@@ -263,7 +336,6 @@ class TitleFactory:
         return COMPRESS_RE.sub(" ", "".join(text).strip())
 
     def title(self):
-        import _pullparser
         p = _pullparser.TolerantPullParser(
             self._response, encoding=self._encoding)
         try:
@@ -277,6 +349,339 @@ class TitleFactory:
             raise ParseError(exc)
 
 
+class DocumentParser(ClientForm.FormParser):
+    """Form parser that also collects links, title, base href and META tags.
+
+    Public attributes, set once .close() has been called:
+
+    links: list of (base href or None, url, text, tag, attrs) tuples, where
+     base href is the value of the last preceding BASE element's href
+     attribute
+    title: page title, or None
+    base: value of the last BASE element's href attribute, or None
+    meta: list of attribute lists of META elements
+    form_error: the ClientForm.ParseError raised by the first form markup
+     ClientForm could not make sense of (e.g. nested FORMs), or None.  After
+     such an error, forms are no longer collected, but everything else is
+
+    Links and title are found as LinksFactory and TitleFactory would find
+    them.
+
+    """
+
+    textify = {"img": "alt", "applet": "alt"}
+
+    def __init__(self, entitydefs=None, encoding=DEFAULT_ENCODING,
+                 urltags=None):
+        ClientForm.FormParser.__init__(self, entitydefs, encoding)
+        if urltags is None:
+            urltags = URLTAGS
+        self.urltags = urltags
+        self.links = []
+        self.title = None
+        self.meta = []
+        self.form_error = None
+        self._link_base = None
+        # while inside <a>: (base, url, tag, attrs) and list of text pieces
+        self._link = None
+        self._link_text = None
+        # None before <title>, then list of text pieces; ._title_done is set
+        # once </title> is seen
+        self._title_text = None
+        self._title_done = False
+        # tags worth looking at when not inside <a> or <title>
+        self._tags = dict.fromkeys(urltags.keys() + ["base", "meta", "title"])
+        # true while inside <a> or <title>: every tag and all data matter
+        self._collecting = False
+
+    def finish_starttag(self, tag, attrs):
+        if self._collecting or tag in self._tags:
+            self._tag("starttag", tag, attrs)
+        if self.form_error is not None:
+            if tag == "base":
+                self.do_base(attrs)
+            return
+        try:
+            ClientForm.FormParser.finish_starttag(self, tag, attrs)
+        except ClientForm.ParseError, exc:
+            self.form_error = exc
+
+    def finish_endtag(self, tag):
+        if self._collecting or tag in self._tags:
+            self._tag("endtag", tag, None)
+        if self.form_error is not None:
+            return
+        try:
+            ClientForm.FormParser.finish_endtag(self, tag)
+        except ClientForm.ParseError, exc:
+            self.form_error = exc
+
+    def handle_data(self, data):
+        if self._collecting:
+            if self._link is not None:
+                self._link_text.append(data)
+            if self._title_text is not None and not self._title_done:
+                self._title_text.append(data)
+        if self.form_error is None:
+            ClientForm.FormParser.handle_data(self, data)
+
+    def _tag(self, type, tag, attrs):
+        if tag == "meta" and type == "starttag":
+            self.meta.append(attrs)
+        self._title_tag(type, tag, attrs)
+        self._link_tag(type, tag, attrs)
+        self._collecting = (self._link is not None or
+                            (self._title_text is not None and
+                             not self._title_done))
+
+    def _title_tag(self, type, tag, attrs):
+        if self._title_done:
+            return
+        if self._title_text is None:
+            if tag == "title":
+                self._title_text = []
+        elif type == "endtag" and tag == "title":
+            self._end_title()
+        else:
+            self._title_text.append(str(_pullparser.Token(type, tag, attrs)))
+
+    def _end_title(self):
+        self._title_done = True
+        self.title = COMPRESS_RE.sub(" ", "".join(self._title_text).strip())
+
+    def _link_tag(self, type, tag, attrs):
+        if self._link is not None:
+            # inside <a>: other tags only contribute text
+            if type == "starttag":
+                alt = self.textify.get(tag)
+                if alt is not None:
+                    for k, v in attrs:
+                        if k == alt:
+                            self._link_text.append(v)
+                    self._link_text.append("[%s]" % tag.upper())
+            elif tag == "a":
+                self._end_link()
+            return
+        if type != "starttag":
+            return
+        if tag == "base":
+            for k, v in attrs:
+                if k == "href":
+                    self._link_base = v
+            return
+        url_attr = self.urltags.get(tag)
+        if url_attr is None:
+            return
+        url = dict(attrs).get(url_attr)
+        if not url:
+            # Probably an <A NAME="blah"> link or <AREA NOHREF...>.
+            # For our purposes a link is something with a URL, so
+            # ignore this.
+            return
+        link = self._link_base, url, tag, attrs
+        if tag == "a":
+            self._link = link
+            self._link_text = []
+        else:
+            self.links.append(link[:2] + (None,) + link[2:])
+
+    def _end_link(self):
+        base, url, tag, attrs = self._link
+        text = COMPRESS_RE.sub(" ", "".join(self._link_text).strip())
+        self.links.append((base, url, text, tag, attrs))
+        self._link = self._link_text = None
+
+    def close(self):
+        if self.form_error is None:
+            try:
+                ClientForm.FormParser.close(self)
+            except ClientForm.ParseError, exc:
+                self.form_error = exc
+        else:
+            sgmllib.SGMLParser.close(self)
+        # unclosed <a> or <title> extends to the end of the document
+        if self._link is not None:
+            self._end_link()
+        if self._title_text is not None and not self._title_done:
+            self._end_title()
+
+
+class DocumentFactory:
+    """Makes forms, links and title from a single parse of the document.
+
+    Does the jobs of FormsFactory, LinksFactory and TitleFactory, so one
+    instance may be passed to Factory as all three of those.
+
+    After the document has been parsed, the .global_form attribute is a form
+    object containing all controls not a descendant of any FORM element,
+    .base_href is the value of the last BASE element's href attribute (or
+    None), and .meta is a list of attribute lists of META elements.
+
+    For constructor argument docs, see FormsFactory and LinksFactory.
+
+    """
+
+    filters_links = True
+
+    def __init__(self,
+                 select_default=False,
+                 request_class=None,
+                 link_class=Link,
+                 urltags=None,
+                 ):
+        self.select_default = select_default
+        if request_class is None:
+            request_class = _request.Request
+        self.request_class = request_class
+        self.link_class = link_class
+        if urltags is None:
+            urltags = URLTAGS.copy()
+        self.urltags = urltags
+        self.set_response(None, None, None)
+
+    def set_response(self, response, base_url, encoding):
+        self._response = response
+        self._base_url = base_url
+        self.encoding = encoding
+        self._forms = self._title = None
+        self.global_form = self.base_href = self.meta = None
+        # The document is fed to ._parser a chunk at a time by ._feed(): by
+        # ._iter_links() while links are searched for, and to the end by
+        # ._parse(), which sets ._done.  Errors are kept, so the document is
+        # never parsed twice: form markup errors are raised by .forms() only,
+        # others (which stop the parse) by every method.
+        self._parser = None
+        self._links = []
+        self._done = False
+        self._error = self._form_error = None
+
+    def _add_links(self):
+        # make Link objects for links the parser has found since last time
+        parser_links = self._parser.links[len(self._links):]
+        if not parser_links:
+            return
+        link_class = self.link_class
+        urls = _rfc3986.URLCleaner(self.encoding).clean_all(
+            [link[1] for link in parser_links])
+        for ii in range(len(urls)):
+            base_url, url, text, tag, attrs = parser_links[ii]
+            if base_url is None:
+                base_url = self._base_url
+            self._links.append(link_class(base_url, urls[ii], text, tag, attrs))
+
+    def _feed(self):
+        # feed the next chunk of the document to the parser
+        if self._parser is None:
+            self._parser = DocumentParser(None, self.encoding, self.urltags)
+        data = self._response.read(ClientForm.CHUNK)
+        try:
+            self._parser.feed(data)
+            if len(data) == ClientForm.CHUNK:
+                self._add_links()
+                return
+            self._parser.close()
+        except ClientForm.ParseError, exc:
+            self._error = ParseError(exc)
+            self._done = True
+            return
+        self._finish()
+
+    def _finish(self):
+        parser = self._parser
+        self._done = True
+        self._add_links()
+        self._title = parser.title
+        self.base_href = parser.base
+        self.meta = parser.meta
+        if parser.form_error is not None:
+            self._form_error = ParseError(parser.form_error)
+            return
+        forms = self._make_forms(parser)
+        self.global_form = forms[0]
+        self._forms = forms[1:]
+
+    def _make_forms(self, parser):
+        # as ClientForm.ParseResponseEx() does it
+        base_uri = parser.base
+        if base_uri is None:
+            base_uri = self._response.geturl()
+        labels = []
+        id_to_labels = {}
+        for attrs in parser.labels:
+            label = ClientForm.Label(attrs)
+            labels.append(label)
+            id_to_labels.setdefault(attrs["for"], []).append(label)
+        forms = []
+        for (name, action, method, enctype), attrs, controls in parser.forms:
+            if action is None:
+                action = base_uri
+            else:
+                action = _rfc3986.urljoin(base_uri, action)
+            form = ClientForm.HTMLForm(
+                action, method, enctype, name, attrs, self.request_class,
+                forms, labels, id_to_labels, False)
+            form._urlparse = _rfc3986.urlsplit
+            form._urlunparse = _rfc3986.urlunsplit
+            for ii in range(len(controls)):
+                type, name, attrs = controls[ii]
+                form.new_control(type, name, attrs,
+                                 select_default=self.select_default,
+                                 index=ii*10)
+            forms.append(form)
+        for form in forms:
+            form.fixup()
+        return forms
+
+    def _parse(self):
+        while not self._done:
+            self._feed()
+        if self._error is not None:
+            raise self._error
+
+    def _iter_links(self):
+        ii = 0
+        while True:
+            links = self._links
+            while ii < len(links):
+                yield links[ii]
+                ii += 1
+            if self._done:
+                break
+            self._feed()
+        if self._error is not None:
+            raise self._error
+
+    def forms(self):
+        self._parse()
+        if self._form_error is not None:
+            raise self._form_error
+        return self._forms
+
+    def links(self, tag=None, url=None, url_regex=None):
+        """Return an iterator that provides links of the document.
+
+        If tag, url or url_regex are given (see LinksFactory.links()), only
+        matching links are returned, and if the document has not yet been
+        parsed, it is only parsed as far as needed to find them (the rest is
+        parsed later, if needed, by the same parser).
+
+        """
+        if not self._done and (
+            tag is not None or url is not None or url_regex is not None):
+            links = self._iter_links()
+        else:
+            self._parse()
+            links = self._links
+        for link in links:
+            if ((tag is None or tag == link.tag) and
+                url_matches(link.url, url, url_regex)):
+                yield link
+
+    def title(self):
+        self._parse()
+        return self._title
+
+
 def unescape(data, entities, encoding):
     if data is None or "&" not in data:
         return data
@@ -315,6 +720,10 @@ def unescape_charref(data, encoding):
         return repl
 
 
+# _pullparser imports unescape and unescape_charref from this module, so this
+# comes after their definitions
+import _pullparser
+
 # bizarre import gymnastics for bundled BeautifulSoup
 import _beautifulsoup
 import ClientForm
@@ -352,9 +761,170 @@ class MechanizeBs(_beautifulsoup.BeautifulSoup):
             escaped_attrs.append((key, val))
         return escaped_attrs
 
+
+# Document trees used by RobustLinksFactory and RobustTitleFactory.  A tree
+# has methods:
+#
+# elements(names): iterate over (name, attrs, node) for elements whose name
+#  is in names, in document order; attrs is a list of (name, value) pairs
+#  with character and entity references replaced
+# text(node): list of text strings (not including markup) inside node
+# title(): inner HTML of the TITLE element, whitespace compressed, or None
+#
+# Tree builders have a method .build(data, encoding) that returns a tree.
+
+class SoupTree:
+    """Document tree built by MechanizeBs (the bundled BeautifulSoup)."""
+
+    def __init__(self, soup):
+        self.soup = soup
+
+    def elements(self, names):
+        soup = self.soup
+        for ch in soup.recursiveChildGenerator():
+            if isinstance(ch, _beautifulsoup.Tag) and ch.name in names:
+                yield ch.name, soup.unescape_attrs(ch.attrs), ch
+
+    def text(self, node):
+        return node.fetchText(lambda t: True)
+
+    def title(self):
+        title = self.soup.first("title")
+        if title == _beautifulsoup.Null:
+            return None
+        else:
+            inner_html = "".join([str(node) for node in title.contents])
+            return COMPRESS_RE.sub(" ", inner_html.strip())
+
+class SoupTreeBuilder:
+    def __init__(self, soup_class=None):
+        if soup_class is None:
+            soup_class = MechanizeBs
+        self.soup_class = soup_class
+    def build(self, data, encoding):
+        return SoupTree(self.soup_class(encoding, data))
+
+try:
+    import lxml.html, lxml.etree
+except ImportError:
+    lxml = None
+
+class LxmlTree:
+    """Document tree built by lxml (http://codespeak.net/lxml/).
+
+    lxml returns unicode; text is encoded back to the document encoding,
+    with characters that encoding can't represent as character references.
+
+    """
+
+    def __init__(self, root, encoding):
+        self._root = root
+        self._encoding = encoding
+
+    def _encode(self, text):
+        if isinstance(text, unicode):
+            text = text.encode(self._encoding, "xmlcharrefreplace")
+        return text
+
+    def elements(self, names):
+        if self._root is None:
+            return
+        encode = self._encode
+        for el in self._root.iter():
+            # (comments and processing instructions have non-string .tag)
+            if el.tag in names:
+                attrs = [(k, encode(v)) for k, v in el.items()]
+                yield el.tag, attrs, el
+
+    def text(self, node):
+        return [self._encode(text) for text in node.itertext()]
+
+    def title(self):
+        if self._root is None:
+            return None
+        title = self._root.find(".//title")
+        if title is None:
+            return None
+        parts = [title.text or ""]
+        for child in title:
+            parts.append(lxml.html.tostring(
+                child, method="html", encoding=unicode, with_tail=False))
+            parts.append(child.tail or "")
+        inner_html = self._encode("".join(parts))
+        return COMPRESS_RE.sub(" ", inner_html.strip())
+
+class LxmlTreeBuilder:
+    """Faster than SoupTreeBuilder, and just as forgiving of bad HTML.
+
+    Requires lxml.  Falls back to SoupTreeBuilder for encodings Python
+    doesn't know about.
+
+    """
+
+    ref_re = re.compile(r"&#?[A-Za-z0-9]+?;")
+
+    def __init__(self):
+        if lxml is None:
+            raise ImportError("LxmlTreeBuilder requires lxml")
+        self._fallback = SoupTreeBuilder()
+
+    def build(self, data, encoding):
+        # transcode here rather than have lxml decode, since libxml2 doesn't
+        # know all of Python's encoding names
+        try:
+            data = data.decode(encoding, "replace").encode("utf-8")
+        except LookupError:
+            return self._fallback.build(data, encoding)
+        # like unescape(), leave alone references to characters the encoding
+        # can't represent
+        def protect_ref(match, encoding=encoding):
+            ref = match.group(0)
+            if unescape(ref, htmlentitydefs.name2codepoint, encoding) == ref:
+                return "&amp;" + ref[1:]
+            return ref
+        data = self.ref_re.sub(protect_ref, data)
+        parser = lxml.html.HTMLParser(encoding="utf-8")
+        try:
+            root = lxml.html.document_fromstring(data, parser=parser)
+        except lxml.etree.ParserError:
+            # empty document
+            root = None
+        return LxmlTree(root, encoding)
+
+def default_tree_builder():
+    """Return LxmlTreeBuilder if lxml is installed, else SoupTreeBuilder."""
+    if lxml is not None:
+        return LxmlTreeBuilder()
+    return SoupTreeBuilder()
+
+class LazyTree:
+    """Builds the tree from the response the first time it's used."""
+
+    def __init__(self, tree_builder, response, encoding):
+        self._tree_builder = tree_builder
+        self._response = response
+        self._encoding = encoding
+        self._tree = None
+
+    def _get_tree(self):
+        if self._tree is None:
+            data = self._response.read()
+            self._tree = self._tree_builder.build(data, self._encoding)
+            self._response = None
+        return self._tree
+
+    def elements(self, names):
+        return self._get_tree().elements(names)
+    def text(self, node):
+        return self._get_tree().text(node)
+    def title(self):
+        return self._get_tree().title()
+
+
 class RobustLinksFactory:
 
     compress_re = COMPRESS_RE
+    filters_links = True
 
     def __init__(self,
                  link_parser_class=None,
@@ -373,47 +943,55 @@ class RobustLinksFactory:
                 "iframe": "src",
                 }
         self.urltags = urltags
-        self._bs = None
+        self._tree = None
         self._encoding = None
         self._base_url = None
 
-    def set_soup(self, soup, base_url, encoding):
-        self._bs = soup
+    def set_tree(self, tree, base_url, encoding):
+        self._tree = tree
         self._base_url = base_url
         self._encoding = encoding
 
-    def links(self):
-        import _beautifulsoup
-        bs = self._bs
+    def set_soup(self, soup, base_url, encoding):
+        self.set_tree(SoupTree(soup), base_url, encoding)
+
+    def links(self, tag=None, url=None, url_regex=None):
+        """See LinksFactory.links()."""
+        tree = self._tree
         base_url = self._base_url
         encoding = self._encoding
-        gen = bs.recursiveChildGenerator()
-        for ch in bs.recursiveChildGenerator():
-            if (isinstance(ch, _beautifulsoup.Tag) and
-                ch.name in self.urltags.keys()+["base"]):
-                link = ch
-                attrs = bs.unescape_attrs(link.attrs)
-                attrs_dict = dict(attrs)
-                if link.name == "base":
-                    base_href = attrs_dict.get("href")
-                    if base_href is not None:
-                        base_url = base_href
-                    continue
-                url_attr = self.urltags[link.name]
-                url = attrs_dict.get(url_attr)
-                if not url:
-                    continue
-                url = _rfc3986.clean_url(url, encoding)
-                text = link.fetchText(lambda t: True)
-                if not text:
-                    # follow _pullparser's weird behaviour rigidly
-                    if link.name == "a":
-                        text = ""
-                    else:
-                        text = None
+        if tag is None:
+            tags = self.urltags.keys()
+        elif tag in self.urltags:
+            tags = [tag]
+        else:
+            return
+        tags = tags+["base"]
+        clean_url = _rfc3986.URLCleaner(encoding).clean
+        for name, attrs, node in tree.elements(tags):
+            attrs_dict = dict(attrs)
+            if name == "base":
+                base_href = attrs_dict.get("href")
+                if base_href is not None:
+                    base_url = base_href
+                continue
+            url_attr = self.urltags[name]
+            url_ = attrs_dict.get(url_attr)
+            if not url_:
+                continue
+            url_ = clean_url(url_)
+            if not url_matches(url_, url, url_regex):
+                continue
+            text = tree.text(node)
+            if not text:
+                # follow _pullparser's weird behaviour rigidly
+                if name == "a":
+                    text = ""
                 else:
-                    text = self.compress_re.sub(" ", " ".join(text).strip())
-                yield Link(base_url, url, text, link.name, attrs)
+                    text = None
+            else:
+                text = self.compress_re.sub(" ", " ".join(text).strip())
+            yield self.link_class(base_url, url_, text, name, attrs)
 
 
 class RobustFormsFactory(FormsFactory):
@@ -430,20 +1008,17 @@ class RobustFormsFactory(FormsFactory):
 
 class RobustTitleFactory:
     def __init__(self):
-        self._bs = self._encoding = None
+        self._tree = self._encoding = None
 
-    def set_soup(self, soup, encoding):
-        self._bs = soup
+    def set_tree(self, tree, encoding):
+        self._tree = tree
         self._encoding = encoding
 
+    def set_soup(self, soup, encoding):
+        self.set_tree(SoupTree(soup), encoding)
+
     def title(self):
-        import _beautifulsoup
-        title = self._bs.first("title")
-        if title == _beautifulsoup.Null:
-            return None
-        else:
-            inner_html = "".join([str(node) for node in title.contents])
-            return COMPRESS_RE.sub(" ", inner_html.strip())
+        return self._tree.title()
 
 
 class Factory:
@@ -456,7 +1031,7 @@ class Factory:
     set_request_class(request_class)
     set_response(response)
     forms()
-    links()
+    links(tag=None, url=None, url_regex=None)
 
     Public attributes:
 
@@ -529,12 +1104,11 @@ class Factory:
             return getattr(self.__class__, name)
 
         if name == "encoding":
-            self.encoding = self._encoding_finder.encoding(
-                copy.copy(self._response))
+            self.encoding = self._encoding_finder.encoding(self._response)
             return self.encoding
         elif name == "is_html":
             self.is_html = self._response_type_finder.is_html(
-                copy.copy(self._response), self.encoding)
+                self._response, self.encoding)
             return self.is_html
         elif name == "title":
             if self.is_html:
@@ -564,11 +1138,22 @@ class Factory:
                 self._forms_factory, "global_form", None)
         return self._forms_genf()
 
-    def links(self):
+    def links(self, tag=None, url=None, url_regex=None):
         """Return iterable over mechanize.Link-like objects.
 
+        tag, url, url_regex: if any of these are given, and the links
+         factory's .filters_links attribute is true, they are passed on to
+         its .links() method, which may use them to skip links that don't
+         match (see Browser.find_link()); links that don't match may still be
+         returned
+
         Raises mechanize.ParseError on failure.
         """
+        if ((tag is not None or url is not None or url_regex is not None) and
+            self._links_genf is None and
+            getattr(self._links_factory, "filters_links", False)):
+            return self._links_factory.links(
+                tag=tag, url=url, url_regex=url_regex)
         if self._links_genf is None:
             try:
                 self._links_genf = CachingGeneratorFunction(
@@ -579,13 +1164,19 @@ class Factory:
         return self._links_genf()
 
 class DefaultFactory(Factory):
-    """Based on sgmllib."""
+    """Based on sgmllib.
+
+    Forms, links and title all come from one parse of the document (see
+    DocumentFactory).
+
+    """
     def __init__(self, i_want_broken_xhtml_support=False):
+        document_factory = DocumentFactory()
         Factory.__init__(
             self,
-            forms_factory=FormsFactory(),
-            links_factory=LinksFactory(),
-            title_factory=TitleFactory(),
+            forms_factory=document_factory,
+            links_factory=document_factory,
+            title_factory=document_factory,
             response_type_finder=ResponseTypeFinder(
                 allow_xhtml=i_want_broken_xhtml_support),
             )
@@ -594,19 +1185,20 @@ class DefaultFactory(Factory):
         Factory.set_response(self, response)
         if response is not None:
             self._forms_factory.set_response(
-                copy.copy(response), self.encoding)
-            self._links_factory.set_response(
                 copy.copy(response), response.geturl(), self.encoding)
-            self._title_factory.set_response(
-                copy.copy(response), self.encoding)
 
 class RobustFactory(Factory):
     """Based on BeautifulSoup, hopefully a bit more robust to bad HTML than is
     DefaultFactory.
 
+    Links and title come from a document tree, which is only built when
+    first needed.  The tree is built by tree_builder (see SoupTreeBuilder);
+    by default LxmlTreeBuilder if lxml is installed, else the bundled
+    BeautifulSoup.  Forms are always parsed using BeautifulSoup.
+
     """
     def __init__(self, i_want_broken_xhtml_support=False,
-                 soup_class=None):
+                 soup_class=None, tree_builder=None):
         Factory.__init__(
             self,
             forms_factory=RobustFormsFactory(),
@@ -615,17 +1207,20 @@ class RobustFactory(Factory):
             response_type_finder=ResponseTypeFinder(
                 allow_xhtml=i_want_broken_xhtml_support),
             )
-        if soup_class is None:
-            soup_class = MechanizeBs
-        self._soup_class = soup_class
+        if tree_builder is None:
+            if soup_class is None:
+                tree_builder = default_tree_builder()
+            else:
+                tree_builder = SoupTreeBuilder(soup_class)
+        self._tree_builder = tree_builder
 
     def set_response(self, response):
         Factory.set_response(self, response)
         if response is not None:
-            data = response.read()
-            soup = self._soup_class(self.encoding, data)
+            tree = LazyTree(self._tree_builder, copy.copy(response),
+                            self.encoding)
             self._forms_factory.set_response(
                 copy.copy(response), self.encoding)
-            self._links_factory.set_soup(
-                soup, response.geturl(), self.encoding)
-            self._title_factory.set_soup(soup, self.encoding)
+            self._links_factory.set_tree(
+                tree, response.geturl(), self.encoding)
+            self._title_factory.set_tree(tree, self.encoding)
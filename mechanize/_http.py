@@ -12,16 +12,23 @@ COPYING.txt included with the distribution).
 
 """
 
-import time, htmlentitydefs, logging, socket, \
-       urllib2, urllib, httplib, sgmllib
+import time, htmlentitydefs, logging, re, socket, \
+       urllib2, urllib, urlparse, httplib, sgmllib
 from urllib2 import URLError, HTTPError, BaseHandler
 from cStringIO import StringIO
+try:
+    import threading as _threading
+except ImportError:
+    import dummy_threading as _threading
 
 from _clientcookie import CookieJar
-from _headersutil import is_html
 from _html import unescape, unescape_charref
 from _request import Request
 from _response import closeable_response, response_seek_wrapper
+from _sniff import content_info
+from _util import http2time, LRUCache
+import _conncache
+import _httpcache
 import _rfc3986
 import _sockettimeout
 
@@ -306,9 +313,8 @@ class HTTPEquivProcessor(BaseHandler):
         if not hasattr(response, "seek"):
             response = response_seek_wrapper(response)
         http_message = response.info()
-        url = response.geturl()
-        ct_hdrs = http_message.getheaders("content-type")
-        if is_html(ct_hdrs, url, self._allow_xhtml):
+        info = content_info(response)
+        if info.is_html(self._allow_xhtml):
             try:
                 try:
                     html_headers = parse_head(response,
@@ -325,6 +331,7 @@ class HTTPEquivProcessor(BaseHandler):
                     text = hdr + ": " + val
                     for line in text.split("\n"):
                         http_message.headers.append(line + "\n")
+                info.update_headers(http_message)
         return response
 
     https_response = http_response
@@ -353,6 +360,258 @@ class HTTPCookieProcessor(BaseHandler):
     https_request = http_request
     https_response = http_response
 
+def robots_quote(path):
+    """Normalise a robots.txt rule path, leaving wildcards intact.
+
+    >>> robots_quote("/a b/*.cgi$")
+    '/a%20b/*.cgi$'
+
+    """
+    anchored = path.endswith("$")
+    if anchored:
+        path = path[:-1]
+    pieces = []
+    for piece in path.split("*"):
+        piece = urlparse.urlunparse(urlparse.urlparse(piece))
+        pieces.append(urllib.quote(piece))
+    path = "*".join(pieces)
+    if anchored:
+        path = path + "$"
+    return path
+
+def robots_path(url):
+    """Return the part of url that robots.txt rules are matched against."""
+    parts = urlparse.urlparse(urllib.unquote(url))
+    path = urlparse.urlunparse(("", "", parts[2], parts[3], parts[4], ""))
+    return urllib.quote(path) or "/"
+
+REQUEST_RATE_UNITS = {"s": 1, "m": 60, "h": 60*60, "d": 24*60*60}
+
+def parse_request_rate(value):
+    """Return Request-rate as (requests, seconds), or None if invalid.
+
+    >>> parse_request_rate("1/5")
+    (1, 5)
+    >>> parse_request_rate("3/1m")
+    (3, 60)
+
+    """
+    try:
+        requests, seconds = value.split("/", 1)
+        requests = int(requests)
+        seconds = seconds.strip().lower()
+        multiplier = REQUEST_RATE_UNITS.get(seconds[-1:])
+        if multiplier is None:
+            multiplier = 1
+        else:
+            seconds = seconds[:-1]
+        seconds = int(seconds) * multiplier
+    except ValueError:
+        return None
+    if requests <= 0 or seconds < 0:
+        return None
+    return requests, seconds
+
+
+class RobotRuleGroup:
+    """The rules in one group of robots.txt lines (those following one or
+    more User-agent lines).
+
+    By default, the first rule in file order whose path is a prefix of the
+    path asked about wins, as in the standard library's robotparser.  If
+    .allowance() is passed longest_match=True, the rules are applied as in
+    the robots.txt standard (RFC 9309) instead: * and $ are wildcards, the
+    longest matching rule wins, and Allow wins if an Allow and a Disallow
+    rule match equally long.
+
+    Rules are compiled on first use.  Plain path prefixes are kept in a dict,
+    looked up by each distinct prefix length; for longest_match, rules using
+    wildcards are compiled to regular expressions.
+
+    Public attributes:
+
+    agents: list of User-agent names
+    rules: list of (path, allowance) pairs, in file order
+    crawl_delay: value of the group's Crawl-delay line in seconds, or None
+    request_rate: value of the group's Request-rate line as a (requests,
+     seconds) pair, or None
+
+    """
+
+    def __init__(self):
+        self.agents = []
+        self.rules = []
+        self.crawl_delay = None
+        self.request_rate = None
+        # rule paths as robotparser quotes them (no wildcards)
+        self._plain_paths = []
+        self._first = self._prefixes = None
+
+    def add_rule(self, path, allowance):
+        if not path:
+            # an empty value means allow all
+            allowance = True
+        self.rules.append((robots_quote(path), allowance))
+        self._plain_paths.append(
+            urllib.quote(urlparse.urlunparse(urlparse.urlparse(path))))
+        self._first = self._prefixes = None
+
+    def applies_to(self, useragent):
+        # same rule as robotparser.Entry.applies_to()
+        useragent = useragent.split("/")[0].lower()
+        for agent in self.agents:
+            if agent == "*" or agent.lower() in useragent:
+                return True
+        return False
+
+    def _sorted_lengths(self, paths):
+        lengths = {}
+        for path in paths:
+            lengths[len(path)] = None
+        lengths = lengths.keys()
+        lengths.sort()
+        lengths.reverse()
+        return lengths
+
+    def _compile_first(self):
+        # path --> (index of first rule with that path, allowance)
+        first = {}
+        for ii in range(len(self.rules)):
+            path = self._plain_paths[ii]
+            if path not in first:
+                first[path] = ii, self.rules[ii][1]
+        self._first_lengths = self._sorted_lengths(first)
+        self._first = first
+
+    def _compile(self):
+        prefixes = {}
+        patterns = []
+        for path, allowance in self.rules:
+            if "*" in path or path.endswith("$"):
+                anchored = path.endswith("$")
+                if anchored:
+                    path = path[:-1]
+                regex = ".*".join(map(re.escape, path.split("*")))
+                if anchored:
+                    regex = regex + "$"
+                patterns.append((len(path) + anchored, re.compile(regex),
+                                 allowance))
+            else:
+                prefixes[path] = prefixes.get(path, False) or allowance
+        patterns.sort()
+        patterns.reverse()
+        self._lengths = self._sorted_lengths(prefixes)
+        self._patterns = patterns
+        self._prefixes = prefixes
+
+    def allowance(self, path, longest_match=False):
+        """Return True if path (as returned by robots_path()) is allowed."""
+        if longest_match:
+            return self._longest_match_allowance(path)
+        if self._first is None:
+            self._compile_first()
+        first = self._first
+        best = None
+        path_length = len(path)
+        for length in self._first_lengths:
+            if length <= path_length:
+                match = first.get(path[:length])
+                if match is not None and (best is None or match < best):
+                    best = match
+        if best is None:
+            return True
+        return best[1]
+
+    def _longest_match_allowance(self, path):
+        if self._prefixes is None:
+            self._compile()
+        best_length = -1
+        allowed = True
+        prefixes = self._prefixes
+        path_length = len(path)
+        for length in self._lengths:
+            if length <= path_length:
+                allowance = prefixes.get(path[:length])
+                if allowance is not None:
+                    best_length, allowed = length, allowance
+                    break
+        for length, regex, allowance in self._patterns:
+            if length < best_length:
+                break
+            if ((length > best_length or (allowance and not allowed)) and
+                regex.match(path)):
+                best_length, allowed = length, allowance
+        return allowed
+
+
+def parse_robots_groups(lines):
+    """Return (groups, default group) from robots.txt lines.
+
+    groups is a list of RobotRuleGroup; the default group is the first group
+    for User-agent *, or None.  Lines are grouped in the same way as
+    robotparser.RobotFileParser.parse() does it.
+
+    """
+    groups = []
+    default_group = None
+    # states:
+    #   0: start state
+    #   1: saw user-agent line
+    #   2: saw a rule line
+    state = 0
+    group = RobotRuleGroup()
+    for line in lines:
+        if not line:
+            if state == 2:
+                groups.append(group)
+            if state != 0:
+                group = RobotRuleGroup()
+                state = 0
+        i = line.find("#")
+        if i >= 0:
+            line = line[:i]
+        parts = line.strip().split(":", 1)
+        if len(parts) != 2:
+            continue
+        name = parts[0].strip().lower()
+        value = urllib.unquote(parts[1].strip())
+        if name == "user-agent":
+            if state == 2:
+                groups.append(group)
+                group = RobotRuleGroup()
+            group.agents.append(value)
+            state = 1
+        elif state == 0:
+            continue
+        elif name == "disallow" or name == "allow":
+            group.add_rule(value, name == "allow")
+            state = 2
+        elif name == "crawl-delay":
+            try:
+                delay = float(value)
+            except ValueError:
+                continue
+            if delay >= 0:
+                group.crawl_delay = delay
+            state = 2
+        elif name == "request-rate":
+            rate = parse_request_rate(value)
+            if rate is not None:
+                group.request_rate = rate
+            state = 2
+    if state == 2:
+        groups.append(group)
+
+    specific_groups = []
+    for group in groups:
+        if "*" in group.agents:
+            if default_group is None:
+                default_group = group
+        else:
+            specific_groups.append(group)
+    return specific_groups, default_group
+
+
 try:
     import robotparser
 except ImportError:
@@ -364,6 +623,78 @@ else:
             robotparser.RobotFileParser.__init__(self, url)
             self._opener = opener
             self._timeout = _sockettimeout._GLOBAL_DEFAULT_TIMEOUT
+            # set by .read(): True if robots.txt couldn't be fetched at all;
+            # lifetime in seconds given by the robots.txt response's
+            # Cache-Control or Expires header, or None
+            self.fetch_failed = False
+            self.lifetime = None
+            self._groups = None
+
+        def parse(self, lines):
+            robotparser.RobotFileParser.parse(self, lines)
+            self._groups, self._default_group = parse_robots_groups(lines)
+            # user-agent string --> group
+            self._group_for_agent = {}
+
+        def _group(self, useragent):
+            try:
+                return self._group_for_agent[useragent]
+            except KeyError:
+                pass
+            group = self._default_group
+            for candidate in self._groups:
+                if candidate.applies_to(useragent):
+                    group = candidate
+                    break
+            self._group_for_agent[useragent] = group
+            return group
+
+        def can_fetch(self, useragent, url, longest_match=False):
+            """Return true if useragent may fetch url.
+
+            See RobotRuleGroup for how rules are applied, with and without
+            longest_match.
+
+            """
+            if (self._groups is None or self.disallow_all or
+                self.allow_all):
+                return robotparser.RobotFileParser.can_fetch(
+                    self, useragent, url)
+            group = self._group(useragent)
+            if group is None:
+                return True
+            return group.allowance(robots_path(url), longest_match)
+
+        def crawl_delay(self, useragent):
+            """Return Crawl-delay in seconds for useragent, or None."""
+            if self._groups is None:
+                return None
+            group = self._group(useragent)
+            if group is None:
+                return None
+            return group.crawl_delay
+
+        def request_rate(self, useragent):
+            """Return Request-rate for useragent as (requests, seconds), or
+            None."""
+            if self._groups is None:
+                return None
+            group = self._group(useragent)
+            if group is None:
+                return None
+            return group.request_rate
+
+        def crawl_interval(self, useragent):
+            """Return the minimum seconds between requests for useragent, or
+            None if robots.txt doesn't ask for one."""
+            delay = self.crawl_delay(useragent)
+            if delay is not None:
+                return delay
+            rate = self.request_rate(useragent)
+            if rate is not None:
+                requests, seconds = rate
+                return float(seconds) / requests
+            return None
 
         def set_opener(self, opener=None):
             import _opener
@@ -387,7 +718,9 @@ else:
             except (IOError, socket.error, OSError), exc:
                 debug_robots("ignoring error opening %r: %s" %
                                    (self.url, exc))
+                self.fetch_failed = True
                 return
+            self.lifetime = robots_lifetime(f.info())
             lines = []
             line = f.readline()
             while line:
@@ -404,6 +737,113 @@ else:
                 debug_robots("parse lines")
                 self.parse(lines)
 
+    def robots_lifetime(headers):
+        """Return robots.txt cache lifetime in seconds from headers, or None.
+        """
+        cc = _httpcache.parse_cache_control(
+            headers.getheaders("Cache-Control"))
+        if "no-store" in cc or "no-cache" in cc:
+            return 0
+        if "max-age" in cc:
+            try:
+                return max(0, int(cc["max-age"]))
+            except (TypeError, ValueError):
+                return 0
+        expires = headers.get("Expires")
+        if expires is not None:
+            expires = http2time(expires)
+            date = http2time(headers.get("Date", ""))
+            if expires is None or date is None:
+                return 0
+            return max(0, expires - date)
+        return None
+
+    class RobotRulesCache:
+        """Parsed robots.txt files for many hosts.
+
+        May be shared between HTTPRobotRulesProcessor instances (and so
+        between Browsers, see UserAgentBase.set_robots_options()), including
+        across threads.
+
+        Constructor arguments / public attributes:
+
+        max_hosts: maximum number of hosts whose rules are kept; least
+         recently used hosts are forgotten first
+        ttl: seconds to keep rules for when the robots.txt response doesn't
+         say (via Cache-Control or Expires), and the most they are ever kept
+        min_ttl: rules are kept at least this long, whatever the robots.txt
+         response says, so that robots.txt isn't fetched for every request
+        error_ttl: seconds to remember that a host's robots.txt could not be
+         fetched at all (e.g. connection refused) before trying again
+
+        """
+
+        def __init__(self, max_hosts=1000, ttl=24*60*60, min_ttl=60,
+                     error_ttl=5*60):
+            self.ttl = ttl
+            self.min_ttl = min_ttl
+            self.error_ttl = error_ttl
+            self._time = time.time
+            self._lock = _threading.Lock()
+            # (scheme, host) --> [parser, expiry time, time of next request
+            # allowed by crawl delay]
+            self._rules = LRUCache(max_hosts)
+
+        def get(self, scheme, host):
+            """Return unexpired parser for host, or None."""
+            key = scheme, host
+            self._lock.acquire()
+            try:
+                rfp, expires = self._rules.get(key, (None, None, None))[:2]
+                if rfp is not None and expires <= self._time():
+                    self._rules.pop(key)
+                    rfp = None
+                return rfp
+            finally:
+                self._lock.release()
+
+        def add(self, scheme, host, rfp):
+            if getattr(rfp, "fetch_failed", False):
+                ttl = self.error_ttl
+            else:
+                ttl = getattr(rfp, "lifetime", None)
+                if ttl is None:
+                    ttl = self.ttl
+                ttl = min(self.ttl, max(self.min_ttl, ttl))
+            self._lock.acquire()
+            try:
+                self._rules[(scheme, host)] = [rfp, self._time() + ttl, 0]
+            finally:
+                self._lock.release()
+
+        def reserve(self, scheme, host, interval):
+            """Book the next request to host, interval seconds after the last.
+
+            Returns the number of seconds to wait before making the request.
+
+            """
+            self._lock.acquire()
+            try:
+                entry = self._rules.get((scheme, host))
+                if entry is None:
+                    return 0
+                now = self._time()
+                start = max(now, entry[2])
+                entry[2] = start + interval
+                return start - now
+            finally:
+                self._lock.release()
+
+        def clear(self):
+            self._lock.acquire()
+            try:
+                self._rules.clear()
+            finally:
+                self._lock.release()
+
+        def __len__(self):
+            return len(self._rules)
+
     class RobotExclusionError(urllib2.HTTPError):
         def __init__(self, request, *args):
             apply(urllib2.HTTPError.__init__, (self,)+args)
@@ -421,11 +861,40 @@ else:
         else:
             http_response_class = HTTPMessage
 
-        def __init__(self, rfp_class=MechanizeRobotFileParser):
+        def __init__(self, rfp_class=MechanizeRobotFileParser, cache=None,
+                     honor_crawl_delay=False, max_crawl_delay=60,
+                     longest_match=False):
+            # If honor_crawl_delay is true, requests to a host are spaced out
+            # as asked by its robots.txt Crawl-delay or Request-rate (but by
+            # no more than max_crawl_delay seconds), across all processors
+            # that share the same RobotRulesCache.  If longest_match is true,
+            # rules are applied as RFC 9309 says (see RobotRuleGroup), which
+            # needs an rfp_class whose .can_fetch() supports that.
             self.rfp_class = rfp_class
+            if cache is None:
+                cache = RobotRulesCache()
+            self.cache = cache
+            self.honor_crawl_delay = honor_crawl_delay
+            self.max_crawl_delay = max_crawl_delay
+            self.longest_match = longest_match
+            self._sleep = time.sleep
+            # parser and host for the most recent request (kept for
+            # backwards compatibility: rules now come from .cache)
             self.rfp = None
             self._host = None
 
+        def _make_rfp(self, request, scheme, host):
+            rfp = self.rfp_class()
+            try:
+                rfp.set_opener(self.parent)
+            except AttributeError:
+                debug("%r instance does not support set_opener" %
+                      rfp.__class__)
+            rfp.set_url(scheme+"://"+host+"/robots.txt")
+            rfp.set_timeout(request.timeout)
+            rfp.read()
+            return rfp
+
         def http_request(self, request):
             scheme = request.get_type()
             if scheme not in ["http", "https"]:
@@ -446,20 +915,21 @@ else:
                 ):
                 return request
 
-            if host != self._host:
-                self.rfp = self.rfp_class()
-                try:
-                    self.rfp.set_opener(self.parent)
-                except AttributeError:
-                    debug("%r instance does not support set_opener" %
-                          self.rfp.__class__)
-                self.rfp.set_url(scheme+"://"+host+"/robots.txt")
-                self.rfp.set_timeout(request.timeout)
-                self.rfp.read()
-                self._host = host
+            rfp = self.cache.get(scheme, host)
+            if rfp is None:
+                rfp = self._make_rfp(request, scheme, host)
+                self.cache.add(scheme, host, rfp)
+            self.rfp, self._host = rfp, host
 
             ua = request.get_header("User-agent", "")
-            if self.rfp.can_fetch(ua, request.get_full_url()):
+            if self.longest_match:
+                allowed = rfp.can_fetch(ua, request.get_full_url(),
+                                        longest_match=True)
+            else:
+                allowed = rfp.can_fetch(ua, request.get_full_url())
+            if allowed:
+                if self.honor_crawl_delay:
+                    self._wait_for_crawl_delay(rfp, ua, scheme, host)
                 return request
             else:
                 # XXX This should really have raised URLError.  Too late now...
@@ -470,6 +940,21 @@ else:
                     403, msg,
                     self.http_response_class(StringIO()), StringIO(msg))
 
+        def _wait_for_crawl_delay(self, rfp, ua, scheme, host):
+            try:
+                interval = rfp.crawl_interval(ua)
+            except AttributeError:
+                return
+            if not interval:
+                return
+            if self.max_crawl_delay is not None:
+                interval = min(interval, self.max_crawl_delay)
+            wait = self.cache.reserve(scheme, host, interval)
+            if wait > 0:
+                debug_robots("waiting %.3gs for crawl delay of %s" %
+                             (wait, host))
+                self._sleep(wait)
+
         https_request = http_request
 
 class HTTPRefererProcessor(BaseHandler):
@@ -637,10 +1122,20 @@ class AbstractHTTPHandler(BaseHandler):
 
     def __init__(self, debuglevel=0):
         self._debuglevel = debuglevel
+        self._connection_cache = None
 
     def set_http_debuglevel(self, level):
         self._debuglevel = level
 
+    def set_connection_cache(self, conn_cache):
+        """Set a mechanize.ConnectionCache, or None to disable keep-alive."""
+        self._connection_cache = conn_cache
+
+    def _connection_key(self, http_class, req):
+        return (req.get_type(), req.get_host(),
+                getattr(req, "_tunnel_host", None),
+                getattr(http_class, "connection_key", None))
+
     def do_request_(self, request):
         host = request.get_host()
         if not host:
@@ -681,29 +1176,40 @@ class AbstractHTTPHandler(BaseHandler):
         if not host_port:
             raise URLError('no host given')
 
-        try:
-            h = http_class(host_port, timeout=req.timeout)
-        except TypeError:
-            # Python < 2.6, no per-connection timeout support
-            h = http_class(host_port)
-        h.set_debuglevel(self._debuglevel)
+        def make_connection():
+            try:
+                h = http_class(host_port, timeout=req.timeout)
+            except TypeError:
+                # Python < 2.6, no per-connection timeout support
+                h = http_class(host_port)
+            h.set_debuglevel(self._debuglevel)
+            return h
 
         headers = dict(req.headers)
         headers.update(req.unredirected_hdrs)
-        # We want to make an HTTP/1.1 request, but the addinfourl
-        # class isn't prepared to deal with a persistent connection.
-        # It will try to read all remaining data from the socket,
-        # which will block while the server waits for the next request.
-        # So make sure the connection gets closed after the (only)
-        # request.
-        headers["Connection"] = "close"
+        cache = self._connection_cache
+        if cache is None:
+            # We want to make an HTTP/1.1 request, but the addinfourl
+            # class isn't prepared to deal with a persistent connection.
+            # It will try to read all remaining data from the socket,
+            # which will block while the server waits for the next request.
+            # So make sure the connection gets closed after the (only)
+            # request.
+            headers["Connection"] = "close"
         headers = dict(
             [(name.title(), val) for name, val in headers.items()])
-        try:
-            h.request(req.get_method(), req.get_selector(), req.data, headers)
-            r = h.getresponse()
-        except socket.error, err: # XXX what error?
-            raise URLError(err)
+
+        if cache is None:
+            h = make_connection()
+            try:
+                h.request(req.get_method(), req.get_selector(), req.data,
+                          headers)
+                r = h.getresponse()
+            except socket.error, err: # XXX what error?
+                raise URLError(err)
+        else:
+            r = self._cached_request(cache, http_class, req, headers,
+                                     make_connection)
 
         # Pick apart the HTTPResponse object to get the addinfourl
         # object initialized properly.
@@ -716,13 +1222,55 @@ class AbstractHTTPHandler(BaseHandler):
         # XXX It might be better to extract the read buffering code
         # out of socket._fileobject() and into a base class.
 
-        r.recv = r.read
+        if not hasattr(r, "recv"):
+            r.recv = r.read
         fp = create_readline_wrapper(r)
 
         resp = closeable_response(fp, r.msg, req.get_full_url(),
                                   r.status, r.reason)
         return resp
 
+    def _cached_request(self, cache, http_class, req, headers,
+                        make_connection):
+        key = self._connection_key(http_class, req)
+        retry = (not req.has_data() and
+                 req.get_method() in _conncache.IDEMPOTENT_METHODS)
+        while True:
+            h, reused = cache.get_connection(key, make_connection)
+            try:
+                if reused:
+                    # the connection was made with an earlier request's
+                    # timeout
+                    _conncache.set_timeout(h, req.timeout)
+                h.request(req.get_method(), req.get_selector(), req.data,
+                          headers)
+                r = h.getresponse()
+            except (socket.error, httplib.HTTPException), err:
+                cache.release(key, h, False)
+                if reused and retry:
+                    # the server probably timed out the idle connection
+                    # between our staleness check and the request: retry
+                    # once on a fresh connection (only if it's safe to send
+                    # the request twice)
+                    debug("retrying on new connection after error: %s" % err)
+                    continue
+                if isinstance(err, socket.error):
+                    raise URLError(err)
+                raise
+            break
+
+        if r.will_close:
+            # httplib has already closed the connection's socket (but not the
+            # response's file object)
+            cache.release(key, h, False)
+            return r
+        if r.length == 0:
+            # e.g. HEAD, 204, 304: no body to wait for
+            r.close()
+            cache.release(key, h)
+            return r
+        return _conncache.connection_releasing_response(r, cache, key, h)
+
 
 class HTTPHandler(AbstractHTTPHandler):
     def http_open(self, req):
@@ -736,6 +1284,7 @@ if hasattr(httplib, 'HTTPS'):
         def __init__(self, key_file, cert_file):
             self._key_file = key_file
             self._cert_file = cert_file
+            self.connection_key = (key_file, cert_file)
         def __call__(self, hostport):
             return httplib.HTTPSConnection(
                 hostport,
@@ -0,0 +1,632 @@
+"""HTTP response cache: a handler plus in-memory, directory and SQLite storage.
+
+A cache is enabled by adding an HTTPCacheHandler to an opener, or by calling
+UserAgentBase.set_http_cache() with one of the storage classes here.  This is
+a private cache (in the sense of RFC 2616 section 13): it is for one user
+agent (or a few that trust each other), not a shared proxy cache.
+
+"""
+
+import os, tempfile, time, urllib2
+try:
+    import threading as _threading
+except ImportError:
+    import dummy_threading as _threading
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import hashlib
+except ImportError:
+    import sha
+    def sha1_digest(bytes):
+        return sha.new(bytes).hexdigest()
+else:
+    def sha1_digest(bytes):
+        return hashlib.sha1(bytes).hexdigest()
+from cStringIO import StringIO
+import mimetools
+
+import _response
+from _util import http2time
+
+# status codes cacheable by default (RFC 2616 section 13.4)
+CACHEABLE_CODES = [200, 203, 300, 301, 410]
+
+# headers that describe the connection rather than the stored entity, so
+# aren't taken from a 304 response when updating a stored one
+HOP_BY_HOP = ["connection", "keep-alive", "proxy-authenticate",
+              "proxy-authorization", "te", "trailers", "transfer-encoding",
+              "upgrade", "content-length"]
+
+# headers never stored in or served from the cache
+NOT_STORED = ["set-cookie", "set-cookie2"]
+
+# freshness lifetime given to responses with a Last-Modified header but no
+# explicit expiry is this fraction of the time since modification...
+HEURISTIC_FRACTION = 0.1
+# ...but no more than this many seconds
+MAX_HEURISTIC_LIFETIME = 24*60*60
+
+
+def parse_cache_control(values):
+    """Return a dict mapping lower-cased Cache-Control directives to values.
+
+    Directives without an argument map to None.
+
+    >>> cc = parse_cache_control(['max-age=60, no-cache', 'private="a, b"'])
+    >>> sorted(cc.items())
+    [('max-age', '60'), ('no-cache', None), ('private', 'a, b')]
+
+    """
+    directives = {}
+    for value in values:
+        for directive in urllib2.parse_http_list(value):
+            parts = directive.split("=", 1)
+            name = parts[0].strip().lower()
+            if not name:
+                continue
+            if len(parts) == 2:
+                arg = parts[1].strip()
+                if arg.startswith('"') and arg.endswith('"'):
+                    arg = arg[1:-1]
+                directives[name] = arg
+            else:
+                directives[name] = None
+    return directives
+
+
+def header_name(line):
+    return line.split(":", 1)[0].strip().lower()
+
+
+class CacheEntry:
+    """A response stored in the cache.
+
+    Public attributes:
+
+    url: URL of the response
+    code: HTTP status code
+    msg: HTTP status message
+    header_lines: list of response header lines, including line endings
+    body: response body (not content-decoded)
+    request_time: time the request was sent
+    response_time: time the response was received
+    vary: dict mapping request header names named in the response's Vary
+     header to the values they had in the request (None if absent)
+
+    """
+
+    def __init__(self, url, code, msg, header_lines, body,
+                 request_time, response_time, vary):
+        self.url = url
+        self.code = code
+        self.msg = msg
+        self.header_lines = header_lines
+        self.body = body
+        self.request_time = request_time
+        self.response_time = response_time
+        self.vary = vary
+
+    def headers(self):
+        return mimetools.Message(StringIO("".join(self.header_lines)))
+
+    def response(self):
+        return _response.closeable_response(
+            StringIO(self.body), self.headers(), self.url, self.code, self.msg)
+
+    def revalidated(self, header_lines, now):
+        """Return a new entry with headers updated from a 304 response.
+
+        The entry itself is left alone, since other threads may be using it.
+
+        """
+        replaced = {}
+        new_lines = []
+        for line in header_lines:
+            if line[:1] in " \t":
+                # continuation line
+                if new_lines:
+                    new_lines.append(line)
+                continue
+            name = header_name(line)
+            if name in HOP_BY_HOP or name in NOT_STORED:
+                continue
+            replaced[name] = None
+            new_lines.append(line)
+        kept = []
+        keeping = False
+        for line in self.header_lines:
+            if line[:1] in " \t":
+                if keeping:
+                    kept.append(line)
+                continue
+            keeping = header_name(line) not in replaced
+            if keeping:
+                kept.append(line)
+        return CacheEntry(self.url, self.code, self.msg, kept + new_lines,
+                          self.body, now, now, self.vary)
+
+    def current_age(self, now):
+        # RFC 2616 section 13.2.3
+        headers = self.headers()
+        apparent_age = 0
+        date = http2time(headers.get("Date", ""))
+        if date is not None:
+            apparent_age = max(0, self.response_time - date)
+        try:
+            age = int(headers.get("Age", "0"))
+        except ValueError:
+            age = 0
+        response_delay = self.response_time - self.request_time
+        initial_age = max(apparent_age, age) + response_delay
+        return initial_age + now - self.response_time
+
+    def freshness_lifetime(self):
+        # RFC 2616 section 13.2.4, plus the heuristic of section 13.2.2
+        # (not for URLs with a query: section 13.9)
+        headers = self.headers()
+        cc = parse_cache_control(headers.getheaders("Cache-Control"))
+        if "max-age" in cc:
+            try:
+                return int(cc["max-age"])
+            except (TypeError, ValueError):
+                return 0
+        date = http2time(headers.get("Date", ""))
+        if date is None:
+            date = self.response_time
+        if headers.get("Expires") is not None:
+            expires = http2time(headers["Expires"])
+            if expires is None:
+                # invalid dates, especially "0", mean "already expired"
+                return 0
+            return max(0, expires - date)
+        last_modified = http2time(headers.get("Last-Modified", ""))
+        if (last_modified is not None and self.code in CACHEABLE_CODES and
+            "?" not in self.url):
+            return min(MAX_HEURISTIC_LIFETIME,
+                       max(0, (date - last_modified) * HEURISTIC_FRACTION))
+        return 0
+
+    def is_fresh(self, now, max_age=None):
+        cc = parse_cache_control(self.headers().getheaders("Cache-Control"))
+        if "no-cache" in cc:
+            return False
+        age = self.current_age(now)
+        if max_age is not None and age > max_age:
+            return False
+        return age < self.freshness_lifetime()
+
+
+class MemoryResponseCache:
+    """Least-recently-used cache of responses in memory.
+
+    max_entries: maximum number of responses kept
+    max_bytes: maximum total size of kept response bodies, or None
+
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = _threading.Lock()
+        # key --> [previous node, next node, key, entry], in a circular
+        # doubly-linked list whose root is ._root; most recently used last
+        self._map = {}
+        self._root = root = []
+        root[:] = [root, root, None, None]
+        self._nr_bytes = 0
+
+    def _unlink(self, node):
+        prev_node, next_node = node[0], node[1]
+        prev_node[1] = next_node
+        next_node[0] = prev_node
+
+    def _append(self, node):
+        root = self._root
+        last = root[0]
+        node[0] = last
+        node[1] = root
+        last[1] = root[0] = node
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            node = self._map.get(key)
+            if node is None:
+                return None
+            self._unlink(node)
+            self._append(node)
+            return node[3]
+        finally:
+            self._lock.release()
+
+    def set(self, key, entry):
+        self._lock.acquire()
+        try:
+            self._delete(key)
+            node = [None, None, key, entry]
+            self._append(node)
+            self._map[key] = node
+            self._nr_bytes += len(entry.body)
+            while (len(self._map) > self.max_entries or
+                   (self.max_bytes is not None and
+                    self._nr_bytes > self.max_bytes)):
+                self._delete(self._root[1][2])
+        finally:
+            self._lock.release()
+
+    def _delete(self, key):
+        node = self._map.pop(key, None)
+        if node is not None:
+            self._unlink(node)
+            self._nr_bytes -= len(node[3].body)
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._delete(key)
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._map)
+
+
+class DirectoryResponseCache:
+    """Cache of responses stored as files in a directory.
+
+    There's no size limit: remove files from the directory to reclaim space
+    (it's safe to do that at any time).
+
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _filename(self, key):
+        return os.path.join(self.directory, sha1_digest(key))
+
+    def get(self, key):
+        try:
+            fh = open(self._filename(key), "rb")
+        except IOError:
+            return None
+        try:
+            try:
+                stored_key, entry = pickle.load(fh)
+            except (EOFError, ValueError, TypeError, pickle.UnpicklingError):
+                return None
+        finally:
+            fh.close()
+        if stored_key != key:
+            return None
+        return entry
+
+    def set(self, key, entry):
+        # write to a temporary file, then rename, so that readers never see
+        # a partly-written file
+        fd, temp_filename = tempfile.mkstemp(dir=self.directory)
+        fh = os.fdopen(fd, "wb")
+        try:
+            try:
+                pickle.dump((key, entry), fh, pickle.HIGHEST_PROTOCOL)
+            finally:
+                fh.close()
+            filename = self._filename(key)
+            try:
+                os.rename(temp_filename, filename)
+            except OSError:
+                # Windows won't rename over an existing file
+                self._remove(filename)
+                os.rename(temp_filename, filename)
+        except:
+            self._remove(temp_filename)
+            raise
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def delete(self, key):
+        self._remove(self._filename(key))
+
+
+class SQLiteResponseCache:
+    """Cache of responses stored in an SQLite database file.
+
+    The database may be shared between threads and processes.
+
+    """
+
+    def __init__(self, filename):
+        import sqlite3
+        self._sqlite3 = sqlite3
+        self.filename = filename
+        self._lock = _threading.Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.execute("""\
+CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, entry BLOB)""")
+        self._conn.commit()
+
+    def _execute(self, query, params):
+        self._lock.acquire()
+        try:
+            try:
+                rows = self._conn.execute(query, params).fetchall()
+            except:
+                self._conn.rollback()
+                raise
+            self._conn.commit()
+            return rows
+        finally:
+            self._lock.release()
+
+    def get(self, key):
+        rows = self._execute("SELECT entry FROM responses WHERE key = ?",
+                             (key,))
+        if not rows:
+            return None
+        return pickle.loads(str(rows[0][0]))
+
+    def set(self, key, entry):
+        data = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        self._execute(
+            "INSERT OR REPLACE INTO responses (key, entry) VALUES (?, ?)",
+            (key, self._sqlite3.Binary(data)))
+
+    def delete(self, key):
+        self._execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def close(self):
+        self._conn.close()
+
+
+class caching_reader:
+    """Reads a response body, storing it in the cache once it's all read.
+
+    If the body turns out to be bigger than max_size bytes, or the response
+    is closed before the end is reached, nothing is stored.
+
+    """
+
+    def __init__(self, fp, store, max_size):
+        self._fp = fp
+        self._store = store
+        self._max_size = max_size
+        self._chunks = []
+        self._size = 0
+
+    def _got(self, data, eof):
+        if self._chunks is None:
+            return
+        if data:
+            self._chunks.append(data)
+            self._size += len(data)
+            if self._max_size is not None and self._size > self._max_size:
+                self._chunks = None
+                return
+        if eof:
+            body = "".join(self._chunks)
+            self._chunks = None
+            self._store(body)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._fp.read()
+            self._got(data, True)
+        else:
+            data = self._fp.read(size)
+            self._got(data, size > 0 and not data)
+        return data
+
+    def readline(self, size=-1):
+        line = self._fp.readline(size)
+        self._got(line, not line)
+        return line
+
+    def readlines(self, sizehint=-1):
+        lines = []
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            lines.append(line)
+        return lines
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration()
+        return line
+
+    def close(self):
+        self._chunks = None
+        self._fp.close()
+
+
+class HTTPCacheHandler(urllib2.BaseHandler):
+    """Serve responses from a cache where RFC 2616 allows it.
+
+    Fresh cached responses are returned without any network access.  Stale
+    ones with an ETag or Last-Modified header are revalidated with
+    If-None-Match / If-Modified-Since; a 304 (Not Modified) response is
+    turned back into the full stored response.  Unsafe requests (those with
+    data) invalidate the stored response for their URL.
+
+    cache: storage object with .get(key), .set(key, entry) and .delete(key)
+     methods, e.g. MemoryResponseCache, DirectoryResponseCache or
+     SQLiteResponseCache
+    max_body_size: responses with bigger bodies than this aren't stored
+
+    Public attributes:
+
+    hits: number of responses served from the cache without network access
+    revalidated: number of responses served from the cache after a 304
+    misses: number of full responses fetched from the network for requests
+     that could have been served from the cache
+
+    Set-Cookie headers are never stored.  Note that the stored body is the
+    body as sent over the network (e.g. gzip-compressed), which is why this
+    handler processes responses before HTTPGzipProcessor does.
+
+    """
+    handler_order = 150  # before HTTPGzipProcessor, after ProxyHandler
+
+    def __init__(self, cache, max_body_size=10*1024*1024):
+        self.cache = cache
+        self.max_body_size = max_body_size
+        self.hits = self.revalidated = self.misses = 0
+        self._stats_lock = _threading.Lock()
+        self._time = time.time
+
+    def _count(self, name):
+        self._stats_lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+        finally:
+            self._stats_lock.release()
+
+    def _key(self, request):
+        return request.get_full_url().split("#", 1)[0]
+
+    def _vary_matches(self, entry, request):
+        for name, value in entry.vary.iteritems():
+            if request.get_header(name) != value:
+                return False
+        return True
+
+    def http_open(self, request):
+        # Runs after all request processors, so the request has all its
+        # headers (which matters for Vary).  Returning None passes the
+        # request on to the next handler (i.e. HTTPHandler).
+        request._http_cache_state = None
+        key = self._key(request)
+        if request.get_method() != "GET":
+            if request.has_data():
+                self.cache.delete(key)
+            return None
+
+        request_cc = parse_cache_control(
+            [request.get_header("Cache-control", "")])
+        if ("no-cache" in request_cc or "no-store" in request_cc or
+            "no-cache" in request.get_header("Pragma", "").lower()):
+            return None
+        entry = self.cache.get(key)
+        if entry is None or not self._vary_matches(entry, request):
+            request._http_cache_state = key, None, False
+            return None
+
+        max_age = request_cc.get("max-age")
+        if max_age is not None:
+            try:
+                max_age = int(max_age)
+            except ValueError:
+                max_age = None
+        now = self._time()
+        if entry.is_fresh(now, max_age):
+            request._http_cache_state = key, entry, True
+            self._count("hits")
+            return entry.response()
+
+        # stale: revalidate if possible, unless the caller is making their
+        # own conditional request
+        if (request.has_header("If-none-match") or
+            request.has_header("If-modified-since")):
+            return None
+        headers = entry.headers()
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if etag is not None:
+            request.add_unredirected_header("If-None-Match", etag)
+        if last_modified is not None:
+            request.add_unredirected_header("If-Modified-Since",
+                                            last_modified)
+        if etag is not None or last_modified is not None:
+            request._http_cache_state = key, entry, False
+        else:
+            request._http_cache_state = key, None, False
+        return None
+
+    def http_response(self, request, response):
+        state = getattr(request, "_http_cache_state", None)
+        if state is None:
+            return response
+        key, entry, served = state
+        if served:
+            # we served this from the cache
+            return response
+
+        now = self._time()
+        if entry is not None and response.code == 304:
+            entry = entry.revalidated(response.info().headers, now)
+            response.close()
+            self.cache.set(key, entry)
+            self._count("revalidated")
+            return entry.response()
+
+        self._count("misses")
+        return self._maybe_store(key, request, response, now)
+
+    def _maybe_store(self, key, request, response, now):
+        if response.code not in CACHEABLE_CODES:
+            return response
+        headers = response.info()
+        cc = parse_cache_control(headers.getheaders("Cache-Control"))
+        request_cc = parse_cache_control(
+            [request.get_header("Cache-control", "")])
+        if "no-store" in cc or "no-store" in request_cc:
+            return response
+
+        vary = {}
+        for value in headers.getheaders("Vary"):
+            for name in value.split(","):
+                name = name.strip().capitalize()
+                if name == "*":
+                    return response
+                if name:
+                    vary[name] = request.get_header(name)
+
+        header_lines = []
+        keeping = True
+        for line in headers.headers:
+            if line[:1] in " \t":
+                if keeping:
+                    header_lines.append(line)
+                continue
+            keeping = header_name(line) not in NOT_STORED
+            if keeping:
+                header_lines.append(line)
+        entry = CacheEntry(response.geturl(), response.code, response.msg,
+                           header_lines, None, now, now, vary)
+        if (entry.freshness_lifetime() <= 0 and
+            headers.get("ETag") is None and
+            headers.get("Last-Modified") is None):
+            # would never be used
+            return response
+
+        length = headers.get("Content-Length")
+        if length is not None:
+            try:
+                if int(length) > self.max_body_size:
+                    return response
+            except ValueError:
+                pass
+        def store(body):
+            entry.body = body
+            self.cache.set(key, entry)
+        reader = caching_reader(response, store, self.max_body_size)
+        new_response = _response.closeable_response(
+            reader, headers, response.geturl(), response.code, response.msg)
+        return new_response
+
+    https_open = http_open
+    https_response = http_response
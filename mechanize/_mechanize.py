@@ -39,27 +39,91 @@ class History:
 
     Though this will become public, the implied interface is not yet stable.
 
+    Constructor arguments / public attributes:
+
+    max_entries: maximum number of (request, response) pairs kept; older
+     ones are discarded (so .back() can't go back further than this), or
+     None for no limit
+    max_bytes: maximum number of bytes of response data the history keeps
+     in memory, or None for no limit.  Beyond this, the data of the oldest
+     responses is evicted
+    spool: if true, evicted response data is moved to temporary files, from
+     which .back() reads it back; otherwise, it's discarded, and .back()
+     fetches the page again (as it does already for responses that were not
+     read to the end)
+
     """
-    def __init__(self):
+    def __init__(self, max_entries=None, max_bytes=None, spool=False):
         self._history = []  # LIFO
+        # in-memory data size of each entry's response as counted when it was
+        # added (0 once evicted), their total, and the index of the oldest
+        # entry that may still be counted
+        self._sizes = []
+        self._nr_bytes = 0
+        self._first = 0
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.spool = spool
     def add(self, request, response):
+        try:
+            size = response.memory_size()
+        except AttributeError:
+            # None, or not a seek_wrapper
+            size = 0
         self._history.append((request, response))
+        self._sizes.append(size)
+        self._nr_bytes += size
+        self._trim()
+    def _pop(self, index):
+        request, response = self._history.pop(index)
+        self._nr_bytes -= self._sizes.pop(index)
+        if index == 0:
+            self._first = max(self._first - 1, 0)
+        else:
+            self._first = min(self._first, len(self._history))
+        return request, response
+    def _trim(self):
+        # Responses are never closed here: copies of a response share its
+        # state, so closing would also close any copy the caller holds.
+        # Dropping the reference frees the data once nobody else uses it.
+        if self.max_entries is not None:
+            while len(self._history) > self.max_entries:
+                self._pop(0)
+        if self.max_bytes is None:
+            return
+        # evict the data of the oldest responses first
+        history, sizes = self._history, self._sizes
+        while self._nr_bytes > self.max_bytes:
+            ii = self._first
+            self._first += 1
+            size = sizes[ii]
+            if not size:
+                continue
+            request, response = history[ii]
+            if self.spool:
+                response.spool()
+            else:
+                history[ii] = request, _response.evicted_response(response)
+            sizes[ii] = 0
+            self._nr_bytes -= size
     def back(self, n, _response):
         response = _response  # XXX move Browser._response into this class?
         while n > 0 or response is None:
             try:
-                request, response = self._history.pop()
+                request, response = self._pop(-1)
             except IndexError:
                 raise BrowserStateError("already at start of history")
             n -= 1
         return request, response
     def clear(self):
         del self._history[:]
+        del self._sizes[:]
+        self._nr_bytes = self._first = 0
     def close(self):
         for request, response in self._history:
             if response is not None:
                 response.close()
-        del self._history[:]
+        self.clear()
 
 
 class HTTPRefererProcessor(urllib2.BaseHandler):
@@ -208,6 +272,10 @@ class Browser(UserAgentBase):
              timeout=_sockettimeout._GLOBAL_DEFAULT_TIMEOUT):
         return self._mech_open(url, data, timeout=timeout)
 
+    def _open_one_of_many(self, request, timeout):
+        # browser state is not thread-safe, so .open_many() doesn't visit
+        return self.open_novisit(request, timeout=timeout)
+
     def _mech_open(self, url, data=None, update_history=True, visit=None,
                    timeout=_sockettimeout._GLOBAL_DEFAULT_TIMEOUT):
         try:
@@ -357,8 +425,10 @@ class Browser(UserAgentBase):
         if self._response is not None:
             self._response.close()
         self.request, response = self._history.back(n, self._response)
+        # .set_response() may read the start of the body
+        read_complete = response.read_complete
         self.set_response(response)
-        if not response.read_complete:
+        if not read_complete:
             return self.reload()
         return copy.copy(response)
 
@@ -409,11 +479,10 @@ class Browser(UserAgentBase):
         """Return iterable over links (mechanize.Link objects)."""
         if not self.viewing_html():
             raise BrowserStateError("not viewing HTML")
-        links = self._factory.links()
         if kwds:
-            return self._filter_links(links, **kwds)
+            return self._filter_links(**kwds)
         else:
-            return links
+            return self._factory.links()
 
     def forms(self):
         """Return iterable over forms.
@@ -621,7 +690,7 @@ class Browser(UserAgentBase):
 
         """
         try:
-            return self._filter_links(self._factory.links(), **kwds).next()
+            return self._filter_links(**kwds).next()
         except StopIteration:
             raise LinkNotFoundError()
 
@@ -634,7 +703,7 @@ class Browser(UserAgentBase):
                 ".select_form()?)" % (self.__class__, name))
         return getattr(form, name)
 
-    def _filter_links(self, links,
+    def _filter_links(self,
                     text=None, text_regex=None,
                     name=None, name_regex=None,
                     url=None, url_regex=None,
@@ -645,27 +714,36 @@ class Browser(UserAgentBase):
         if not self.viewing_html():
             raise BrowserStateError("not viewing HTML")
 
-        found_links = []
+        if text_regex is not None:
+            text_regex = re.compile(text_regex)
+        if name_regex is not None:
+            name_regex = re.compile(name_regex)
+        if url_regex is not None:
+            url_regex = re.compile(url_regex)
+        # the factory may use these to avoid work on links that can't match
+        links = self._factory.links(tag=tag, url=url, url_regex=url_regex)
+
         orig_nr = nr
 
         for link in links:
+            if tag is not None and tag != link.tag:
+                continue
             if url is not None and url != link.url:
                 continue
-            if url_regex is not None and not re.search(url_regex, link.url):
+            if url_regex is not None and not url_regex.search(link.url):
                 continue
+            if name is not None or name_regex is not None:
+                link_name = dict(link.attrs).get("name")
+                if name is not None and name != link_name:
+                    continue
+                if name_regex is not None and (
+                    link_name is None or not name_regex.search(link_name)):
+                    continue
             if (text is not None and
                 (link.text is None or text != link.text)):
                 continue
             if (text_regex is not None and
-                (link.text is None or not re.search(text_regex, link.text))):
-                continue
-            if name is not None and name != dict(link.attrs).get("name"):
-                continue
-            if name_regex is not None:
-                link_name = dict(link.attrs).get("name")
-                if link_name is None or not re.search(name_regex, link_name):
-                    continue
-            if tag is not None and tag != link.tag:
+                (link.text is None or not text_regex.search(link.text))):
                 continue
             if predicate is not None and not predicate(link):
                 continue
@@ -321,9 +321,9 @@ class MSIECookieJar(MSIEBase, FileCookieJar):
 
     Iterating over a delayloaded MSIECookieJar instance will not cause any
     cookies to be read from disk.  To force reading of all cookies from disk,
-    call read_all_cookies.  Note that the following methods iterate over self:
-    clear_temporary_cookies, clear_expired_cookies, __len__, __repr__, __str__
-    and as_string.
+    call read_all_cookies.  Note that the following methods only see cookies
+    that have already been read: clear_temporary_cookies,
+    clear_expired_cookies, __len__, __repr__, __str__ and as_string.
 
     Additional methods:
 
@@ -346,7 +346,7 @@ class MSIECookieJar(MSIEBase, FileCookieJar):
         """Return a list of cookies to be returned to server."""
         domains = self._cookies.copy()
         domains.update(self._delayload_domains)
-        domains = domains.keys()
+        domains = self._domains_for_request(domains, request)
 
         cookies = []
         for domain in domains:
@@ -9,7 +9,7 @@ COPYING.txt included with the distribution).
 
 """
 
-import os, urllib2, bisect, httplib, types, tempfile
+import os, re, socket, urllib2, bisect, httplib, types, tempfile
 try:
     import threading as _threading
 except ImportError:
@@ -27,7 +27,8 @@ import _response
 import _rfc3986
 import _sockettimeout
 import _upgrade
-from _util import isstringlike
+import _workerpool
+from _util import isstringlike, http2time
 
 
 class ContentTooShortError(urllib2.URLError):
@@ -36,6 +37,82 @@ class ContentTooShortError(urllib2.URLError):
         self.result = result
 
 
+class RangeNotHonouredError(urllib2.URLError):
+    # the server sent the whole body (or the wrong part) in response to a
+    # range request, usually because the resource has changed
+    pass
+
+
+# exceptions that mean a transfer may be worth resuming
+TRANSFER_ERRORS = (socket.error, IOError, httplib.HTTPException)
+
+# Last-Modified is only a strong validator if at least this many seconds
+# older than Date (RFC 7233, section 2.2 / RFC 7232, section 2.2.2)
+STRONG_LAST_MODIFIED_AGE = 60
+
+CONTENT_RANGE_RE = re.compile(r"\s*bytes\s+(\d+)-(\d+)/(\d+|\*)\s*$", re.I)
+
+def range_validator(req, headers):
+    """Return a value for an If-Range header for the response, or None.
+
+    None is returned if a range request can't safely be used to fetch the rest
+    of the response body.
+
+    """
+    encoding = headers.get("Content-encoding", "identity")
+    if req.has_data() or encoding.strip().lower() != "identity":
+        return None
+    etag = headers.get("ETag")
+    if etag is not None and not etag.startswith("W/"):
+        return etag
+    last_modified = headers.get("Last-modified")
+    if last_modified is not None:
+        modified = http2time(last_modified)
+        date = http2time(headers.get("Date", ""))
+        if (modified is not None and date is not None and
+            date - modified >= STRONG_LAST_MODIFIED_AGE):
+            return last_modified
+    return None
+
+
+class RetrieveProgress:
+    """Calls a .retrieve() reporthook, from one or more threads."""
+
+    def __init__(self, reporthook, block_size, size):
+        self._reporthook = reporthook
+        self.block_size = block_size
+        self.size = size
+        self.blocknum = 0
+        # set to ask transfers still running in other threads to stop
+        self.cancelled = False
+        self._lock = _threading.Lock()
+
+    def start(self):
+        if self._reporthook:
+            self._reporthook(0, self.block_size, self.size)
+
+    def block_done(self):
+        if not self._reporthook:
+            return
+        self._lock.acquire()
+        try:
+            self.blocknum += 1
+            self._reporthook(self.blocknum, self.block_size, self.size)
+        finally:
+            self._lock.release()
+
+
+def call_chain(methods, *args):
+    # Handlers raise an exception if no one else should try to handle the
+    # request, or return None if they can't but another handler could.
+    # Otherwise, they return the response.
+    for meth in methods:
+        result = apply(meth, args)
+        if result is not None:
+            return result
+    return None
+
+
 def set_request_attr(req, name, value, default):
     try:
         getattr(req, name)
@@ -54,6 +131,7 @@ class OpenerDirector(urllib2.OpenerDirector):
         self.process_request = {}
         self._any_request = {}
         self._any_response = {}
+        self._chains = {}
         self._handler_index_valid = True
         self._tempfiles = []
 
@@ -148,6 +226,51 @@ class OpenerDirector(urllib2.OpenerDirector):
         self.process_response = process_response
         self._any_request = any_request
         self._any_response = any_response
+        self._chains = {}
+        self._handler_index_valid = True
+
+    def _chain(self, phase, kind):
+        """Return a tuple of the bound handler methods to call, in order.
+
+        phase is "request", "open", "response" or "http_error".  kind is the
+        URL scheme, "default" or "unknown" for "open", and the status code or
+        "default" for "http_error".  Chains are built from the handler indexes
+        the first time they're needed, so that .open() doesn't have to look
+        up, sort and getattr() the handlers every time.
+
+        """
+        key = phase, kind
+        try:
+            return self._chains[key]
+        except KeyError:
+            pass
+
+        if phase == "request" or phase == "response":
+            if phase == "request":
+                handlers = set(self.process_request.get(kind, []))
+                handlers.update(self._any_request)
+            else:
+                handlers = set(self.process_response.get(kind, []))
+                handlers.update(self._any_response)
+            handlers = list(handlers)
+            handlers.sort()
+            meth_names = ["any_"+phase, kind+"_"+phase]
+        elif phase == "open":
+            handlers = self.handle_open.get(kind, [])
+            meth_names = [kind+"_open"]
+        else:
+            assert phase == "http_error"
+            handlers = self.handle_error["http"].get(kind, [])
+            meth_names = ["http_error_%s" % kind]
+
+        methods = []
+        for handler in handlers:
+            for meth_name in meth_names:
+                meth = getattr(handler, meth_name, None)
+                if meth:
+                    methods.append(meth)
+        chain = self._chains[key] = tuple(methods)
+        return chain
 
     def _request(self, url_or_req, data, visit,
                  timeout=_sockettimeout._GLOBAL_DEFAULT_TIMEOUT):
@@ -168,65 +291,82 @@ class OpenerDirector(urllib2.OpenerDirector):
              timeout=_sockettimeout._GLOBAL_DEFAULT_TIMEOUT):
         req = self._request(fullurl, data, None, timeout)
         req_scheme = req.get_type()
+        req = self.preprocess_request(req)
+        response = self._open(req, data)
+        return self.postprocess_response(req, response, req_scheme)
+
+    def _open(self, req, data=None):
+        # as urllib2.OpenerDirector._open(), but using ._chain()
+        self._maybe_reindex_handlers()
+        result = call_chain(self._chain("open", "default"), req)
+        if result:
+            return result
+
+        result = call_chain(self._chain("open", req.get_type()), req)
+        if result:
+            return result
+
+        return call_chain(self._chain("open", "unknown"), req)
+
+    # .open() is split into three stages -- processing the request, opening
+    # it (the only stage that does I/O, apart from anything handlers do
+    # themselves) and processing the response.  The first and last are
+    # public, so that code driving the I/O some other way (e.g. from an event
+    # loop) can still run requests and responses through the processors.
+
+    def preprocess_request(self, req):
+        """Run req through the request processors; return the result."""
+        req_scheme = req.get_type()
 
         self._maybe_reindex_handlers()
 
-        # pre-process request
         # XXX should we allow a Processor to change the URL scheme
         #   of the request?
-        request_processors = set(self.process_request.get(req_scheme, []))
-        request_processors.update(self._any_request)
-        request_processors = list(request_processors)
-        request_processors.sort()
-        for processor in request_processors:
-            for meth_name in ["any_request", req_scheme+"_request"]:
-                meth = getattr(processor, meth_name, None)
-                if meth:
-                    req = meth(req)
-
-        # In Python >= 2.4, .open() supports processors already, so we must
-        # call ._open() instead.
-        urlopen = getattr(urllib2.OpenerDirector, "_open",
-                          urllib2.OpenerDirector.open)
-        response = urlopen(self, req, data)
-
-        # post-process response
-        response_processors = set(self.process_response.get(req_scheme, []))
-        response_processors.update(self._any_response)
-        response_processors = list(response_processors)
-        response_processors.sort()
-        for processor in response_processors:
-            for meth_name in ["any_response", req_scheme+"_response"]:
-                meth = getattr(processor, meth_name, None)
-                if meth:
-                    response = meth(req, response)
+        for meth in self._chain("request", req_scheme):
+            req = meth(req)
+        return req
+
+    def postprocess_response(self, req, response, req_scheme=None):
+        """Run response through the response processors; return the result.
+
+        req must be the request returned by .preprocess_request().
+        req_scheme defaults to the scheme of req; pass the scheme of the
+        request as it was before processing and opening, in case a handler
+        (e.g. ProxyHandler) changed it.
+
+        """
+        if req_scheme is None:
+            req_scheme = req.get_type()
+
+        self._maybe_reindex_handlers()
+
+        for meth in self._chain("response", req_scheme):
+            response = meth(req, response)
 
         return response
 
     def error(self, proto, *args):
         if proto in ['http', 'https']:
             # XXX http[s] protocols are special-cased
-            dict = self.handle_error['http'] # https is not different than http
-            proto = args[2]  # YUCK!
-            meth_name = 'http_error_%s' % proto
-            http_err = 1
-            orig_args = args
-        else:
-            dict = self.handle_error
-            meth_name = proto + '_error'
-            http_err = 0
+            # https is not different than http
+            code = args[2]  # YUCK!
+            result = apply(call_chain, (self._chain("http_error", code),)+args)
+            if result:
+                return result
+            return apply(call_chain,
+                         (self._chain("http_error", "default"),)+args)
+
+        dict = self.handle_error
+        meth_name = proto + '_error'
         args = (dict, proto, meth_name) + args
-        result = apply(self._call_chain, args)
-        if result:
-            return result
-
-        if http_err:
-            args = (dict, 'default', 'http_error_default') + orig_args
-            return apply(self._call_chain, args)
+        return apply(self._call_chain, args)
 
     BLOCK_SIZE = 1024*8
+    # block size used by .retrieve() when there's no reporthook to report to
+    LARGE_BLOCK_SIZE = 1024*256
     def retrieve(self, fullurl, filename=None, reporthook=None, data=None,
-                 timeout=_sockettimeout._GLOBAL_DEFAULT_TIMEOUT):
+                 timeout=_sockettimeout._GLOBAL_DEFAULT_TIMEOUT,
+                 resume_attempts=3, segments=1):
         """Returns (filename, headers).
 
         For remote objects, the default filename will refer to a temporary
@@ -241,9 +381,30 @@ class OpenerDirector(urllib2.OpenerDirector):
         subclass).  The exception's .result attribute contains the (filename,
         headers) that would have been returned.
 
+        If the transfer of the response body fails part way through, and the
+        response had a strong ETag or Last-Modified header, the rest of the
+        body is fetched using a Range request with an If-Range header, up to
+        resume_attempts times.  If the server doesn't honour the Range
+        request (for example because the resource has changed), the whole
+        body is fetched again with an ordinary request.
+
+        If segments is greater than 1, and the server accepts byte ranges for
+        the URL, a large response body is fetched in that many parts in
+        parallel, each as a separate range request, and written into place in
+        the file.  In that case reporthook may be called from other threads
+        (but never more than one at a time).
+
+        Unless the request already has an Accept-Encoding header, the body is
+        requested with "Accept-Encoding: identity", and saved as it is sent,
+        without being decompressed.
+
         """
         req = self._request(fullurl, data, False, timeout)
         scheme = req.get_type()
+        if not req.has_header("Accept-encoding"):
+            # save the body exactly as sent (and keep Content-Length and
+            # byte ranges meaningful): HTTPGzipProcessor leaves these alone
+            req.add_header("Accept-encoding", "identity")
         fp = self.open(req)
         headers = fp.info()
         if filename is None and scheme == 'file':
@@ -261,25 +422,52 @@ class OpenerDirector(urllib2.OpenerDirector):
             tfp = os.fdopen(fd, 'wb')
 
         result = filename, headers
-        bs = self.BLOCK_SIZE
         size = -1
-        read = 0
-        blocknum = 0
         if reporthook:
+            bs = self.BLOCK_SIZE
             if "content-length" in headers:
                 size = int(headers["Content-Length"])
-            reporthook(blocknum, bs, size)
-        while 1:
-            block = fp.read(bs)
-            if block == "":
-                break
-            read += len(block)
-            tfp.write(block)
-            blocknum += 1
-            if reporthook:
-                reporthook(blocknum, bs, size)
-        fp.close()
-        tfp.close()
+        else:
+            bs = self.LARGE_BLOCK_SIZE
+        progress = RetrieveProgress(reporthook, bs, size)
+        progress.start()
+
+        validator = range_validator(req, headers)
+        length = None
+        if validator is not None and "content-length" in headers:
+            length = int(headers["Content-Length"])
+        try:
+            try:
+                if (segments > 1 and length is not None and
+                    length >= 2*self.LARGE_BLOCK_SIZE and
+                    getattr(fp, "code", None) == 200 and
+                    headers.get("Accept-ranges", "").lower() == "bytes"):
+                    nr_segments = min(segments,
+                                      length // self.LARGE_BLOCK_SIZE)
+                    read = self._retrieve_segments(
+                        req, fp, filename, tfp, length, validator,
+                        nr_segments, resume_attempts, progress)
+                    size = length
+                else:
+                    read = self._retrieve_range(
+                        req, fp, tfp, 0, length, validator, resume_attempts,
+                        progress)
+            except RangeNotHonouredError:
+                # start again from scratch, without range requests
+                tfp.seek(0)
+                tfp.truncate()
+                fp = self.open(req)
+                headers = fp.info()
+                result = filename, headers
+                size = -1
+                if reporthook and "content-length" in headers:
+                    size = int(headers["Content-Length"])
+                progress.size = size
+                progress.cancelled = False
+                read = self._retrieve_range(req, fp, tfp, 0, None, None, 0,
+                                            progress)
+        finally:
+            tfp.close()
         del fp
         del tfp
 
@@ -293,6 +481,116 @@ class OpenerDirector(urllib2.OpenerDirector):
 
         return result
 
+    def _retrieve_range(self, req, fp, tfp, start, end, validator, attempts,
+                        progress):
+        # Copy bytes start to end of the response body to tfp, and return the
+        # number of bytes copied.  fp is a response whose body data starts at
+        # start, or None to make a range request for it.  end is None for
+        # "up to the end of the body".  If validator is not None, broken
+        # transfers are resumed with range requests.
+        pos = start
+        while True:
+            if progress.cancelled:
+                if fp is not None:
+                    fp.close()
+                return pos - start
+            if fp is None:
+                try:
+                    fp = self._open_range(req, pos, end, validator)
+                except RangeNotHonouredError:
+                    # retrying won't help
+                    raise
+                except TRANSFER_ERRORS:
+                    if attempts < 1:
+                        raise
+                    attempts -= 1
+                    continue
+
+            block = ""
+            try:
+                while (end is None or pos < end) and not progress.cancelled:
+                    amount = progress.block_size
+                    if end is not None:
+                        amount = min(amount, end - pos)
+                    try:
+                        # the data is only read once, so don't let any
+                        # seek_wrapper cache it
+                        block = _response.read_uncached(fp, amount)
+                    except TRANSFER_ERRORS:
+                        if validator is None or attempts < 1:
+                            raise
+                        block = None
+                        break
+                    if block == "":
+                        break
+                    tfp.write(block)
+                    pos += len(block)
+                    progress.block_done()
+            finally:
+                fp.close()
+            fp = None
+
+            failed = block is None or (end is not None and pos < end)
+            if (not failed or validator is None or attempts < 1 or
+                progress.cancelled):
+                return pos - start
+            attempts -= 1
+
+    def _open_range(self, req, start, end, validator):
+        if end is None:
+            byte_range = "bytes=%d-" % start
+        else:
+            byte_range = "bytes=%d-%d" % (start, end-1)
+        range_req = Request(req.get_full_url(), headers=req.headers,
+                            visit=False, timeout=req.timeout)
+        range_req.add_header("Range", byte_range)
+        range_req.add_header("If-range", validator)
+        # byte offsets into a decoded body are no use
+        range_req.add_header("Accept-encoding", "identity")
+        fp = self.open(range_req)
+        content_range = fp.info().get("Content-range", "")
+        match = CONTENT_RANGE_RE.match(content_range)
+        if (getattr(fp, "code", None) != 206 or match is None or
+            int(match.group(1)) != start):
+            fp.close()
+            raise RangeNotHonouredError(
+                "range request for %s not honoured" % req.get_full_url())
+        return fp
+
+    def _retrieve_segments(self, req, fp, filename, tfp, length, validator,
+                           nr_segments, attempts, progress):
+        segment_size = -(-length // nr_segments)
+        ranges = []
+        for start in range(0, length, segment_size):
+            ranges.append((start, min(start+segment_size, length)))
+
+        def fetch(byte_range):
+            start, end = byte_range
+            fh = open(filename, "r+b")
+            try:
+                fh.seek(start)
+                return self._retrieve_range(req, None, fh, start, end,
+                                            validator, attempts, progress)
+            finally:
+                fh.close()
+
+        pool = _workerpool.WorkerPool(fetch, ranges[1:], len(ranges)-1)
+        try:
+            # meanwhile, read the first segment from the response we have
+            read = self._retrieve_range(req, fp, tfp, 0, ranges[0][1],
+                                        validator, attempts, progress)
+            for byte_range, nr_read, error in pool:
+                if error is not None:
+                    raise error
+                read += nr_read
+        finally:
+            # stop the other segments and wait for them, so that nothing
+            # is still writing to the file when we return or re-raise
+            progress.cancelled = True
+            pool.close()
+            pool.join()
+        return read
+
     def close(self):
         urllib2.OpenerDirector.close(self)
 
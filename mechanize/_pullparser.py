@@ -33,8 +33,9 @@ under the terms of the BSD or ZPL 2.1 licenses.
 
 """
 
-import re, htmlentitydefs
+import re, htmlentitydefs, string
 import sgmllib, HTMLParser
+from collections import deque
 from xml.sax import saxutils
 
 from _html import unescape, unescape_charref
@@ -42,7 +43,7 @@ from _html import unescape, unescape_charref
 
 class NoMoreTokensError(Exception): pass
 
-class Token:
+class Token(object):
     """Represents an HTML tag, declaration, processing instruction etc.
 
     Behaves as both a tuple-like object (ie. iterable) and has attributes
@@ -67,6 +68,8 @@ class Token:
      (or None if token does not represent an opening tag)
 
     """
+    __slots__ = ("type", "data", "attrs")
+
     def __init__(self, type, data, attrs=None):
         self.type = type
         self.data = data
@@ -85,6 +88,10 @@ class Token:
     def __repr__(self):
         args = ", ".join(map(repr, [self.type, self.data, self.attrs]))
         return self.__class__.__name__+"(%s)" % args
+    def __getstate__(self):
+        return self.type, self.data, self.attrs
+    def __setstate__(self, state):
+        self.type, self.data, self.attrs = state
 
     def __str__(self):
         """
@@ -192,7 +199,7 @@ class _AbstractParser:
 
         """
         self._fh = fh
-        self._tokenstack = []  # FIFO
+        self._tokenstack = deque()  # FIFO
         self.textify = textify
         self.encoding = encoding
         if entitydefs is None:
@@ -226,20 +233,26 @@ class _AbstractParser:
         """
         while 1:
             while self._tokenstack:
-                token = self._tokenstack.pop(0)
+                token = self._tokenstack.popleft()
                 if tokentypes:
                     if token.type in tokentypes:
                         return token
                 else:
                     return token
-            data = self._fh.read(self.chunk)
-            if not data:
+            if not self._read():
                 raise NoMoreTokensError()
-            self.feed(data)
+
+    def _read(self):
+        # feed the next chunk of input; return false at end of input
+        data = self._fh.read(self.chunk)
+        if not data:
+            return False
+        self.feed(data)
+        return True
 
     def unget_token(self, token):
         """Push a Token back onto the stack."""
-        self._tokenstack.insert(0, token)
+        self._tokenstack.appendleft(token)
 
     def get_tag(self, *names):
         """Return the next Token that represents an opening or closing tag.
@@ -382,6 +395,202 @@ class TolerantPullParser(_AbstractParser, sgmllib.SGMLParser):
         self._tokenstack.append(Token("endtag", tag))
 
 
+# complete tokens of the commonest kinds; everything else (including
+# constructs that may continue in the next chunk) is handled one case at a time
+_token_re = re.compile(r"""
+    ([^<&]+)                                          # 1: data
+  | <([a-zA-Z][-.:a-zA-Z0-9_]*)                       # 2: start tag name
+     ((?:[^>"']|"[^"]*"|'[^']*')*)>                   # 3: attributes
+  | </\s*([a-zA-Z][-.:a-zA-Z0-9_]*)[^>]*>             # 4: end tag name
+  | &\#([xX][0-9a-fA-F]+|[0-9]+);                     # 5: charref
+  | &([a-zA-Z][-.a-zA-Z0-9]*);                        # 6: entityref
+  | <!--(.*?)-->                                      # 7: comment
+""", re.S | re.X)
+_charref_re = re.compile(r"&#([xX][0-9a-fA-F]+|[0-9]+)(;?)")
+_entityref_re = re.compile(r"&([a-zA-Z][-.a-zA-Z0-9]*)(;?)")
+_incomplete_ref_re = re.compile(r"&(?:#[xX]?)?$")
+_endtag_re = re.compile(r"</\s*([a-zA-Z][-.:a-zA-Z0-9_]*)[^>]*>")
+_starttag_re = re.compile(
+    r"""<([a-zA-Z][-.:a-zA-Z0-9_]*)((?:[^>"']|"[^"]*"|'[^']*')*)>""")
+_letters = string.ascii_letters
+# start tag with unbalanced quotes in its attributes (only tried at the end
+# of the document, since the closing quote may yet arrive)
+_bad_starttag_re = re.compile(r"<([a-zA-Z][-.:a-zA-Z0-9_]*)([^>]*)>")
+_attr_re = re.compile(
+    r"""([^\s"'>/=]+)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s>]*))?""")
+# a slash at the end of a start tag is not "/>" if it ends an unquoted
+# attribute value
+_unquoted_slash_re = re.compile(r"""=\s*[^\s"']+/\s*$""")
+_cdata_end_res = {}
+
+class FastPullParser(_AbstractParser):
+    """Pull parser with its own regular expression based tokenizer.
+
+    Around twice as fast as PullParser and TolerantPullParser on large
+    documents, and more forgiving of bad HTML than either.  Produces the same
+    tokens as PullParser, except that valueless attributes get their name as
+    value (as with TolerantPullParser), and data may be split into more tokens.
+    The content of SCRIPT and STYLE elements is returned as data.
+
+    Usable as the link_parser_class argument to LinksFactory.
+
+    """
+    chunk = 64*1024
+    cdata_elements = ("script", "style")
+
+    def __init__(self, *args, **kwds):
+        _AbstractParser.__init__(self, *args, **kwds)
+        self._rawdata = ""
+        self._cdata_end_re = None
+        self._closed = False
+
+    def _read(self):
+        if self._closed:
+            return False
+        data = self._fh.read(self.chunk)
+        if data:
+            self.feed(data)
+        else:
+            self.close()
+        return True
+
+    def feed(self, data):
+        self._rawdata = self._rawdata + data
+        self._goahead(False)
+
+    def close(self):
+        self._goahead(True)
+        self._closed = True
+
+    def _goahead(self, end):
+        rawdata = self._rawdata
+        append = self._tokenstack.append
+        match = _token_re.match
+        i = 0
+        n = len(rawdata)
+        while i < n:
+            if self._cdata_end_re is not None:
+                m = self._cdata_end_re.search(rawdata, i)
+                if m:
+                    j = m.start()
+                elif end:
+                    j = n
+                else:
+                    break
+                if j > i:
+                    append(Token("data", rawdata[i:j]))
+                i = j
+                self._cdata_end_re = None
+                continue
+            m = match(rawdata, i)
+            if m:
+                k = m.lastindex
+                if k == 1:
+                    append(Token("data", m.group(1)))
+                elif k == 3:
+                    self._handle_starttag(m.group(2).lower(), m.group(3))
+                elif k == 4:
+                    append(Token("endtag", m.group(4).lower()))
+                elif k == 5:
+                    append(Token("charref", m.group(5)))
+                elif k == 6:
+                    append(Token("entityref", m.group(6)))
+                else:
+                    append(Token("comment", m.group(7)))
+                i = m.end()
+                continue
+            if rawdata[i] == "&":
+                m = (_charref_re.match(rawdata, i) or
+                     _entityref_re.match(rawdata, i))
+                if m is None:
+                    if not end and _incomplete_ref_re.match(rawdata, i):
+                        break
+                    append(Token("data", "&"))
+                    i = i + 1
+                    continue
+                if m.end() == n and not m.group(2) and not end:
+                    # the reference may continue in the next chunk
+                    break
+                if rawdata[i+1] == "#":
+                    append(Token("charref", m.group(1)))
+                else:
+                    append(Token("entityref", m.group(1)))
+                i = m.end()
+                continue
+            # rawdata[i] == "<"
+            if rawdata.startswith("<!--", i):
+                j = rawdata.find("-->", i+4)
+                if j < 0:
+                    if not end:
+                        break
+                    j = n
+                append(Token("comment", rawdata[i+4:j]))
+                i = j + 3
+            elif rawdata.startswith("<!", i) or rawdata.startswith("<?", i):
+                if n - i < 4 and not end and rawdata.startswith("<!", i):
+                    break  # could be the start of a comment
+                j = rawdata.find(">", i+2)
+                if j < 0:
+                    if not end:
+                        break
+                    j = n
+                if rawdata[i+1] == "!":
+                    append(Token("decl", rawdata[i+2:j]))
+                else:
+                    append(Token("pi", rawdata[i+2:j]))
+                i = j + 1
+            elif rawdata.startswith("</", i):
+                m = _endtag_re.match(rawdata, i)
+                if m:
+                    append(Token("endtag", m.group(1).lower()))
+                    i = m.end()
+                elif not end and rawdata.find(">", i) < 0:
+                    break
+                else:
+                    append(Token("data", "<"))
+                    i = i + 1
+            else:
+                m = _starttag_re.match(rawdata, i)
+                if m is None and end:
+                    m = _bad_starttag_re.match(rawdata, i)
+                if m:
+                    self._handle_starttag(m.group(1).lower(), m.group(2))
+                    i = m.end()
+                elif not end and (i + 1 == n or rawdata[i+1] in _letters):
+                    # the tag continues in the next chunk (a ">" seen so far
+                    # may be inside a quoted attribute value)
+                    break
+                else:
+                    append(Token("data", "<"))
+                    i = i + 1
+        self._rawdata = rawdata[i:]
+
+    def _handle_starttag(self, tag, attrtext):
+        type = "starttag"
+        attrs = []
+        if attrtext:
+            stripped = attrtext.rstrip()
+            if (stripped.endswith("/") and
+                not _unquoted_slash_re.search(stripped)):
+                attrtext = stripped[:-1]
+                type = "startendtag"
+            for name, value in _attr_re.findall(attrtext):
+                if not value:
+                    value = name
+                elif value[0] in "'\"":
+                    value = value[1:-1]
+                if "&" in value:
+                    value = self.unescape_attr(value)
+                attrs.append((name.lower(), value))
+        self._tokenstack.append(Token(type, tag, attrs))
+        if type == "starttag" and tag in self.cdata_elements:
+            end_re = _cdata_end_res.get(tag)
+            if end_re is None:
+                end_re = _cdata_end_res[tag] = re.compile(
+                    r"</%s[\s>/]" % tag, re.I)
+            self._cdata_end_re = end_re
+
+
 def _test():
    import doctest, _pullparser
    return doctest.testmod(_pullparser)
@@ -0,0 +1,250 @@
+"""Per-host and per-proxy request rate limiting.
+
+Used by adding an HTTPRateLimitHandler to an opener, or by calling
+UserAgentBase.set_rate_limiter().
+
+"""
+
+import logging, time, urllib2
+try:
+    import threading as _threading
+except ImportError:
+    import dummy_threading as _threading
+
+import _rfc3986
+
+debug = logging.getLogger("mechanize.ratelimit").debug
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, and bursts of up to
+    capacity requests.
+
+    Requests are booked in advance (the bucket may go into debt), so that
+    waiting requests are served in the order they arrived and nobody has to
+    poll.
+
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = 0
+
+    def _tokens_at(self, when):
+        return min(self.capacity, self.tokens + (when - self.last)*self.rate)
+
+    def available_at(self, now):
+        """Return the earliest time >= now at which a token is available."""
+        when = max(now, self.last)
+        tokens = self._tokens_at(when)
+        if tokens >= 1:
+            return when
+        return when + (1 - tokens) / self.rate
+
+    def take(self, when):
+        """Take a token at time when (as returned by .available_at())."""
+        self.tokens = self._tokens_at(when) - 1
+        self.last = when
+
+    def is_full(self, now):
+        return now >= self.last and self._tokens_at(now) >= self.capacity
+
+
+class RateLimiter:
+    """Token-bucket request rate limits, per host and per proxy.
+
+    One instance may be shared between many UserAgent / Browser instances
+    (including across threads): the limits then apply to all their requests
+    together.  Requests over the limit block (sleeping, not polling) until
+    their turn comes; requests for a host are let through in the order they
+    arrived.
+
+    Constructor arguments / public attributes:
+
+    rate: maximum average requests per second to each host (host:port, as
+     in the URL), or None for no limit
+    burst: maximum number of requests to a host let through at once after a
+     quiet period
+    proxy_rate, proxy_burst: the same, for requests through each proxy
+    robots_cache: mechanize.RobotRulesCache; if given, hosts whose
+     robots.txt asks for a Crawl-delay or Request-rate (for the request's
+     User-Agent) are limited to that rate, if it's lower than rate.  Use
+     with the same cache passed to UserAgentBase.set_robots_options(), and
+     leave honor_crawl_delay false there (otherwise requests wait twice)
+    max_crawl_delay: longest robots.txt delay between requests honored, in
+     seconds
+
+    Statistics (public attributes, read-only):
+
+    nr_requests: number of requests seen
+    nr_waits: number of requests that had to wait
+    total_wait: total time spent waiting, in seconds
+    max_wait: longest wait, in seconds
+
+    """
+
+    # above this number of buckets, idle ones are discarded
+    max_buckets = 1000
+
+    def __init__(self, rate=None, burst=1, proxy_rate=None, proxy_burst=1,
+                 robots_cache=None, max_crawl_delay=60):
+        self.rate = rate
+        self.burst = burst
+        self.proxy_rate = proxy_rate
+        self.proxy_burst = proxy_burst
+        self.robots_cache = robots_cache
+        self.max_crawl_delay = max_crawl_delay
+        self.nr_requests = self.nr_waits = 0
+        self.total_wait = self.max_wait = 0.
+        self._time = time.time
+        self._sleep = time.sleep
+        self._lock = _threading.Lock()
+        # key --> TokenBucket; keys are ("host", host) or ("proxy", host)
+        self._buckets = {}
+        # key --> number of requests waiting
+        self._waiting = {}
+
+    def queue_depth(self, key=None):
+        """Return number of requests waiting.
+
+        key: ("host", host) or ("proxy", host); if None, return the total
+
+        """
+        self._lock.acquire()
+        try:
+            if key is not None:
+                return self._waiting.get(key, 0)
+            total = 0
+            for nr in self._waiting.itervalues():
+                total += nr
+            return total
+        finally:
+            self._lock.release()
+
+    def queue_depths(self):
+        """Return dict mapping keys (see .queue_depth()) to nr waiting."""
+        self._lock.acquire()
+        try:
+            return self._waiting.copy()
+        finally:
+            self._lock.release()
+
+    def _host_rate(self, scheme, host, useragent):
+        rate, burst = self.rate, self.burst
+        if self.robots_cache is None:
+            return rate, burst
+        rfp = self.robots_cache.get(scheme, host)
+        try:
+            interval = rfp.crawl_interval(useragent)
+        except AttributeError:
+            interval = None
+        if interval:
+            if self.max_crawl_delay is not None:
+                interval = min(interval, self.max_crawl_delay)
+            robots_rate = 1. / interval
+            if rate is None or robots_rate < rate:
+                rate, burst = robots_rate, 1
+        return rate, burst
+
+    def _bucket(self, key, rate, burst, now):
+        # must hold lock
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._discard_idle(now)
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+        else:
+            bucket.rate, bucket.capacity = rate, burst
+        return bucket
+
+    def _discard_idle(self, now):
+        # must hold lock
+        for key, bucket in self._buckets.items():
+            if bucket.is_full(now) and not self._waiting.get(key):
+                del self._buckets[key]
+
+    def wait(self, scheme, host, proxy=None, useragent=""):
+        """Block until a request to host (through proxy, if not None) may be
+        made.  Return the number of seconds waited."""
+        limits = [(("host", host),) + self._host_rate(scheme, host,
+                                                        useragent)]
+        if proxy is not None:
+            limits.append((("proxy", proxy), self.proxy_rate,
+                           self.proxy_burst))
+
+        self._lock.acquire()
+        try:
+            now = self._time()
+            buckets = []
+            when = now
+            for key, rate, burst in limits:
+                if rate is None:
+                    continue
+                bucket = self._bucket(key, rate, burst, now)
+                buckets.append((key, bucket))
+                when = max(when, bucket.available_at(now))
+            for key, bucket in buckets:
+                bucket.take(when)
+            wait = when - now
+            self.nr_requests += 1
+            if wait > 0:
+                self.nr_waits += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                for key, bucket in buckets:
+                    self._waiting[key] = self._waiting.get(key, 0) + 1
+        finally:
+            self._lock.release()
+
+        if wait > 0:
+            debug("waiting %.3gs for %s", wait, host)
+            try:
+                self._sleep(wait)
+            finally:
+                self._lock.acquire()
+                try:
+                    for key, bucket in buckets:
+                        nr = self._waiting[key] - 1
+                        if nr:
+                            self._waiting[key] = nr
+                        else:
+                            del self._waiting[key]
+                finally:
+                    self._lock.release()
+        return wait
+
+
+class HTTPRateLimitHandler(urllib2.BaseHandler):
+    """Delay requests as needed to keep to the limits of a RateLimiter.
+
+    This works at the "open" stage, after ProxyHandler has picked any proxy
+    (so per-proxy limits can be applied) and after HTTPCacheHandler (so that
+    responses served from the cache don't count).
+
+    """
+    handler_order = 160  # after ProxyHandler and HTTPCacheHandler
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    def http_open(self, request):
+        scheme = request.get_type()
+        proxy = None
+        tunnel_host = getattr(request, "_tunnel_host", None)
+        if tunnel_host:
+            host = tunnel_host
+            proxy = request.get_host()
+        elif request.has_proxy():
+            # the URL still names the origin host
+            proxy = request.get_host()
+            scheme, host = _rfc3986.urlsplit(request.get_full_url())[:2]
+        else:
+            host = request.get_host()
+        self.limiter.wait(scheme, host, proxy,
+                          request.get_header("User-agent", ""))
+        # let the next handler open the connection
+        return None
+
+    https_open = http_open
@@ -17,7 +17,7 @@ included with the distribution).
 
 """
 
-import copy, mimetools
+import copy, mimetools, tempfile
 from cStringIO import StringIO
 import urllib2
 
@@ -33,6 +33,74 @@ def len_of_seekable(file_):
         file_.seek(pos)
 
 
+class spooled_file:
+    """Read/write file-like object that moves its data to disk when it grows.
+
+    Data is kept in memory until more than max_size bytes have been written,
+    then moved to an anonymous temporary file.  If max_size is None, data is
+    always kept in memory.
+
+    Only the methods used by seek_wrapper are implemented.
+
+    """
+
+    def __init__(self, max_size=None):
+        self._file = StringIO()
+        self._max_size = max_size
+        self.spooled = False  # true iff data has been moved to disk
+
+    def _spool(self):
+        f = tempfile.TemporaryFile()
+        f.write(self._file.getvalue())
+        f.seek(self._file.tell())
+        self._file = f
+        self.spooled = True
+
+    def write(self, data):
+        self._file.write(data)
+        if (not self.spooled and self._max_size is not None and
+            self._file.tell() > self._max_size):
+            self._spool()
+
+    def spool(self):
+        """Move data to disk now, if it is not there already."""
+        if not self.spooled:
+            self._spool()
+
+    def memory_size(self):
+        """Return number of bytes held in memory."""
+        if self.spooled:
+            return 0
+        return len_of_seekable(self._file)
+
+    def seek(self, offset, whence=0):
+        self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readline(self, size=-1):
+        return self._file.readline(size)
+
+    def readlines(self, sizehint=-1):
+        if sizehint < 0:
+            return self._file.readlines()
+        return self._file.readlines(sizehint)
+
+    def getvalue(self):
+        if not self.spooled:
+            return self._file.getvalue()
+        pos = self._file.tell()
+        try:
+            self._file.seek(0)
+            return self._file.read()
+        finally:
+            self._file.seek(pos)
+
+
 # XXX Andrew Dalke kindly sent me a similar class in response to my request on
 # comp.lang.python, which I then proceeded to lose.  I wrote this class
 # instead, but I think he's released his code publicly since, could pinch the
@@ -59,6 +127,14 @@ class seek_wrapper:
 
     wrapped: the wrapped file object
     is_closed: true iff .close() has been called
+    content_info: cached mechanize._sniff.ContentInfo, or None (shared by
+     all copies, like the data cache)
+
+    Class attributes:
+
+    max_memory_cache: maximum number of bytes of wrapped file data to cache
+     in memory; beyond that, the cache is moved to a temporary file.  None
+     means no limit.
 
     WARNING: All other attributes of the wrapped object (ie. those that are not
     one of wrapped, read, readline, readlines, xreadlines, __iter__ and next)
@@ -67,17 +143,20 @@ class seek_wrapper:
 
     """
     # General strategy is to check that cache is full enough, then delegate to
-    # the cache (self.__cache, which is a cStringIO.StringIO instance).  A seek
+    # the cache (self.__cache, which is a spooled_file instance).  A seek
     # position (self.__pos) is maintained independently of the cache, in order
     # that a single cache may be shared between multiple seek_wrapper objects.
     # Copying using module copy shares the cache in this way.
 
+    max_memory_cache = 4*1024*1024
+
     def __init__(self, wrapped):
         self.wrapped = wrapped
         self.__read_complete_state = [False]
         self.__is_closed_state = [False]
+        self.__content_info_state = [None]
         self.__have_readline = hasattr(self.wrapped, "readline")
-        self.__cache = StringIO()
+        self.__cache = spooled_file(self.max_memory_cache)
         self.__pos = 0  # seek position
 
     def invariant(self):
@@ -95,6 +174,8 @@ class seek_wrapper:
             return self.__is_closed_state[0]
         elif name == "read_complete":
             return self.__read_complete_state[0]
+        elif name == "content_info":
+            return self.__content_info_state[0]
 
         wrapped = self.__dict__.get("wrapped")
         if wrapped:
@@ -108,6 +189,8 @@ class seek_wrapper:
         elif name == "read_complete":
             if not self.is_closed:
                 self.__read_complete_state[0] = bool(value)
+        elif name == "content_info":
+            self.__content_info_state[0] = value
         else:
             self.__dict__[name] = value
 
@@ -160,11 +243,20 @@ class seek_wrapper:
     def tell(self):
         return self.__pos
 
+    def memory_size(self):
+        """Return number of bytes of wrapped file data cached in memory."""
+        return self.__cache.memory_size()
+
+    def spool(self):
+        """Move the cached data to a temporary file (shared by all copies)."""
+        self.__cache.spool()
+
     def __copy__(self):
         cpy = self.__class__(self.wrapped)
         cpy.__cache = self.__cache
         cpy.__read_complete_state = self.__read_complete_state
         cpy.__is_closed_state = self.__is_closed_state
+        cpy.__content_info_state = self.__content_info_state
         return cpy
 
     def get_data(self):
@@ -206,6 +298,18 @@ class seek_wrapper:
         assert self.__pos == pos + len(data)
         return data
 
+    def _read_uncached(self, size):
+        # see read_uncached()
+        available = len_of_seekable(self.__cache) - self.__pos
+        if available > 0 and size != -1:
+            return self.read(min(size, available))
+        if available > 0:
+            return self.read(available) + read_uncached(self.wrapped, -1)
+        data = read_uncached(self.wrapped, size)
+        if not data:
+            self.read_complete = True
+        return data
+
     def readline(self, size=-1):
         if not self.__have_readline:
             raise NotImplementedError("no readline method on wrapped object")
@@ -253,6 +357,21 @@ class seek_wrapper:
                 (self.__class__.__name__, hex(abs(id(self))), self.wrapped))
 
 
+def read_uncached(fh, size=-1):
+    """Read from fh without adding to the cache of any seek_wrapper.
+
+    Data that a seek_wrapper has already cached beyond its current position is
+    returned first; after that, reads go straight to the wrapped file object.
+    This avoids keeping a copy of a large response body that is only going to
+    be read once (see OpenerDirector.retrieve()).  Once this has been used,
+    seeking fh (or a copy of it) gives undefined results.
+
+    """
+    if isinstance(fh, seek_wrapper):
+        return fh._read_uncached(size)
+    return fh.read(size)
+
+
 class response_seek_wrapper(seek_wrapper):
 
     """
@@ -286,8 +405,11 @@ class response_seek_wrapper(seek_wrapper):
         self.seek(0)
         self.read()
         self.close()
-        cache = self._seek_wrapper__cache = StringIO()
+        cache = self._seek_wrapper__cache = spooled_file(
+            self.max_memory_cache)
         cache.write(data)
+        # new body, so sniff again
+        self._seek_wrapper__content_info_state = [None]
         self.seek(0)
 
 
@@ -394,6 +516,14 @@ class closeable_response:
         state["wrapped"] = new_wrapped
         return state
 
+def evicted_response(response):
+    """Return a stand-in for response that has no data and is not
+    .read_complete, so that Browser.back() fetches the page again."""
+    r = closeable_response(
+        eoffile(), response.info(), response.geturl(),
+        getattr(response, "code", None), getattr(response, "msg", None))
+    return response_seek_wrapper(r)
+
 def test_response(data='test data', headers=[],
                   url="http://example.com/", code=200, msg="OK"):
     return make_response(data, headers, url, code, msg)
@@ -27,6 +27,24 @@ import re, urllib
 BAD_URI_CHARS_RE = re.compile("[^A-Za-z0-9\-_.~!*'();:@&=+$,/?%#[\]]")
 
 
+# encoding --> true if every URI character is represented by its ASCII byte
+_ascii_compatible = {}
+_URI_CHARS = ("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
+              "-_.~!*'();:@&=+$,/?%#[]")
+
+def _is_ascii_compatible(encoding):
+    try:
+        return _ascii_compatible[encoding]
+    except KeyError:
+        try:
+            compatible = (
+                _URI_CHARS.decode(encoding, "replace") == unicode(_URI_CHARS)
+                and unicode(_URI_CHARS).encode(encoding) == _URI_CHARS)
+        except (LookupError, UnicodeError):
+            compatible = False
+        _ascii_compatible[encoding] = compatible
+        return compatible
+
 def clean_url(url, encoding):
     # percent-encode illegal URI characters
     # Trying to come up with test cases for this gave me a headache, revisit
@@ -36,12 +54,38 @@ def clean_url(url, encoding):
 ##     - Mozilla/Firefox will send you latin-1 if there's no non latin-1
 ##     characters in your link. It will send you utf-8 however if there are...
     if type(url) == type(""):
+        if (not BAD_URI_CHARS_RE.search(url) and
+            _is_ascii_compatible(encoding)):
+            # nothing to do (the common case)
+            return url
         url = url.decode(encoding, "replace")
     url = url.strip()
     # for second param to urllib.quote(), we want URI_CHARS, minus the
     # 'always_safe' characters that urllib.quote() never percent-encodes
     return urllib.quote(url.encode(encoding), "!*'();:@&=+$,/?%#[]~")
 
+class URLCleaner:
+    """clean_url() for one encoding, remembering results for repeated URLs.
+
+    Use one instance per document: it's not bounded in size.
+
+    """
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self._cache = {}
+
+    def clean(self, url):
+        try:
+            return self._cache[url]
+        except KeyError:
+            cleaned = self._cache[url] = clean_url(url, self.encoding)
+            return cleaned
+
+    def clean_all(self, urls):
+        clean = self.clean
+        return [clean(url) for url in urls]
+
 def is_clean_uri(uri):
     """
     >>> is_clean_uri("ABC!")
@@ -94,6 +138,88 @@ def urljoin(base_uri, uri_reference):
     return urlunsplit(urljoin_parts(urlsplit(base_uri),
                                     urlsplit(uri_reference)))
 
+class Resolver:
+    """Resolves URI references against one base URI.
+
+    Equivalent to urljoin(base_uri, uri_reference), but the base URI is split
+    only once, and results for repeated references are remembered (up to
+    max_cache of them; None means no limit).
+
+    """
+
+    def __init__(self, base_uri, max_cache=1000):
+        self.base_uri = base_uri
+        self.max_cache = max_cache
+        self._base_parts = urlsplit(base_uri)
+        scheme, authority, path = self._base_parts[:3]
+        self._cache = {}
+        # for the common case of a reference with only path, query and
+        # fragment: the start of the result, and what merge() would prepend
+        # to a relative path
+        self._prefix = urlunsplit((scheme, authority, "", None, None))
+        self._base_dir = merge(authority, path, "")
+
+    def _resolve(self, uri_reference):
+        parts = urlsplit(uri_reference)
+        rscheme, rauthority, rpath, rquery, rfragment = parts
+        if ((rscheme is not None and rscheme != self._base_parts[0]) or
+            rauthority is not None or rpath == ""):
+            return urlunsplit(urljoin_parts(self._base_parts, parts))
+        if rpath.startswith("/"):
+            tpath = remove_dot_segments(rpath)
+        else:
+            tpath = remove_dot_segments(self._base_dir + rpath)
+        r = [self._prefix, tpath]
+        if rquery is not None:
+            r.append("?")
+            r.append(rquery)
+        if rfragment is not None:
+            r.append("#")
+            r.append(rfragment)
+        return "".join(r)
+
+    def resolve(self, uri_reference):
+        try:
+            return self._cache[uri_reference]
+        except KeyError:
+            pass
+        absolute_uri = self._resolve(uri_reference)
+        if (self.max_cache is not None and
+            len(self._cache) >= self.max_cache):
+            self._cache.clear()
+        self._cache[uri_reference] = absolute_uri
+        return absolute_uri
+
+    def resolve_all(self, uri_references):
+        """Return list of absolute URIs for sequence uri_references."""
+        resolve = self.resolve
+        return [resolve(ref) for ref in uri_references]
+
+def resolve_all(base_uri, uri_references):
+    """Return list of absolute URIs for uri_references, relative to base_uri.
+
+    >>> resolve_all("http://a/b/c/d;p?q", ["g", "../g", "//g", "#s", "g"])
+    ['http://a/b/c/g', 'http://a/b/g', 'http://g', 'http://a/b/c/d;p?q#s', 'http://a/b/c/g']
+    """
+    return Resolver(base_uri, max_cache=None).resolve_all(uri_references)
+
+# base URI --> Resolver, for recently used base URIs
+_resolvers = {}
+def resolver(base_uri):
+    """Return a Resolver for base_uri, shared with other callers.
+
+    Thread-safe enough: at worst, two threads make a Resolver for the same
+    base.
+
+    """
+    try:
+        return _resolvers[base_uri]
+    except KeyError:
+        if len(_resolvers) >= 20:
+            _resolvers.clear()
+        r = _resolvers[base_uri] = Resolver(base_uri)
+        return r
+
 # oops, this doesn't do the same thing as the literal translation
 # from the RFC below
 ## import posixpath
@@ -177,6 +303,9 @@ def urljoin_parts(base_parts, reference_parts):
 
 
 def remove_dot_segments(path):
+    if not path.startswith(".") and "/." not in path:
+        # no dot segments (the common case)
+        return path
     r = []
     while path:
         # A
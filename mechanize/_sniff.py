@@ -0,0 +1,143 @@
+"""Content type and character encoding detection, done once per response.
+
+The result is cached on seekable responses (and shared by their copies), so
+that HTTPEquivProcessor, the HTML factories and the forms parser don't each
+re-examine the headers and the start of the body.
+
+"""
+
+import codecs, re
+
+from _headersutil import split_header_words, is_html
+from _response import seek_wrapper
+
+# number of bytes at the start of the body searched for a BOM or META charset
+SNIFF_SIZE = 1024
+
+BOMS = [
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+    ]
+
+# matches both <meta charset="..."> and
+# <meta http-equiv="content-type" content="text/html; charset=...">
+META_CHARSET_RE = re.compile(
+    r"""<meta\b[^>]*?charset\s*=\s*["']?\s*([-\w.:]+)""", re.I)
+
+
+def _known_encoding(encoding):
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        return False
+    return True
+
+def sniff_bom(data):
+    """Return encoding indicated by a byte order mark at start of data."""
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return encoding
+    return None
+
+def sniff_meta_charset(data):
+    """Return charset named by the first META element in data that has one.
+
+    Charsets Python doesn't know about are ignored.
+
+    """
+    m = META_CHARSET_RE.search(data)
+    if m is not None:
+        charset = m.group(1)
+        if _known_encoding(charset):
+            return charset
+    return None
+
+
+class ContentInfo:
+    """What is known about the content type and encoding of a response.
+
+    Public attributes (all read-only):
+
+    url: response URL
+    charset: charset parameter of the first Content-Type header that has one
+     (HTTPEquivProcessor appends HTTP-EQUIV headers after the HTTP headers,
+     so HTTP wins), or None
+    bom_encoding: encoding indicated by a byte order mark at the start of the
+     body, or None
+    meta_charset: charset given by a META element near the start of the body,
+     or None
+
+    The body is only looked at if there is no charset header and the response
+    might be HTML, and then only the first SNIFF_SIZE bytes.
+
+    """
+
+    def __init__(self, headers, url, prefix=None):
+        """
+        headers: mimetools.Message-like response headers
+        url: response URL
+        prefix: callable returning the start of the body, or None if the body
+         is not available
+
+        """
+        self.url = url
+        self.update_headers(headers)
+        self.bom_encoding = self.meta_charset = None
+        if (prefix is not None and self.charset is None and
+            (not self._ct_hdrs or self.is_html(True))):
+            data = prefix()
+            self.bom_encoding = sniff_bom(data)
+            if self.bom_encoding is None:
+                self.meta_charset = sniff_meta_charset(data)
+
+    def update_headers(self, headers):
+        """Re-read Content-Type headers (after headers have been added)."""
+        self._ct_hdrs = headers.getheaders("content-type")
+        self._is_html = {}
+        self.charset = None
+        for ct in self._ct_hdrs:
+            for k, v in split_header_words([ct])[0]:
+                if k == "charset":
+                    self.charset = v
+                    return
+
+    def encoding(self, default_encoding):
+        """Return the document's encoding, or default_encoding if unknown."""
+        for encoding in self.charset, self.bom_encoding, self.meta_charset:
+            if encoding:
+                return encoding
+        return default_encoding
+
+    def is_html(self, allow_xhtml=False):
+        try:
+            return self._is_html[allow_xhtml]
+        except KeyError:
+            result = self._is_html[allow_xhtml] = is_html(
+                self._ct_hdrs, self.url, allow_xhtml)
+            return result
+
+
+def _read_prefix(response):
+    pos = response.tell()
+    try:
+        response.seek(0)
+        return response.read(SNIFF_SIZE)
+    finally:
+        response.seek(pos)
+
+def content_info(response):
+    """Return ContentInfo for response, sniffing it only on first use.
+
+    Only seekable responses (as returned by mechanize.seek_wrapped_response()
+    and friends) have their body examined and the result cached.
+
+    """
+    if not isinstance(response, seek_wrapper):
+        return ContentInfo(response.info(), response.geturl())
+    info = response.content_info
+    if info is None:
+        info = response.content_info = ContentInfo(
+            response.info(), response.geturl(),
+            lambda: _read_prefix(response))
+    return info
@@ -25,9 +25,13 @@ from _debug import \
      HTTPRedirectDebugProcessor
 from _file import \
      FileHandler
-# crap ATM
-## from _gzip import \
-##      HTTPGzipProcessor
+from _gzip import \
+     HTTPGzipProcessor
+from _httpcache import \
+     HTTPCacheHandler, \
+     MemoryResponseCache, \
+     DirectoryResponseCache, \
+     SQLiteResponseCache
 from _http import \
      HTTPHandler, \
      HTTPDefaultErrorHandler, \
@@ -38,11 +42,15 @@ from _http import \
      HTTPRefreshProcessor, \
      HTTPErrorProcessor, \
      HTTPRobotRulesProcessor, \
+     RobotRulesCache, \
      RobotExclusionError
 import httplib
 if hasattr(httplib, 'HTTPS'):
     from _http import HTTPSHandler
 del httplib
+from _ratelimit import \
+     HTTPRateLimitHandler, \
+     RateLimiter
 from _opener import OpenerDirector, \
      SeekableResponseOpener, \
      build_opener, install_opener, urlopen
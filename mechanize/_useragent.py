@@ -11,14 +11,25 @@ included with the distribution).
 
 """
 
-import warnings
-
 import _auth
 import _gzip
 import _opener
 import _response
+import _rfc3986
 import _sockettimeout
 import _urllib2
+import _workerpool
+
+
+def request_authority(url_or_req):
+    try:
+        url = url_or_req.get_full_url()
+    except AttributeError:
+        url = url_or_req
+    authority = _rfc3986.urlsplit(url)[1]
+    if authority is not None:
+        authority = authority.lower()
+    return authority
 
 
 class UserAgentBase(_opener.OpenerDirector):
@@ -70,7 +81,9 @@ class UserAgentBase(_opener.OpenerDirector):
         "_proxy_basicauth": _urllib2.ProxyBasicAuthHandler,
         "_proxy_digestauth": _urllib2.ProxyDigestAuthHandler,
         "_robots": _urllib2.HTTPRobotRulesProcessor,
-        "_gzip": _gzip.HTTPGzipProcessor,  # experimental!
+        "_gzip": _gzip.HTTPGzipProcessor,
+        "_cache": _urllib2.HTTPCacheHandler,
+        "_ratelimit": _urllib2.HTTPRateLimitHandler,
 
         # debug handlers
         "_debug_redirect": _urllib2.HTTPRedirectDebugProcessor,
@@ -85,7 +98,7 @@ class UserAgentBase(_opener.OpenerDirector):
                         "_refresh", "_equiv",
                         "_basicauth", "_digestauth",
                         "_proxy", "_proxy_basicauth", "_proxy_digestauth",
-                        "_robots",
+                        "_robots", "_gzip",
                         ]
     if hasattr(_urllib2, 'HTTPSHandler'):
         handler_classes["https"] = _urllib2.HTTPSHandler
@@ -93,6 +106,8 @@ class UserAgentBase(_opener.OpenerDirector):
 
     def __init__(self):
         _opener.OpenerDirector.__init__(self)
+        self._http_conn_cache = None
+        self._robots_options = {}
 
         ua_handlers = self._ua_handlers = {}
         for scheme in (self.default_schemes+
@@ -128,11 +143,112 @@ class UserAgentBase(_opener.OpenerDirector):
         _opener.OpenerDirector.close(self)
         self._ua_handlers = None
 
+    def open_many(self, requests, max_workers=4, max_per_host=None,
+                  timeout=_sockettimeout._GLOBAL_DEFAULT_TIMEOUT):
+        """Open several URLs concurrently, using a pool of worker threads.
+
+        requests: sequence of URLs and/or Request objects
+        max_workers: maximum number of requests in progress at once
+        max_per_host: maximum number of requests in progress at once for any
+         one host (and port), or None for no per-host limit.  This applies to
+         the URL as passed in, not to the targets of any redirections.
+
+        Returns an iterator over (request, response, error) tuples, in the
+        order in which the requests complete.  request is the URL or Request
+        object that was passed in.  If opening it raised an exception
+        (including HTTPError), response is None and error is the exception;
+        otherwise, error is None.  Call the iterator's .close() method to
+        abandon requests that have not yet been started.
+
+        Each request is handled exactly as by .open() (cookies, redirection,
+        authentication, robots.txt, etc.).  The cookiejar and password
+        managers are shared between the worker threads.  To limit the number
+        of connections (rather than requests) per host, see
+        .set_http_connection_cache().
+
+        """
+        self._maybe_reindex_handlers()
+        def open_one(request):
+            return self._open_one_of_many(request, timeout)
+        return _workerpool.WorkerPool(open_one, requests, max_workers,
+                                      request_authority, max_per_host)
+
+    def open_async(self, request,
+                   timeout=_sockettimeout._GLOBAL_DEFAULT_TIMEOUT):
+        """Start opening a URL in another thread, and return straight away.
+
+        request: URL or Request object
+
+        Returns a future: see mechanize.Future.  Its .result() is the
+        response, or raises the exception (including HTTPError) raised by
+        opening the URL.  Callbacks added with .add_done_callback() are
+        called from the thread that opened the URL; to wake up an event
+        loop, have them use whatever thread-safe mechanism the loop provides.
+
+        The request is handled exactly as by .open_many().  Requests started
+        this way share a pool of a limited number of threads (see
+        mechanize._workerpool.MAX_ASYNC_WORKERS); beyond that, they wait their
+        turn.  Code that does its own I/O can instead use
+        .preprocess_request() and .postprocess_response().
+
+        """
+        self._maybe_reindex_handlers()
+        return _workerpool.call_async(self._open_one_of_many, request, timeout)
+
+    def retrieve_async(self, fullurl, filename=None, reporthook=None,
+                       data=None,
+                       timeout=_sockettimeout._GLOBAL_DEFAULT_TIMEOUT):
+        """As .retrieve(), but in another thread, like .open_async().
+
+        Returns a future whose .result() is the (filename, headers) pair.
+        reporthook is called from the thread doing the retrieval.
+
+        """
+        self._maybe_reindex_handlers()
+        return _workerpool.call_async(self.retrieve, fullurl, filename,
+                                      reporthook, data, timeout)
+
+    def _open_one_of_many(self, request, timeout):
+        return self.open(request, timeout=timeout)
+
+    def set_http_connection_cache(self, conn_cache):
+        """Set a mechanize.ConnectionCache, or None.
+
+        If a connection cache is set, HTTP and HTTPS connections are kept
+        alive and reused for later requests to the same host (and port, and
+        proxy).  The same cache may be shared between several UserAgent or
+        Browser instances, including across threads.
+
+        """
+        self._http_conn_cache = conn_cache
+        for scheme in "http", "https":
+            h = self._ua_handlers.get(scheme)
+            if h is not None:
+                h.set_connection_cache(conn_cache)
+
+    def set_http_cache(self, cache):
+        """Set an HTTP response cache, or None.
+
+        cache is an object like mechanize.MemoryResponseCache,
+        mechanize.DirectoryResponseCache or mechanize.SQLiteResponseCache.
+        See mechanize.HTTPCacheHandler.
+
+        """
+        self._set_handler("_cache", obj=cache)
+
+    def set_rate_limiter(self, limiter):
+        """Set a mechanize.RateLimiter, or None.
+
+        The same limiter may be shared between several UserAgent or Browser
+        instances, including across threads, to keep all their requests
+        within its limits.
+
+        """
+        self._set_handler("_ratelimit", obj=limiter)
+
     # XXX
 ##     def set_timeout(self, timeout):
 ##         self._timeout = timeout
-##     def set_http_connection_cache(self, conn_cache):
-##         self._http_conn_cache = conn_cache
 ##     def set_ftp_connection_cache(self, conn_cache):
 ##         # XXX ATM, FTP has cache as part of handler; should it be separate?
 ##         self._ftp_conn_cache = conn_cache
@@ -164,6 +280,8 @@ class UserAgentBase(_opener.OpenerDirector):
         # add the scheme handlers that are missing
         for scheme in want.keys():
             self._set_handler(scheme, True)
+        if self._http_conn_cache is not None:
+            self.set_http_connection_cache(self._http_conn_cache)
 
     def set_cookiejar(self, cookiejar):
         """Set a mechanize.CookieJar, or None."""
@@ -223,10 +341,33 @@ class UserAgentBase(_opener.OpenerDirector):
         handler = self._ua_handlers["https"]
         handler.client_cert_manager = cert_manager
 
+    def set_robots_options(self, cache=None, honor_crawl_delay=False,
+                           max_crawl_delay=60, longest_match=False):
+        """Set options for observing robots.txt (see .set_handle_robots()).
+
+        cache: mechanize.RobotRulesCache to keep parsed robots.txt files in;
+         pass the same cache to several Browser instances to share it
+        honor_crawl_delay: space out requests to each host as asked by its
+         robots.txt Crawl-delay or Request-rate (off by default; see also
+         mechanize.RateLimiter, which can do this without a second wait)
+        max_crawl_delay: longest delay between requests honored, in seconds
+        longest_match: apply rules as RFC 9309 says (the longest matching
+         rule wins, and * and $ are wildcards) rather than as the standard
+         library's robotparser does (the first matching rule wins)
+
+        """
+        self._robots_options = {
+            "cache": cache, "honor_crawl_delay": honor_crawl_delay,
+            "max_crawl_delay": max_crawl_delay,
+            "longest_match": longest_match}
+        if self._ua_handlers.get("_robots") in self.handlers:
+            self.set_handle_robots(True)
+
     # these methods all take a boolean parameter
     def set_handle_robots(self, handle):
         """Set whether to observe rules from robots.txt."""
-        self._set_handler("_robots", handle)
+        self._set_handler("_robots", handle,
+                          constructor_kwds=self._robots_options)
     def set_handle_redirect(self, handle):
         """Set whether to handle HTTP 30x redirections."""
         self._set_handler("_redirect", handle)
@@ -247,12 +388,12 @@ class UserAgentBase(_opener.OpenerDirector):
             constructor_kwds={}
         self._set_handler("_equiv", handle, constructor_kwds=constructor_kwds)
     def set_handle_gzip(self, handle):
-        """Handle gzip transfer encoding.
+        """Set whether to handle gzip and deflate content-encoding.
+
+        If this is set (as it is by default), compressed responses are
+        requested, and response bodies are decompressed as they are read.
 
         """
-        if handle:
-            warnings.warn(
-                "gzip transfer encoding is experimental!", stacklevel=2)
         self._set_handler("_gzip", handle)
     def set_debug_redirects(self, handle):
         """Log information about HTTP redirects (including refreshes).
@@ -322,6 +463,7 @@ class UserAgentBase(_opener.OpenerDirector):
                     self.handlers.remove(handler)
                 except ValueError:
                     pass
+                self._handler_index_valid = False
         # then add the replacement, if any
         if newhandler is not None:
             self.add_handler(newhandler)
@@ -9,6 +9,10 @@ COPYING.txt included with the distribution).
 """
 
 import re, time, warnings
+try:
+    import threading as _threading
+except ImportError:
+    import dummy_threading as _threading
 
 
 class ExperimentalWarning(UserWarning):
@@ -34,6 +38,69 @@ def isstringlike(x):
     except: return False
     else: return True
 
+
+class LRUCache:
+    """Mapping holding at most max_size items, discarding least recently used.
+
+    Not thread-safe: callers that share an instance between threads must
+    lock around it.
+
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # key --> [previous node, next node, key, value], in a circular
+        # doubly-linked list whose root is ._root; most recently used last
+        self._map = {}
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def _unlink(self, node):
+        node[0][1] = node[1]
+        node[1][0] = node[0]
+
+    def _append(self, node):
+        root = self._root
+        last = root[0]
+        node[0] = last
+        node[1] = root
+        last[1] = root[0] = node
+
+    def get(self, key, default=None):
+        node = self._map.get(key)
+        if node is None:
+            return default
+        self._unlink(node)
+        self._append(node)
+        return node[3]
+
+    def __setitem__(self, key, value):
+        node = self._map.get(key)
+        if node is not None:
+            self._unlink(node)
+        node = [None, None, key, value]
+        self._append(node)
+        self._map[key] = node
+        while len(self._map) > self.max_size:
+            self.pop(self._root[1][2])
+
+    def pop(self, key, default=None):
+        node = self._map.pop(key, None)
+        if node is None:
+            return default
+        self._unlink(node)
+        return node[3]
+
+    def clear(self):
+        self._map.clear()
+        self._root[:] = [self._root, self._root, None, None]
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def __len__(self):
+        return len(self._map)
+
 ## def caller():
 ##     try:
 ##         raise SyntaxError
@@ -169,6 +236,11 @@ def _str2time(day, mon, yr, hr, min, sec, tz):
 
 strict_re = re.compile(r"^[SMTWF][a-z][a-z], (\d\d) ([JFMASOND][a-z][a-z]) "
                        r"(\d\d\d\d) (\d\d):(\d\d):(\d\d) GMT$")
+rfc850_re = re.compile(r"^[SMTWF][a-z]+day, (\d\d)-([JFMASOND][a-z][a-z])-"
+                       r"(\d\d) (\d\d):(\d\d):(\d\d) GMT$")
+asctime_re = re.compile(r"^\s*[SMTWF][a-z][a-z] ([JFMASOND][a-z][a-z]) "
+                        r"([ \d]\d) (\d\d):(\d\d):(\d\d) (\d\d\d\d)\s*$",
+                        re.I)
 wkday_re = re.compile(
     r"^(?:Sun|Mon|Tue|Wed|Thu|Fri|Sat)[a-z]*,?\s*", re.I)
 loose_http_re = re.compile(
@@ -188,6 +260,12 @@ loose_http_re = re.compile(
        \s*
     (?:\(\w+\))?       # ASCII representation of timezone in parens.
        \s*$""", re.X)
+# recently parsed date strings --> http2time() result: servers send the same
+# few dates (cookie expiry dates in particular) over and over
+_http2time_cache = LRUCache(500)
+_http2time_lock = _threading.Lock()
+_missing = object()
+
 def http2time(text):
     """Returns time in seconds since epoch of time represented by a string.
 
@@ -209,6 +287,7 @@ def http2time(text):
     09 Feb 1994 22:23:32 GMT            -- HTTP format (no weekday)
     08-Feb-94 14:15:29 GMT              -- rfc850 format (no weekday)
     08-Feb-1994 14:15:29 GMT            -- broken rfc850 format (no weekday)
+    Wed Feb  9 22:23:32 1994            -- ANSI C asctime() format
 
     The parser ignores leading and trailing whitespace.  The time may be
     absent.
@@ -217,6 +296,21 @@ def http2time(text):
     century that makes the year closest to the current date.
 
     """
+    _http2time_lock.acquire()
+    try:
+        t = _http2time_cache.get(text, _missing)
+    finally:
+        _http2time_lock.release()
+    if t is _missing:
+        t = _http2time(text)
+        _http2time_lock.acquire()
+        try:
+            _http2time_cache[text] = t
+        finally:
+            _http2time_lock.release()
+    return t
+
+def _http2time(text):
     # fast exit for strictly conforming string
     m = strict_re.search(text)
     if m:
@@ -226,6 +320,15 @@ def http2time(text):
               int(g[3]), int(g[4]), float(g[5]))
         return my_timegm(tt)
 
+    # the other two formats HTTP/1.1 clients must accept
+    m = rfc850_re.search(text)
+    if m:
+        return _str2time(*(m.groups() + ("GMT",)))
+    m = asctime_re.search(text)
+    if m:
+        mon, day, hr, min, sec, yr = m.groups()
+        return _str2time(day.lstrip(), mon, yr, hr, min, sec, None)
+
     # No, we need some messy parsing...
 
     # clean up
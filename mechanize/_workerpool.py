@@ -0,0 +1,316 @@
+"""Bounded pool of worker threads, used by UserAgentBase.open_many(), and
+futures, used by UserAgentBase.open_async().
+
+"""
+
+import sys
+try:
+    import threading as _threading
+except ImportError:
+    import dummy_threading as _threading
+
+
+class WorkerPool:
+    """Call a function once per job, on at most max_workers threads.
+
+    Iterating over the pool gives (job, result, error) tuples in order of
+    completion.  Exactly one of result and error is None: error is the
+    exception instance raised by the function, if any.
+
+    Jobs are grouped by key(job) (e.g. the host name for URL jobs).  If
+    max_per_key is not None, no more than that many jobs with the same key run
+    at once.  Jobs with different keys are started in round-robin order, so a
+    long run of jobs for one key doesn't hold up the rest.
+
+    .add(job) adds a job to a pool that is already running.  Threads are only
+    started when there is work for them, and end when there is none left.
+
+    If keep_results is false, the function's return value and errors are
+    dropped, rather than kept for iteration (use this for a long-lived pool
+    whose function reports results some other way).
+
+    .close() discards jobs that have not yet started; jobs already running are
+    allowed to finish, but their results are discarded.  .join() waits for
+    running jobs to finish.
+
+    """
+
+    def __init__(self, function, jobs, max_workers,
+                 key=None, max_per_key=None, keep_results=True):
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+        if max_per_key is not None and max_per_key < 1:
+            raise ValueError("max_per_key must be at least 1")
+        self._function = function
+        self._max_workers = max_workers
+        self._key = key
+        self._max_per_key = max_per_key
+        self._keep_results = keep_results
+        self._lock = _threading.Lock()
+        self._changed = _threading.Condition(self._lock)
+        # key --> list of jobs not yet started; ._keys gives round-robin order
+        self._pending = {}
+        self._keys = []
+        self._running = {}
+        self._done = []
+        self._nr_outstanding = 0
+        self._nr_workers = 0
+        self._closed = False
+
+        for job in jobs:
+            self._add(job)
+        self._start_workers()
+
+    def _add(self, job):
+        # must hold lock
+        if self._key is None:
+            job_key = None
+        else:
+            job_key = self._key(job)
+        if job_key not in self._pending:
+            self._pending[job_key] = []
+            self._keys.append(job_key)
+        self._pending[job_key].append(job)
+        if self._keep_results:
+            self._nr_outstanding += 1
+
+    def add(self, job):
+        """Add a job (ignored if the pool is closed)."""
+        self._lock.acquire()
+        try:
+            if self._closed:
+                return
+            self._add(job)
+            self._start_workers()
+            self._changed.notifyAll()
+        finally:
+            self._lock.release()
+
+    def _start_workers(self):
+        # must hold lock
+        nr_pending = 0
+        for jobs in self._pending.values():
+            nr_pending += len(jobs)
+        nr_idle = self._nr_workers - sum(self._running.values())
+        for ii in range(min(self._max_workers - self._nr_workers,
+                            nr_pending - nr_idle)):
+            self._start_worker()
+
+    def _start_worker(self):
+        # must hold lock
+        self._nr_workers += 1
+        thread = _threading.Thread(target=self._work)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _take_job(self):
+        # must hold lock
+        for ii in range(len(self._keys)):
+            job_key = self._keys[ii]
+            if (self._max_per_key is not None and
+                self._running.get(job_key, 0) >= self._max_per_key):
+                continue
+            jobs = self._pending[job_key]
+            job = jobs.pop(0)
+            del self._keys[ii]
+            if jobs:
+                self._keys.append(job_key)
+            else:
+                del self._pending[job_key]
+            self._running[job_key] = self._running.get(job_key, 0) + 1
+            return job_key, job
+        return None
+
+    def _work(self):
+        while True:
+            self._lock.acquire()
+            try:
+                while True:
+                    if self._closed or not self._keys:
+                        self._nr_workers -= 1
+                        return
+                    taken = self._take_job()
+                    if taken is not None:
+                        break
+                    # every pending job's key is at its limit
+                    self._changed.wait()
+            finally:
+                self._lock.release()
+
+            job_key, job = taken
+            try:
+                done = job, self._function(job), None
+            except Exception:
+                done = job, None, sys.exc_info()[1]
+            except:
+                # SystemExit, KeyboardInterrupt etc.: record the job as done
+                # so nobody waits for it forever, then let the error end this
+                # thread, in favour of a new one if there's more work
+                self._job_done(job_key, (job, None, sys.exc_info()[1]), True)
+                raise
+            self._job_done(job_key, done, False)
+
+    def _job_done(self, job_key, done, exiting):
+        self._lock.acquire()
+        try:
+            self._running[job_key] -= 1
+            if not self._closed and self._keep_results:
+                self._done.append(done)
+            if exiting:
+                self._nr_workers -= 1
+                if not self._closed:
+                    self._start_workers()
+            self._changed.notifyAll()
+        finally:
+            self._lock.release()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        self._lock.acquire()
+        try:
+            while not self._done:
+                if self._nr_outstanding == 0 or self._closed:
+                    raise StopIteration()
+                self._changed.wait()
+            self._nr_outstanding -= 1
+            return self._done.pop(0)
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._closed = True
+            self._pending = {}
+            self._keys = []
+            self._done = []
+            self._changed.notifyAll()
+        finally:
+            self._lock.release()
+
+    def join(self):
+        """Wait until no jobs are pending or running."""
+        self._lock.acquire()
+        try:
+            while self._keys or [n for n in self._running.values() if n]:
+                self._changed.wait()
+        finally:
+            self._lock.release()
+
+
+class TimeoutError(Exception):
+    """Raised by Future methods when the call has not finished in time."""
+
+
+class Future:
+    """The eventual result of a call running in another thread.
+
+    Like concurrent.futures.Future (but without cancellation):
+
+    .done(): return true if the call has finished
+    .result(timeout=None): wait for the call to finish (for at most timeout
+     seconds, if not None) and return its result, or raise the exception
+     it raised (with its original traceback); raises TimeoutError if the
+     call is still running
+    .exception(timeout=None): the same, but return the exception raised (or
+     None) instead
+    .add_done_callback(fn): call fn(future) when the call has finished (in
+     the thread that ran it, or straight away if it has already finished)
+
+    """
+
+    def __init__(self):
+        self._lock = _threading.Lock()
+        self._finished = _threading.Condition(self._lock)
+        self._done = False
+        self._result = self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def _wait(self, timeout):
+        self._lock.acquire()
+        try:
+            if not self._done:
+                self._finished.wait(timeout)
+            if not self._done:
+                raise TimeoutError()
+        finally:
+            self._lock.release()
+
+    def result(self, timeout=None):
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        if self._exc_info is None:
+            return None
+        return self._exc_info[1]
+
+    def add_done_callback(self, fn):
+        self._lock.acquire()
+        try:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._lock.release()
+        fn(self)
+
+    def _set(self, result, exc_info):
+        self._lock.acquire()
+        try:
+            self._result, self._exc_info = result, exc_info
+            self._done = True
+            self._finished.notifyAll()
+            callbacks = self._callbacks
+            self._callbacks = []
+        finally:
+            self._lock.release()
+        for fn in callbacks:
+            fn(self)
+
+
+# calls started by call_async() run on at most this many threads at once;
+# later calls wait for a thread to become free
+MAX_ASYNC_WORKERS = 20
+
+def _run_call(job):
+    future, function, args = job
+    try:
+        result = function(*args)
+    except:
+        exc_info = sys.exc_info()
+        future._set(None, exc_info)
+        if not isinstance(exc_info[1], Exception):
+            # see WorkerPool._work()
+            raise exc_info[0], exc_info[1], exc_info[2]
+    else:
+        future._set(result, None)
+
+_async_pool = None
+_async_pool_lock = _threading.Lock()
+
+def call_async(function, *args):
+    """Call function(*args) in another thread; return a Future for the result.
+
+    Calls share one WorkerPool of at most MAX_ASYNC_WORKERS threads.
+
+    """
+    global _async_pool
+    _async_pool_lock.acquire()
+    try:
+        if _async_pool is None:
+            _async_pool = WorkerPool(_run_call, [], MAX_ASYNC_WORKERS,
+                                     keep_results=False)
+    finally:
+        _async_pool_lock.release()
+    future = Future()
+    _async_pool.add((future, function, args))
+    return future
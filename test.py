@@ -105,7 +105,7 @@ if __name__ == "__main__":
 
         # run doctests in docstrings
         from mechanize import _headersutil, _auth, _clientcookie, _pullparser, \
-             _http, _rfc3986, _useragent
+             _http, _rfc3986, _useragent, _httpcache
         doctest.testmod(_headersutil)
         doctest.testmod(_rfc3986)
         doctest.testmod(_auth)
@@ -113,6 +113,7 @@ if __name__ == "__main__":
         doctest.testmod(_pullparser)
         doctest.testmod(_http)
         doctest.testmod(_useragent)
+        doctest.testmod(_httpcache)
 
     if run_unittests:
         # run vanilla unittest tests
@@ -248,6 +248,71 @@ class BrowserTests(TestCase):
                      ):
             self.assert_(getattr(b, attr) is None)
 
+    def test_history_limits(self):
+        import mechanize
+        from mechanize import _response
+
+        class Handler(mechanize.BaseHandler):
+            def __init__(self):
+                self.nr_fetches = 0
+            def http_open(self, request):
+                self.nr_fetches += 1
+                url = request.get_full_url()
+                r = _response.test_response(data=url*100, url=url)
+                r.get_data()
+                return r
+
+        def browse(history, responses=None):
+            handler = Handler()
+            b = TestBrowser2(history=history)
+            b.add_handler(handler)
+            for path in "abcd":
+                r = b.open("http://example.com/%s" % path)
+                if responses is not None:
+                    responses.append(r)
+            return b, handler
+
+        # depth
+        b, handler = browse(mechanize.History(max_entries=2))
+        self.assertEqual(b.back().geturl(), "http://example.com/c")
+        self.assertEqual(b.back().geturl(), "http://example.com/b")
+        self.assertRaises(mechanize.BrowserStateError, b.back)
+        self.assertEqual(handler.nr_fetches, 4)
+
+        # byte budget, evicted data dropped: room for two pages' data
+        size = len("http://example.com/a"*100)
+        responses = []
+        b, handler = browse(mechanize.History(max_bytes=2*size), responses)
+        # responses the caller still holds are not closed by eviction
+        responses[0].seek(0)
+        self.assertEqual(responses[0].read(), "http://example.com/a"*100)
+        self.assertEqual(b.back().read(), "http://example.com/c"*100)
+        self.assertEqual(b.back().read(), "http://example.com/b"*100)
+        self.assertEqual(handler.nr_fetches, 4)
+        r = b.back()  # reloaded
+        self.assertEqual(handler.nr_fetches, 5)
+        self.assertEqual(r.read(), "http://example.com/a"*100)
+        self.assertEqual(b.geturl(), "http://example.com/a")
+        self.assertRaises(mechanize.BrowserStateError, b.back)
+        # going back uncounts the popped responses
+        self.assertEqual(b._history._nr_bytes, 0)
+
+        # byte budget, evicted data spooled to disk
+        history = mechanize.History(max_bytes=2*size, spool=True)
+        b, handler = browse(history)
+        self.assertEqual(
+            [response.memory_size() for request, response in
+             history._history], [0, size, size])
+        b.back(2)
+        self.assertEqual(b.back().read(), "http://example.com/a"*100)
+        self.assertEqual(handler.nr_fetches, 4)
+
+        # .clear_history() and .reload() are unaffected
+        b, handler = browse(mechanize.History(max_entries=1, max_bytes=0))
+        self.assertEqual(b.reload().read(), "http://example.com/d"*100)
+        b.clear_history()
+        self.assertRaises(mechanize.BrowserStateError, b.back)
+
     def test_reload_read_incomplete(self):
         import mechanize
         from mechanize._response import test_response
@@ -623,6 +688,66 @@ class BrowserTests(TestCase):
                  attrs=[("name", "name2"), ("href", "href"), ("src", "src")]),
             ])
 
+    def test_find_link_early_exit(self):
+        # tag, url and url_regex are handed to the links factory, which finds
+        # matching links without parsing the whole document
+        import mechanize
+        url = "http://example.com/"
+        html = """\
+<a href="one">One<a href="nested">nested</a>
+<frame src="one"><a href="two"><img alt="Two"></a>
+<base href="http://example.com/base/">
+<a href="two" name="second">Second <b>two</b></a>
+<a href="three">Three</a>
+""" + "<p>padding</p>\n"*1000 + """\
+<form action="/form"><input name="spam"></form>
+<a href="four">Four"""
+        def open_page():
+            b = TestBrowser()
+            # seekable, as responses from a non-test Browser are
+            r = mechanize.make_response(
+                html, [("Content-Type", "text/html")], url, 200, "OK")
+            b.add_handler(make_mock_handler()([("http_open", r)]))
+            b.open(url)
+            return b
+        all_links = list(open_page().links())
+        self.assertEqual([link.url for link in all_links],
+                         ["one", "one", "two", "two", "three", "four"])
+        for kwds in [
+            dict(url="two"),
+            dict(url="two", nr=1),
+            dict(url_regex="t"),
+            dict(url_regex=re.compile("^t"), nr=2),
+            dict(tag="frame"),
+            dict(tag="a", text="Second two"),
+            dict(tag="a", url="one", name_regex="."),
+            dict(tag="iframe"),
+            dict(url="four"),
+            ]:
+            b = open_page()
+            try:
+                link = b.find_link(**kwds)
+            except mechanize.LinkNotFoundError:
+                link = None
+            else:
+                if link.url != "four":
+                    # found without parsing the rest of the document
+                    self.assert_(b._factory._forms_factory._forms is None)
+            # the same parser carries on where find_link() stopped
+            links = list(b.links(**kwds))
+            self.assertEqual(links, list(b._filter_links(**kwds)))
+            self.assertEqual(list(b.links()), all_links)
+            self.assertEqual([form.action for form in b.forms()],
+                             ["http://example.com/form"])
+            if link is None:
+                self.assertEqual(links, [])
+            else:
+                self.assertEqual(link, links[0])
+                self.assert_(link in all_links)
+                self.assertEqual(
+                    link.base_url,
+                    all_links[all_links.index(link)].base_url)
+
     def test_base_uri(self):
         import mechanize
         url = "http://example.com/"
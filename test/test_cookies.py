@@ -183,6 +183,19 @@ class CookieJarInterfaceTests(TestCase):
         request = StubRequest(dict(unverifiable=False))
         self.assertEquals(request_is_unverifiable(request), False)
 
+    def test_pickle_and_copy(self):
+        import copy, pickle
+        from mechanize import CookieJar
+        jar = CookieJar()
+        interact_netscape(jar, "http://example.com/", "spam=eggs")
+        for jar2 in [copy.deepcopy(jar), pickle.loads(pickle.dumps(jar))]:
+            self.assert_(jar2._cookies_lock is not jar._cookies_lock)
+            self.assertEquals([(c.name, c.value) for c in jar2],
+                              [("spam", "eggs")])
+            interact_netscape(jar2, "http://example.com/", "foo=bar")
+            self.assertEquals(len(jar2), 2)
+        self.assertEquals(len(jar), 1)
+
 
 class CookieTests(TestCase):
     # XXX
@@ -434,6 +447,55 @@ class CookieTests(TestCase):
 
         # XXX RFC 2965 expiry rules (some apply to V0 too)
 
+    def test_len_and_expiry_tracking(self):
+        from mechanize import Cookie, CookieJar, Request
+
+        def make_cookie(domain, path, name, expires=None):
+            return Cookie(0, name, "v", None, False, domain, False, False,
+                          path, False, False, expires, expires is None, None,
+                          None, {})
+        c = CookieJar()
+        future = time.time() + 3600
+        for ii in range(10):
+            c.set_cookie(make_cookie("example.com", "/", "n%d" % ii, future))
+            c.set_cookie(make_cookie("example.com", "/p", "n%d" % ii))
+            c.set_cookie(make_cookie("example.net", "/", "n%d" % ii))
+        self.assertEqual(len(c), 30)
+        # replacing a cookie doesn't change the count, and doesn't let the
+        # expiry heap grow without limit
+        for ii in range(1000):
+            c.set_cookie(make_cookie("example.com", "/", "n0", future+ii))
+        self.assertEqual(len(c), 30)
+        self.assert_(len(c._expiry_heap) < 200)
+        c.clear("example.com", "/", "n1")
+        self.assertEqual(len(c), 29)
+        c.clear("example.com", "/p")
+        self.assertEqual(len(c), 19)
+        c.clear("example.net")
+        self.assertEqual(len(c), 9)
+
+        # expired cookies are removed by .add_cookie_header() and
+        # .extract_cookies() ...
+        c.set_cookie(make_cookie("example.org", "/", "old", time.time()-1))
+        c.set_cookie(make_cookie("example.org", "/", "older", time.time()-2))
+        self.assertEqual(len(c), 11)
+        c.add_cookie_header(Request("http://example.com/"))
+        self.assertEqual(len(c), 9)
+        c.set_cookie(make_cookie("example.org", "/", "old", time.time()-1))
+        interact_netscape(c, "http://example.com/")
+        self.assertEqual(len(c), 9)
+        # ... but not cookies whose expiry date has since been changed
+        c.set_cookie(make_cookie("example.org", "/", "old", time.time()-1))
+        c.set_cookie(make_cookie("example.org", "/", "old", future))
+        c.clear_expired_cookies()
+        self.assertEqual(len(c), 10)
+        self.assertEqual([cookie.name for cookie in c if cookie.name == "old"],
+                         ["old"])
+
+        c.clear()
+        self.assertEqual(len(c), 0)
+        self.assertEqual(list(c), [])
+
     def test_default_path(self):
         from mechanize import CookieJar, DefaultCookiePolicy
 
@@ -1072,6 +1134,59 @@ class CookieTests(TestCase):
                           ["longer", "short"])
 
 
+    def test_cookies_for_request_domain_lookup(self):
+        # only domains that might match are looked at, but with the same
+        # results as checking every domain
+        from mechanize import CookieJar, DefaultCookiePolicy, Request
+
+        class CountingPolicy(DefaultCookiePolicy):
+            def __init__(self, *args, **kwds):
+                DefaultCookiePolicy.__init__(self, *args, **kwds)
+                self.checked = []
+            def return_ok(self, cookie, request):
+                self.checked.append(cookie.domain)
+                return DefaultCookiePolicy.return_ok(self, cookie, request)
+        class OverridingPolicy(DefaultCookiePolicy):
+            # overriding .domain_return_ok() means every domain is checked
+            def domain_return_ok(self, domain, request):
+                self.checked.append(domain)
+                return DefaultCookiePolicy.domain_return_ok(
+                    self, domain, request)
+
+        def names(cookiejar, url):
+            cookies = cookiejar.cookies_for_request(Request(url))
+            names = [cookie.name for cookie in cookies]
+            names.sort()
+            return names
+
+        pol = CountingPolicy(blocked_domains=["blocked.example.com"])
+        cj = CookieJar(pol)
+        for ii in range(100):
+            interact_netscape(cj, "http://www%d.example.net/" % ii, "a=b")
+        interact_netscape(cj, "http://www.example.com/",
+                          "host=1", "dom=1; domain=.example.com")
+        interact_netscape(cj, "http://blocked.example.com/", "blocked=1")
+        interact_netscape(cj, "http://foo/", "intranet=1")
+        del pol.checked[:]
+
+        self.assertEqual(names(cj, "http://www.example.com/"), ["dom", "host"])
+        self.assertEqual(names(cj, "http://WWW.Example.com/"), ["dom", "host"])
+        self.assertEqual(names(cj, "http://other.example.com/"), ["dom"])
+        self.assertEqual(names(cj, "http://blocked.example.com/"), ["dom"])
+        self.assertEqual(names(cj, "http://example.com/"), ["dom"])
+        self.assertEqual(names(cj, "http://example.org/"), [])
+        self.assertEqual(names(cj, "http://foo/"), ["intranet"])
+        self.assertEqual(names(cj, "http://www7.example.net/"), ["a"])
+        self.assert_("www8.example.net" not in pol.checked)
+        self.assert_(len(pol.checked) < 10)
+
+        pol = OverridingPolicy()
+        pol.checked = []
+        cj.set_policy(pol)
+        self.assertEqual(names(cj, "http://www7.example.net/"), ["a"])
+        self.assertEqual(len(pol.checked), len(cj._cookies))
+
+
 class CookieJarPersistenceTests(TempfileTestMixin, TestCase):
 
     def _interact(self, cj):
@@ -1207,6 +1322,87 @@ class CookieJarPersistenceTests(TempfileTestMixin, TestCase):
             self.assertEquals(request.get_header("Cookie"),
                               "fooa=bar; foob=bar")
 
+    def test_firefox3_cookiejar_flush_interval(self):
+        try:
+            from mechanize import Firefox3CookieJar
+        except ImportError:
+            pass
+        else:
+            import sqlite3
+            from mechanize import Request
+            filename = self.mktemp()
+            hide_experimental_warnings()
+            try:
+                cj = Firefox3CookieJar(filename, flush_interval=60)
+            finally:
+                reset_experimental_warnings()
+            now = [1000.]
+            cj._time = lambda: now[0]
+            cj.flush()
+            def nr_committed():
+                conn = sqlite3.connect(filename, timeout=0)
+                try:
+                    return conn.execute(
+                        "SELECT COUNT(*) FROM moz_cookies").fetchone()[0]
+                finally:
+                    conn.close()
+
+            year_plus_one = localtime(time.time())[0] + 1
+            expires = "expires=09-Nov-%d 23:12:40 GMT" % (year_plus_one,)
+            interact_netscape(cj, "http://www.foo.com/",
+                              "fooa=bar; %s" % expires)
+            interact_netscape(cj, "http://www.foo.com/sub/",
+                              "foob=bar; %s" % expires,
+                              "fooc=bar; path=/other; %s" % expires)
+            # changes are visible to the cookiejar itself...
+            self.assertEqual(len(cj), 3)
+            request = Request("http://www.foo.com/sub/")
+            cj.add_cookie_header(request)
+            self.assertEquals(request.get_header("Cookie"),
+                              "foob=bar; fooa=bar")
+            # ...but not yet committed
+            self.assertEqual(nr_committed(), 0)
+            # the first change after flush_interval has passed commits
+            now[0] += 60
+            interact_netscape(cj, "http://www.bar.com/",
+                              "bar=baz; %s" % expires)
+            self.assertEqual(nr_committed(), 4)
+            cj.flush()
+            self.assertEqual(nr_committed(), 4)
+            interact_netscape(cj, "http://www.bar.com/",
+                              "bar2=baz; %s" % expires)
+            self.assertEqual(nr_committed(), 4)
+            cj.close()
+            self.assertEqual(nr_committed(), 5)
+
+    def test_firefox3_cookiejar_expire_interval(self):
+        try:
+            from mechanize import Firefox3CookieJar
+        except ImportError:
+            pass
+        else:
+            filename = self.mktemp()
+            hide_experimental_warnings()
+            try:
+                cj = Firefox3CookieJar(filename, expire_interval=60)
+            finally:
+                reset_experimental_warnings()
+            year_plus_one = localtime(time.time())[0] + 1
+            interact_netscape(
+                cj, "http://www.foo.com/",
+                "a=b; expires=09-Nov-%d 23:12:40 GMT" % year_plus_one,
+                "c=d; expires=09-Nov-%d 23:12:50 GMT" % year_plus_one)
+            expiries = [cookie.expires for cookie in cj]
+            expiries.sort()
+            cj._last_expire = None
+            cj._expire_cookies(expiries[0])
+            self.assertEqual(len(cj), 1)
+            # expired rows are only deleted every expire_interval seconds
+            cj._expire_cookies(expiries[1])
+            self.assertEqual(len(cj), 1)
+            cj._expire_cookies(expiries[0] + 60)
+            self.assertEqual(len(cj), 0)
+
     def test_mozilla_cookiejar(self):
         # Save / load Mozilla/Netscape cookie file format.
         from mechanize import MozillaCookieJar, DefaultCookiePolicy
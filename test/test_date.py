@@ -55,6 +55,8 @@ class DateTimeTests(TestCase):
          '03-Feb-1994',  # broken rfc850 HTTP format (no weekday, no time)
          '03 Feb 1994',  # proposed new HTTP format (no weekday, no time)
 
+         'Thu Feb  3 00:00:00 1994',  # ANSI C asctime() format
+
          # A few tests with extra space at various places
          '  03   Feb   1994  0:00  ',
          '  03-Feb-1994  ',
@@ -74,6 +76,18 @@ class DateTimeTests(TestCase):
             assert t == t2 == t3 == test_t, \
                    "'%s'  =>  %s, %s, %s (%s)" % (s, t, t2, t3, test_t)
 
+    def test_http2time_cache(self):
+        from mechanize import _util
+        text = "Thu, 03 Feb 1994 00:00:00 GMT"
+        self.assertEqual(_util.http2time(text), 760233600)
+        self.assert_(text in _util._http2time_cache)
+        for ii in range(_util._http2time_cache.max_size):
+            _util.http2time("%d Feb 1994" % ii)
+        self.assert_(text not in _util._http2time_cache)
+        self.assertEqual(_util.http2time(text), 760233600)
+        self.assertEqual(_util.http2time("Garbage"), None)
+        self.assertEqual(_util.http2time("Garbage"), None)
+
     def test_http2time_garbage(self):
         from mechanize._util import http2time
 
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import copy
 from unittest import TestCase
 
 import mechanize
@@ -24,6 +25,34 @@ class RegressionTests(TestCase):
             br.set_response(response)
             list(br.links())
 
+    def test_bad_forms(self):
+        # form markup ClientForm rejects used to break .title() and .links()
+        # too, when they came from the same parse as the forms
+        for bad in ["<form><form></form></form>",
+                    "<option>x</option>",
+                    "<textarea><textarea></textarea></textarea>",
+                    ]:
+            html = ("<html><head><title>Title</title></head><body>"
+                    "<a href='one'>One</a>%s<a href='two'>Two</a>"
+                    "</body></html>" % bad)
+            br = mechanize.Browser()
+            br.set_response(test_html_response(html))
+            self.assertEqual(br.find_link(url="two").text, "Two")
+            self.assertEqual(br.title(), "Title")
+            self.assertEqual([link.url for link in br.links()],
+                             ["one", "two"])
+            self.assertRaises(mechanize.ParseError, br.forms)
+            self.assertRaises(mechanize.ParseError, br.forms)
+            self.assertEqual(br.title(), "Title")
+            # the document is parsed once only
+            factory = mechanize.DocumentFactory()
+            response = test_html_response(html)
+            factory.set_response(response, response.geturl(), "latin-1")
+            self.assertEqual(len(list(factory.links())), 2)
+            self.assertRaises(mechanize.ParseError, factory.forms)
+            self.assertRaises(mechanize.ParseError, factory.forms)
+            self.assertEqual(factory.title(), "Title")
+
 
 class CachingGeneratorFunctionTests(TestCase):
 
@@ -65,6 +94,178 @@ class CachingGeneratorFunctionTests(TestCase):
         self.assertRaises(StopIteration, cgen2.next)
 
 
+class FactoryTests(TestCase):
+
+    def test_links_filters(self):
+        from mechanize._html import Factory
+        class LinksFactory:
+            def __init__(self):
+                self.calls = []
+            def set_response(self, response, base_url, encoding):
+                pass
+            def links(self, *args, **kwds):
+                self.calls.append((args, kwds))
+                if args or kwds:
+                    raise TypeError("unexpected arguments")
+                return iter([])
+        links_factory = LinksFactory()
+        factory = Factory(None, links_factory, None)
+        factory.set_response(test_html_response(""))
+        # arguments only passed on if the factory says it wants them
+        self.assertEqual(list(factory.links(tag="a")), [])
+        self.assertEqual(links_factory.calls, [((), {})])
+        links_factory.filters_links = True
+        factory.set_response(test_html_response(""))
+        self.assertRaises(TypeError, factory.links, tag="a")
+
+
+class LinkTests(TestCase):
+
+    def test_absolute_url(self):
+        link = mechanize.Link("http://example.com/foo/", "bar", "text", "a",
+                              [("href", "bar")])
+        self.assertEqual(link.absolute_url, "http://example.com/foo/bar")
+        link.absolute_url = "http://example.com/spam"
+        self.assertEqual(link.absolute_url, "http://example.com/spam")
+
+    def test_compact(self):
+        from mechanize._pullparser import Token
+        link = mechanize.Link("http://example.com/", "bar", None, "a", [])
+        token = Token("starttag", "a", [])
+        for obj in link, token:
+            self.assert_(not hasattr(obj, "__dict__"))
+            self.assertRaises(AttributeError, setattr, obj, "spam", "eggs")
+
+    def test_pickle(self):
+        import pickle
+        from mechanize._pullparser import Token
+        link = mechanize.Link("http://example.com/", "bar", "text", "a",
+                              [("href", "bar")])
+        token = Token("starttag", "a", [("href", "bar")])
+        for protocol in range(pickle.HIGHEST_PROTOCOL+1):
+            link2 = pickle.loads(pickle.dumps(link, protocol))
+            self.assertEqual(link2, link)
+            self.assertEqual(link2.base_url, link.base_url)
+            self.assertEqual(link2.absolute_url, "http://example.com/bar")
+            self.assertEqual(pickle.loads(pickle.dumps(token, protocol)),
+                             token)
+
+
+class ContentInfoTests(TestCase):
+
+    def test_encoding(self):
+        from mechanize._sniff import content_info
+        ct = ("Content-Type", "text/html")
+        utf8_ct = ("Content-Type", "text/html; charset=utf-8")
+        for data, headers, expected in [
+            ("", [ct], "default"),
+            ("", [utf8_ct], "utf-8"),
+            ("\xef\xbb\xbf<html>", [ct], "utf-8"),
+            ("\xff\xfe<\x00h\x00", [ct], "utf-16-le"),
+            ('<meta charset="koi8-r">', [ct], "koi8-r"),
+            ('<META HTTP-EQUIV="Content-Type" '
+             'CONTENT="text/html; charset=koi8-r">', [ct], "koi8-r"),
+            ('<meta charset="no-such-charset">', [ct], "default"),
+            # HTTP header wins
+            ('<meta charset="koi8-r">', [utf8_ct], "utf-8"),
+            # not HTML: body not examined
+            ('<meta charset="koi8-r">', [("Content-Type", "image/png")],
+             "default"),
+            # META charset beyond the sniffed prefix
+            (" "*2000 + '<meta charset="koi8-r">', [ct], "default"),
+            ]:
+            r = test_html_response(data, headers)
+            self.assertEqual(content_info(r).encoding("default"), expected)
+
+    def test_cached(self):
+        from mechanize._sniff import content_info
+        r = test_html_response('<meta charset="koi8-r">')
+        info = content_info(r)
+        self.assertEqual(info.meta_charset, "koi8-r")
+        self.assertEqual(r.tell(), 0)
+        r.read(5)
+        self.assert_(content_info(copy.copy(r)) is info)
+        self.assertEqual(r.tell(), 5)
+        # new body, so sniffed again
+        r.set_data('<meta charset="utf-8">')
+        self.assertEqual(content_info(r).meta_charset, "utf-8")
+
+    def test_http_equiv(self):
+        from mechanize._sniff import content_info
+        r = test_html_response(
+            '<html><head><meta http-equiv="Content-Type" '
+            'content="text/html; charset=koi8-r"></head></html>',
+            [("Content-Type", "text/html")])
+        info = content_info(r)
+        r = mechanize.HTTPEquivProcessor().http_response(None, r)
+        self.assert_(content_info(r) is info)
+        self.assertEqual(info.charset, "koi8-r")
+
+
+class RobustFactoryTests(TestCase):
+
+    html = """\
+<html><head><title>  The &amp; <b>title</b>
+</title><base href="http://example.com/base/"></head><body>
+<p><a href="one?a=1&amp;b=2">One <i>two</b> &mdash; three</a>
+<table><tr><td><a href=two>Two</a>
+<frame src=frame></frame>
+<iframe src=iframe>x</iframe><a href="">skipped</a>
+</body></html>
+"""
+
+    def _tree_builders(self):
+        from mechanize import _html
+        builders = [_html.SoupTreeBuilder()]
+        if _html.lxml is not None:
+            builders.append(_html.LxmlTreeBuilder())
+        return builders
+
+    def test_lazy(self):
+        class Builder:
+            def __init__(self):
+                self.nr_builds = 0
+                self.builder = mechanize._html.SoupTreeBuilder()
+            def build(self, data, encoding):
+                self.nr_builds += 1
+                return self.builder.build(data, encoding)
+        builder = Builder()
+        factory = mechanize.RobustFactory(tree_builder=builder)
+        response = test_html_response(self.html)
+        factory.set_response(response)
+        self.assertEqual(factory.is_html, True)
+        self.assertEqual(builder.nr_builds, 0)
+        self.assertEqual(response.tell(), 0)
+        self.assertEqual(factory.title, "The & <b>title</b>")
+        self.assertEqual(len(list(factory.links())), 4)
+        self.assertEqual(builder.nr_builds, 1)
+
+    def test_tree_builders(self):
+        expected_links = [
+            ("one?a=1&b=2", "One two \xe2\x80\x94 three", "a"),
+            ("two", "Two", "a"),
+            ("frame", None, "frame"),
+            ("iframe", "x", "iframe"),
+            ]
+        for builder in self._tree_builders():
+            factory = mechanize.RobustFactory(tree_builder=builder)
+            factory.set_response(test_html_response(
+                self.html, [("Content-Type", "text/html; charset=utf-8")]))
+            links = list(factory.links())
+            self.assertEqual([(link.url, link.text, link.tag)
+                              for link in links], expected_links)
+            for link in links:
+                self.assertEqual(link.base_url, "http://example.com/base/")
+            self.assertEqual(factory.title, "The & <b>title</b>")
+
+    def test_empty(self):
+        for builder in self._tree_builders():
+            factory = mechanize.RobustFactory(tree_builder=builder)
+            factory.set_response(test_html_response(""))
+            self.assertEqual(list(factory.links()), [])
+            self.assertEqual(factory.title, None)
+
+
 class UnescapeTests(TestCase):
 
     def test_unescape_charref(self):
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-import os, math, stat
+import os, math, re, socket, stat, tempfile
 from unittest import TestCase
 
 import mechanize
@@ -18,8 +18,200 @@ def killfile(filename):
             except OSError:
                 pass
 
+class BrokenResponse:
+    # response whose connection fails after nr_bytes bytes of body
+    def __init__(self, response, nr_bytes):
+        self._response = response
+        self._left = nr_bytes
+        self.code = response.code
+    def read(self, size=-1):
+        if self._left <= 0:
+            raise socket.error("connection reset by peer")
+        if size == -1 or size > self._left:
+            size = self._left
+        data = self._response.read(size)
+        self._left -= len(data)
+        return data
+    def info(self): return self._response.info()
+    def geturl(self): return self._response.geturl()
+    def close(self): self._response.close()
+
+
+class RangeOpener(mechanize.OpenerDirector):
+    # serves .data, honouring Range and If-Range headers; the first
+    # len(.break_after) responses fail after the given numbers of bytes
+    def __init__(self, data, validator_header=("ETag", '"abc"')):
+        mechanize.OpenerDirector.__init__(self)
+        self.data = data
+        self.validator_header = validator_header
+        self.break_after = []
+        self.calls = []
+
+    def open(self, fullurl, data=None,
+             timeout=_sockettimeout._GLOBAL_DEFAULT_TIMEOUT):
+        from mechanize import _response
+        self.calls.append(fullurl)
+        headers = [("Accept-Ranges", "bytes"),
+                   ("Date", "Tue, 15 Nov 1994 13:00:00 GMT")]
+        if self.validator_header is not None:
+            headers.append(self.validator_header)
+            validator = self.validator_header[1]
+        else:
+            validator = None
+        byte_range = None
+        if not isinstance(fullurl, basestring):
+            byte_range = fullurl.get_header("Range")
+            if fullurl.get_header("If-range") != validator:
+                byte_range = None
+        if byte_range is None:
+            body, code = self.data, 200
+        else:
+            start, end = re.match(r"bytes=(\d+)-(\d*)$", byte_range).groups()
+            start = int(start)
+            if end:
+                end = int(end) + 1
+            else:
+                end = len(self.data)
+            body, code = self.data[start:end], 206
+            headers.append(("Content-Range", "bytes %d-%d/%d" % (
+                        start, end-1, len(self.data))))
+        headers.append(("Content-Length", str(len(body))))
+        response = _response.test_response(body, headers, code=code)
+        if self.break_after:
+            response = BrokenResponse(response, self.break_after.pop(0))
+        return response
+
+
 class OpenerTests(TestCase):
 
+    def _retrieve(self, op, **kwds):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            op.retrieve("http://example.com/", filename, **kwds)
+            return open(filename, "rb").read()
+        finally:
+            killfile(filename)
+
+    def test_retrieve_resume(self):
+        data = "".join([chr(ii % 256) for ii in range(50000)])
+        for validator_header in [("ETag", '"abc"'),
+                                 ("Last-Modified",
+                                  "Tue, 15 Nov 1994 12:45:26 GMT")]:
+            op = RangeOpener(data, validator_header)
+            op.break_after = [10000, 20000]
+            blocks = []
+            def reporthook(blocknum, bs, size):
+                blocks.append(blocknum)
+            self.assertEqual(self._retrieve(op, reporthook=reporthook), data)
+            self.assertEqual(len(op.calls), 3)
+            self.assertEqual(op.calls[1].get_header("Range"), "bytes=10000-49999")
+            self.assertEqual(op.calls[1].get_header("If-range"),
+                             validator_header[1])
+            self.assertEqual(op.calls[2].get_header("Range"), "bytes=30000-49999")
+            self.assertEqual(blocks, range(len(blocks)))
+
+        # too many failures
+        op = RangeOpener(data)
+        op.break_after = [10000, 10, 10]
+        self.assertRaises(socket.error,
+                          self._retrieve, op, resume_attempts=2)
+        self.assertEqual(len(op.calls), 3)
+        # no validator: no resume
+        op = RangeOpener(data, None)
+        op.break_after = [10000]
+        self.assertRaises(socket.error, self._retrieve, op)
+        self.assertEqual(len(op.calls), 1)
+        # weak ETags can't be used with If-Range, nor can a Last-Modified
+        # date less than a minute older than Date
+        for validator_header in [("ETag", 'W/"abc"'),
+                                 ("Last-Modified",
+                                  "Tue, 15 Nov 1994 12:59:30 GMT")]:
+            op = RangeOpener(data, validator_header)
+            op.break_after = [10000]
+            self.assertRaises(socket.error, self._retrieve, op)
+            self.assertEqual(len(op.calls), 1)
+        # resource changed: server ignores Range, so the whole body is
+        # fetched again, without retrying the range request
+        class ChangingOpener(RangeOpener):
+            def open(self, *args, **kwds):
+                response = RangeOpener.open(self, *args, **kwds)
+                self.validator_header = ("ETag", '"def"')
+                return response
+        op = ChangingOpener(data)
+        op.break_after = [10000]
+        self.assertEqual(self._retrieve(op, resume_attempts=5), data)
+        self.assertEqual(len(op.calls), 3)
+        self.assertEqual(op.calls[2].get_header("Range"), None)
+
+    def test_retrieve_segments(self):
+        data = "".join([chr(ii % 251) for ii in range(10000)])
+        op = RangeOpener(data)
+        op.LARGE_BLOCK_SIZE = 1024
+        blocks = []
+        def reporthook(blocknum, bs, size):
+            blocks.append(blocknum)
+            self.assertEqual(size, len(data))
+        self.assertEqual(
+            self._retrieve(op, segments=3, reporthook=reporthook), data)
+        ranges = [req.get_header("Range") for req in op.calls[1:]]
+        ranges.sort()
+        self.assertEqual(ranges, ["bytes=3334-6667", "bytes=6668-9999"])
+        blocks.sort()
+        self.assertEqual(blocks, range(len(blocks)))
+
+        # segments that fail are resumed
+        op = RangeOpener(data)
+        op.LARGE_BLOCK_SIZE = 1024
+        op.break_after = [100, 200, 300]
+        self.assertEqual(self._retrieve(op, segments=3), data)
+        self.assertEqual(len(op.calls), 6)
+
+        # server ignores Range: the whole body is fetched again
+        class NoRangesOpener(RangeOpener):
+            def open(self, fullurl, *args, **kwds):
+                if not isinstance(fullurl, basestring):
+                    fullurl.headers.pop("Range", None)
+                return RangeOpener.open(self, fullurl, *args, **kwds)
+        op = NoRangesOpener(data)
+        op.LARGE_BLOCK_SIZE = 1024
+        self.assertEqual(self._retrieve(op, segments=3), data)
+        self.assertEqual(len(op.calls), 4)
+
+        # no Accept-Ranges: one request
+        op = RangeOpener(data, None)
+        op.LARGE_BLOCK_SIZE = 1024
+        self.assertEqual(self._retrieve(op, segments=3), data)
+        self.assertEqual(len(op.calls), 1)
+
+
+    def test_retrieve_compressed(self):
+        # a .tar.gz sent with Content-Encoding: gzip is saved as it is
+        import gzip
+        from cStringIO import StringIO
+        from mechanize import _response
+        f = StringIO()
+        gzf = gzip.GzipFile(fileobj=f, mode="wb")
+        gzf.write("tar file contents")
+        gzf.close()
+        gzipped = f.getvalue()
+        class Handler(mechanize.BaseHandler):
+            def http_open(self, req):
+                self.req = req
+                return _response.make_response(
+                    gzipped, [("Content-Encoding", "gzip"),
+                              ("Content-Length", str(len(gzipped)))],
+                    req.get_full_url(), 200, "OK")
+        handler = Handler()
+        op = mechanize.OpenerDirector()
+        op.add_handler(handler)
+        op.add_handler(mechanize.HTTPGzipProcessor())
+        self.assertEqual(self._retrieve(op), gzipped)
+        self.assertEqual(handler.req.get_header("Accept-encoding"), "identity")
+        # but .open() decodes
+        self.assertEqual(op.open("http://example.com/").read(),
+                         "tar file contents")
+
     def test_retrieve(self):
         # The .retrieve() method deals with a number of different cases.  In
         # each case, .read() should be called the expected number of times, the
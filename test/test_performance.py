@@ -40,19 +40,284 @@ def time_retrieve_local_file(temp_maker, size, retrieve_fn):
 
 class PerformanceTests(TestCase):
 
-    def test_retrieve_local_file(self):
+    def _test_retrieve_local_file(self, make_opener):
         def retrieve(url, filename):
-            br = mechanize.Browser()
-            br.retrieve(url, filename)
+            make_opener().retrieve(url, filename)
         size = 100 * MB
 #         size = 1 * KB
-        desired_rate = 2*MB  # per second
+        # .retrieve() should not cache the response body, so it should run at
+        # close to disk speed
+        desired_rate = 100*MB  # per second
         desired_time = size / float(desired_rate)
         fudge_factor = 2.
         self.assert_less_than(
             time_retrieve_local_file(self, size, retrieve),
             desired_time * fudge_factor)
 
+    def test_retrieve_local_file(self):
+        self._test_retrieve_local_file(mechanize.Browser)
+
+    def test_retrieve_local_file_useragent(self):
+        self._test_retrieve_local_file(mechanize.UserAgent)
+
+    def test_retrieve_local_file_opener(self):
+        self._test_retrieve_local_file(mechanize.build_opener)
+
+    def test_fast_pull_parser(self):
+        from mechanize._pullparser import \
+             PullParser, TolerantPullParser, FastPullParser
+        data = make_html(2 * MB)
+        fast = time_pull_parser(FastPullParser, data)
+        for parser_class in PullParser, TolerantPullParser:
+            self.assert_less_than(fast, time_pull_parser(parser_class, data))
+
+    def test_tree_builders(self):
+        from mechanize import _html
+        if _html.lxml is None:
+            return
+        data = make_malformed_html(200 * KB)
+        lxml_time = time_tree_builder(_html.LxmlTreeBuilder(), data)
+        soup_time = time_tree_builder(_html.SoupTreeBuilder(), data)
+        self.assert_less_than(lxml_time, soup_time)
+
+    def test_http2time(self):
+        from mechanize import _util
+        dates = COOKIE_DATES * 2000
+        def parse(http2time):
+            def operation():
+                for date in dates:
+                    http2time(date)
+            return operation
+        cached = time_it(parse(_util.http2time))
+        uncached = time_it(parse(_util._http2time))
+        self.assert_less_than(cached, uncached)
+
+    def test_cookie_header_parsing(self):
+        from mechanize._headersutil import \
+             split_header_words, parse_ns_headers
+        ns_hdrs, rfc2965_hdrs = make_cookie_headers(40)
+        self.assertEqual(parse_ns_headers(ns_hdrs),
+                         regex_parse_ns_headers(ns_hdrs))
+        self.assertEqual(split_header_words(rfc2965_hdrs),
+                         regex_split_header_words(rfc2965_hdrs))
+        def parse(split_header_words, parse_ns_headers):
+            def operation():
+                for ii in range(200):
+                    split_header_words(rfc2965_hdrs)
+                    parse_ns_headers(ns_hdrs)
+            return time_it(operation)
+        self.assert_less_than(
+            parse(split_header_words, parse_ns_headers),
+            parse(regex_split_header_words, regex_parse_ns_headers))
+
+    def test_resolve_all(self):
+        from mechanize._rfc3986 import \
+             urljoin, resolve_all, clean_url, URLCleaner
+        base = "http://example.com/dir/page.html"
+        refs = make_link_urls(20000)
+        self.assertEqual(resolve_all(base, refs),
+                         [urljoin(base, ref) for ref in refs])
+        self.assert_less_than(
+            time_it(lambda: resolve_all(base, refs)),
+            time_it(lambda: [urljoin(base, ref) for ref in refs]))
+        self.assert_less_than(
+            time_it(lambda: URLCleaner("utf-8").clean_all(refs)),
+            time_it(lambda: [clean_url(ref, "utf-8") for ref in refs]))
+
+    def test_link_memory(self):
+        # per-link memory on a link-heavy page
+        if not hasattr(sys, "getsizeof"):
+            return  # Python < 2.6
+        from mechanize._html import DocumentFactory
+        nr_links = 20000
+        html = "".join(["<a href='/item/%d'>Item %d</a>\n" % (ii, ii)
+                        for ii in range(nr_links)])
+        response = mechanize.make_response(
+            html, [("Content-Type", "text/html")], "http://example.com/",
+            200, "OK")
+        factory = DocumentFactory()
+        factory.set_response(response, "http://example.com/", "latin-1")
+        links = list(factory.links())
+        self.assertEqual(len(links), nr_links)
+        total = 0
+        for link in links:
+            total += object_size(link)
+        # no per-instance __dict__, no eagerly computed .absolute_url
+        self.assert_less_than(total / float(nr_links), 200)
+
+
+def object_size(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+def make_html(nr_bytes):
+    row = ("<tr><td class=name><a href=\"/item?id=%d&amp;ref=list\">Item %d</a>"
+           "<td>Some &quot;text&quot; &#8212; and more text<br/>"
+           "<!-- comment --><td><img src=\"/img/%d.png\" alt=\"\"></tr>\n")
+    rows = ["<html><head><title>Big page</title>"
+            "<script>var x = 1 < 2 && '</b>';</script></head><body><table>\n"]
+    size = 0
+    i = 0
+    while size < nr_bytes:
+        rows.append(row % (i, i, i))
+        size += len(rows[-1])
+        i += 1
+    rows.append("</table></body></html>\n")
+    return "".join(rows)
+
+# expires= dates seen in real Set-Cookie headers
+COOKIE_DATES = [
+    "Fri, 01-Jan-2038 00:00:01 GMT",
+    "Thu, 01-Jan-1970 00:00:01 GMT",
+    "Thu, 01 Jan 1970 00:00:00 GMT",
+    "Tue, 19 Jan 2038 03:14:07 GMT",
+    "Sun, 17-Jan-2038 19:14:07 GMT",
+    "Wed, 18-Oct-2028 07:03:15 GMT",
+    "Sat, 18 Oct 2031 07:03:15 GMT",
+    "Monday, 19-Oct-26 07:03:15 GMT",
+    "Wednesday, 09-Nov-99 23:12:40 GMT",
+    "Mon, 31-Dec-2035 23:59:59 GMT",
+    "Sun Oct 18 07:03:15 2026",
+    "18-Oct-2027 07:03:15 GMT",
+    ]
+
+def make_link_urls(nr_links):
+    # hrefs as on a big listing page: many repeated, some relative
+    urls = []
+    for ii in range(nr_links):
+        urls.append(["/item?id=%d" % (ii % 1000),
+                     "page%d.html" % ii,
+                     "../img/%d.png" % (ii % 100),
+                     "http://example.com/about",
+                     "#top"][ii % 5])
+    return urls
+
+def make_cookie_headers(nr_cookies):
+    ns_hdrs = []
+    rfc2965_hdrs = []
+    for ii in range(nr_cookies):
+        ns_hdrs.append("session_%d=abc%d; expires=%s; path=/; "
+                       "domain=.example.com; HttpOnly" %
+                       (ii, ii, COOKIE_DATES[ii % len(COOKIE_DATES)]))
+        ns_hdrs.append('pref%d="a b c"; Max-Age=3600; Path=/foo; '
+                       'Version=1; secure' % ii)
+        rfc2965_hdrs.append('c%d="v%d"; Version="1"; Path="/"; '
+                            'Port="80,8080"; Discard' % (ii, ii))
+    return ns_hdrs, rfc2965_hdrs
+
+# mechanize 0.1.x header parsers, which rescan the header for every token
+def regex_split_header_words(header_values):
+    import re
+    from mechanize._headersutil import unmatched
+    token_re = re.compile(r"^\s*([^=\s;,]+)")
+    quoted_value_re = re.compile(r"^\s*=\s*\"([^\"\\]*(?:\\.[^\"\\]*)*)\"")
+    value_re = re.compile(r"^\s*=\s*([^\s;,]*)")
+    escape_re = re.compile(r"\\(.)")
+    result = []
+    for text in header_values:
+        pairs = []
+        while text:
+            m = token_re.search(text)
+            if m:
+                text = unmatched(m)
+                name = m.group(1)
+                m = quoted_value_re.search(text)
+                if m:  # quoted value
+                    text = unmatched(m)
+                    value = m.group(1)
+                    value = escape_re.sub(r"\1", value)
+                else:
+                    m = value_re.search(text)
+                    if m:  # unquoted value
+                        text = unmatched(m)
+                        value = m.group(1)
+                        value = value.rstrip()
+                    else:
+                        # no value, a lone token
+                        value = None
+                pairs.append((name, value))
+            elif text.lstrip().startswith(","):
+                # concatenated headers, as per RFC 2616 section 4.2
+                text = text.lstrip()[1:]
+                if pairs: result.append(pairs)
+                pairs = []
+            else:
+                # skip junk
+                text = re.sub("^[=\s;]*", "", text)
+        if pairs: result.append(pairs)
+    return result
+
+def regex_parse_ns_headers(ns_headers):
+    import re
+    from mechanize._headersutil import strip_quotes
+    from mechanize._util import http2time
+    known_attrs = ("expires", "domain", "path", "secure",
+                   "version", "port", "max-age")
+    result = []
+    for ns_header in ns_headers:
+        pairs = []
+        version_set = False
+        params = re.split(r";\s*", ns_header)
+        for ii in range(len(params)):
+            param = params[ii]
+            param = param.rstrip()
+            if param == "": continue
+            if "=" not in param:
+                k, v = param, None
+            else:
+                k, v = re.split(r"\s*=\s*", param, 1)
+                k = k.lstrip()
+            if ii != 0:
+                lc = k.lower()
+                if lc in known_attrs:
+                    k = lc
+                if k == "version":
+                    v = strip_quotes(v)
+                    version_set = True
+                if k == "expires":
+                    v = http2time(strip_quotes(v))
+            pairs.append((k, v))
+        if pairs:
+            if not version_set:
+                pairs.append(("version", "0"))
+            result.append(pairs)
+    return result
+
+def make_malformed_html(nr_bytes):
+    # unclosed and misnested elements, unquoted and bare attributes, stray
+    # end tags and ampersands, as found in the wild
+    row = ("<tr><td class=name><a href=/item?id=%d&ref=list>Item %d"
+           "<td><font color=red><b>Some <i>text</b></i> & more<p>text"
+           "<td><img src=/img/%d.png alt=''><a name=x%d></font></a></tr>\n")
+    rows = ["<html><head><title>Malformed page</title><body><table>\n"]
+    size = 0
+    i = 0
+    while size < nr_bytes:
+        rows.append(row % (i, i, i, i))
+        size += len(rows[-1])
+        i += 1
+    return "".join(rows)
+
+def time_tree_builder(tree_builder, data):
+    def operation():
+        factory = mechanize.RobustFactory(tree_builder=tree_builder)
+        factory.set_response(mechanize.make_response(
+            data, [("Content-Type", "text/html")], "http://example.com/",
+            200, "OK"))
+        for link in factory.links():
+            pass
+        factory.title
+    return time_it(operation)
+
+def time_pull_parser(parser_class, data):
+    from StringIO import StringIO
+    def operation():
+        for token in parser_class(StringIO(data)).tokens():
+            pass
+    return time_it(operation)
+
 
 def show_plot(rows):
     import matplotlib.pyplot
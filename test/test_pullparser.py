@@ -10,8 +10,10 @@ def peek_token(p):
 
 
 class PullParserTests(TestCase):
-    from mechanize._pullparser import PullParser, TolerantPullParser
-    PARSERS = [(PullParser, False), (TolerantPullParser, True)]
+    from mechanize._pullparser import PullParser, TolerantPullParser, \
+         FastPullParser
+    PARSERS = [(PullParser, False), (TolerantPullParser, True),
+               (FastPullParser, False)]
 
     def data_and_file(self):
         from StringIO import StringIO
@@ -310,6 +312,47 @@ still a comment , blah and a space at the end
             self.assertEquals(token, expected_tokens[i])
         f.close()
 
+    def test_fast_get_token(self):
+        from mechanize._pullparser import FastPullParser
+        self._test_get_token(FastPullParser, False)
+        self._test_tokens(FastPullParser, False)
+
+    def test_fast_chunks(self):
+        # tokens must not depend on where the input is split into chunks
+        from StringIO import StringIO
+        from mechanize._pullparser import FastPullParser
+        data = self.data_and_file()[0] + (
+            '<script>if (a<b && c) x="</a>";\n</script>'
+            "<style>p>a{}</STYLE ><a href='x&amp;y' name=n checked/>&#x4\n"
+            '<a title="a>b" href="/x">')
+        def tokens(chunk):
+            p = FastPullParser(StringIO(data))
+            p.chunk = chunk
+            result = []
+            for token in p.tokens():
+                if (token.type == "data" and result and
+                    result[-1][0] == "data"):
+                    result[-1] = ("data", result[-1][1] + token.data, None)
+                else:
+                    result.append(tuple(token))
+            return result
+        expected = tokens(len(data))
+        self.assertEqual(expected[-10:], [
+            ("starttag", "script", []),
+            ("data", 'if (a<b && c) x="</a>";\n', None),
+            ("endtag", "script", None),
+            ("starttag", "style", []),
+            ("data", "p>a{}", None),
+            ("endtag", "style", None),
+            ("startendtag", "a",
+             [("href", "x&y"), ("name", "n"), ("checked", "checked")]),
+            ("charref", "x4", None),
+            ("data", "\n", None),
+            ("starttag", "a", [("title", "a>b"), ("href", "/x")]),
+            ])
+        for chunk in range(1, 20):
+            self.assertEqual(tokens(chunk), expected)
+
     def test_token_eq(self):
         from mechanize._pullparser import Token
         for (a, b) in [
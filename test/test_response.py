@@ -70,6 +70,70 @@ dog.
         sfh = seek_wrapper(fh)
         self._testCopy(sfh)
 
+    def testSpooledCache(self):
+        # same again, but with a cache that moves to disk almost immediately
+        from mechanize._response import seek_wrapper
+        class spooling_seek_wrapper(seek_wrapper):
+            max_memory_cache = 8
+        text = self.text
+
+        for ii in range(1, 6):
+            fh = TestUnSeekable(text)
+            sfh = spooling_seek_wrapper(fh)
+            test = getattr(self, "_test%d" % ii)
+            test(sfh)
+
+        fh = TestUnSeekable(text)
+        sfh = spooling_seek_wrapper(fh)
+        self._testCopy(sfh)
+
+        fh = TestUnSeekable(text)
+        sfh = spooling_seek_wrapper(fh)
+        cache = sfh._seek_wrapper__cache
+        sfh.read(5)
+        self.assert_(not cache.spooled)
+        sfh.read(5)
+        self.assert_(cache.spooled)
+        # copies share the spooled cache
+        sfh2 = copy.copy(sfh)
+        self.assert_(sfh2._seek_wrapper__cache is cache)
+        self.assertEqual(sfh2.read(), text)
+        sfh.seek(0)
+        self.assertEqual(sfh.readline(), text.splitlines(True)[0])
+        self.assertEqual(sfh.get_data(), text)
+        self.assert_(sfh.invariant())
+
+        # no limit
+        class unlimited_seek_wrapper(seek_wrapper):
+            max_memory_cache = None
+        sfh = unlimited_seek_wrapper(TestUnSeekable(text))
+        sfh.read()
+        self.assert_(not sfh._seek_wrapper__cache.spooled)
+
+    def testReadUncached(self):
+        from mechanize._response import seek_wrapper, read_uncached
+        text = self.text
+        sfh = seek_wrapper(TestUnSeekable(text))
+        self.assertEqual(sfh.read(10), text[:10])
+        sfh.seek(5)
+        # cached data first, then straight from the wrapped file
+        self.assertEqual(read_uncached(sfh, 100), text[5:10])
+        self.assertEqual(read_uncached(sfh, 3), text[10:13])
+        self.assertEqual(len(sfh._seek_wrapper__cache.getvalue()), 10)
+        self.assertEqual(read_uncached(sfh), text[13:])
+        self.assertEqual(read_uncached(sfh, 3), "")
+        self.assert_(sfh.read_complete)
+        self.assertEqual(len(sfh._seek_wrapper__cache.getvalue()), 10)
+
+        sfh = seek_wrapper(seek_wrapper(TestUnSeekable(text)))
+        sfh.wrapped.read(4)
+        sfh.wrapped.seek(2)
+        self.assertEqual(read_uncached(sfh, 4), text[2:4])
+        self.assertEqual(read_uncached(sfh), text[4:])
+        self.assertEqual(len(sfh.wrapped._seek_wrapper__cache.getvalue()), 4)
+        # plain file objects are just read
+        self.assertEqual(read_uncached(TestUnSeekable(text), 4), text[:4])
+
     def _testCopy(self, sfh):
         sfh2 = copy.copy(sfh)
         sfh.read(10)
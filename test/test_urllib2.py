@@ -25,7 +25,7 @@ from mechanize._response import test_response
 from mechanize import HTTPRedirectHandler, HTTPRequestUpgradeProcessor, \
      HTTPEquivProcessor, HTTPRefreshProcessor, SeekableProcessor, \
      HTTPCookieProcessor, HTTPRefererProcessor, \
-     HTTPErrorProcessor, HTTPHandler
+     HTTPErrorProcessor, HTTPHandler, HTTPGzipProcessor
 from mechanize import OpenerDirector, build_opener, urlopen, Request
 from mechanize._util import hide_deprecations, reset_deprecations
 import mechanize._sockettimeout as _sockettimeout
@@ -199,6 +199,31 @@ class OpenerDirectorTests(unittest.TestCase):
         self.assertEqual(list(o.process_response["http"]), [p])
         self.assertEqual(list(o._any_response), [p])
         self.assertEqual(o.handlers, [h, p])
+        # the chains of methods called for each stage are cached until the
+        # handlers change
+        self.assertEqual(o._chain("response", "http"),
+                         (p.any_response, p.http_response))
+        self.assertEqual(o._chain("response", "ftp"), (p.any_response,))
+        self.assertEqual(o._chain("open", "http"), (h.http_open,))
+        self.assert_(o._chain("open", "http") is o._chain("open", "http"))
+        class LaterProcessor(Processor):
+            handler_order = 4
+        p2 = LaterProcessor()
+        o.add_handler(p2)
+        o._maybe_reindex_handlers()
+        self.assertEqual(o._chain("response", "ftp"),
+                         (p.any_response, p2.any_response))
+
+    def test_useragent_handler_removal(self):
+        # removing a handler takes effect on the next request
+        from mechanize import UserAgent
+        ua = UserAgent()
+        ua._maybe_reindex_handlers()
+        robots = ua._ua_handlers["_robots"]
+        self.assert_(robots.http_request in ua._chain("request", "http"))
+        ua.set_handle_robots(False)
+        ua._maybe_reindex_handlers()
+        self.assert_(robots.http_request not in ua._chain("request", "http"))
 
     def test_handler_order(self):
         o = OpenerDirector()
@@ -356,6 +381,25 @@ class OpenerDirectorTests(unittest.TestCase):
                     self.assert_(args[1] is None or
                                  isinstance(args[1], MockResponse))
 
+    def test_process_without_open(self):
+        # request and response processing can be driven separately from the
+        # I/O done by the *_open methods
+        o = OpenerDirector()
+        meth_spec = [
+            [("http_request", "return request"),
+             ("http_response", "return response"),
+             ("http_open", "raise")],
+            ]
+        handlers = add_ordered_mock_handlers(o, meth_spec)
+
+        req = o.preprocess_request(Request("http://example.com/"))
+        self.assertEqual(req.get_full_url(), "http://blah/")
+        self.assertEqual([call[1] for call in o.calls], ["http_request"])
+        o.calls = []
+        response = o.postprocess_response(req, None)
+        self.assert_(isinstance(response, MockResponse))
+        self.assertEqual([call[1] for call in o.calls], ["http_response"])
+
 
 class MockHTTPResponse:
     def __init__(self, fp, msg, status, reason):
@@ -849,6 +893,167 @@ class HandlerTests(unittest.TestCase):
                           "http://example.com/",
                           ])
 
+    def test_robots_precedence(self):
+        try:
+            import robotparser
+        except ImportError:
+            return  # skip test
+        from mechanize import HTTPRobotRulesProcessor
+
+        class RobotsHTTPHandler(mechanize.BaseHandler):
+            def http_open(self, req):
+                url = req.get_full_url()
+                if not url.endswith("/robots.txt"):
+                    return test_response("", [], url)
+                return test_response(
+                    "User-agent: *\nDisallow: /a\nAllow: /a/b\n", [], url)
+
+        # first matching rule wins, as with robotparser...
+        o = build_test_opener(RobotsHTTPHandler(), HTTPRobotRulesProcessor())
+        self.assertRaises(mechanize.RobotExclusionError,
+                          o.open, "http://example.com/a/b")
+        # ...unless RFC 9309 longest-match precedence is asked for
+        o = build_test_opener(RobotsHTTPHandler(),
+                              HTTPRobotRulesProcessor(longest_match=True))
+        o.open("http://example.com/a/b")
+        self.assertRaises(mechanize.RobotExclusionError,
+                          o.open, "http://example.com/a/c")
+
+    def test_robots_cache(self):
+        try:
+            import robotparser
+        except ImportError:
+            return  # skip test
+        import socket
+        from mechanize import HTTPRobotRulesProcessor, RobotRulesCache
+        from mechanize._util import time2netscape
+
+        class RobotsHTTPHandler(mechanize.BaseHandler):
+            def __init__(self):
+                self.robots_requests = []
+                self.headers = {}
+            def http_open(self, req):
+                url = req.get_full_url()
+                if not url.endswith("/robots.txt"):
+                    return test_response("", [], url)
+                self.robots_requests.append(url)
+                if "down" in url:
+                    raise socket.error("connection refused")
+                return test_response("User-agent: *\nDisallow: /private\n",
+                                     self.headers.get(url, []), url)
+
+        now = [1e9]
+        cache = RobotRulesCache(max_hosts=2, ttl=1000, min_ttl=10,
+                                error_ttl=100)
+        cache._time = lambda: now[0]
+        hh = RobotsHTTPHandler()
+        o = build_test_opener(hh, HTTPRobotRulesProcessor(cache=cache))
+        # alternating between hosts doesn't refetch robots.txt
+        for ii in range(2):
+            o.open("http://a.example.com/")
+            o.open("http://b.example.com/")
+        self.assertEqual(hh.robots_requests,
+                         ["http://a.example.com/robots.txt",
+                          "http://b.example.com/robots.txt"])
+        self.assertRaises(mechanize.RobotExclusionError,
+                          o.open, "http://a.example.com/private")
+        # least recently used host is forgotten
+        o.open("http://c.example.com/")
+        o.open("http://a.example.com/")
+        self.assertEqual(len(hh.robots_requests), 3)
+        o.open("http://b.example.com/")
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(len(hh.robots_requests), 4)
+        # shared between processors; expires after ttl
+        o2 = build_test_opener(RobotsHTTPHandler(),
+                               HTTPRobotRulesProcessor(cache=cache))
+        o2.open("http://a.example.com/")
+        self.assertEqual(len(hh.robots_requests), 4)
+        now[0] += 1000
+        o.open("http://a.example.com/")
+        self.assertEqual(len(hh.robots_requests), 5)
+
+        # lifetime from robots.txt response headers, within limits
+        cache.clear()
+        hh.robots_requests = []
+        hh.headers = {
+            "http://a.example.com/robots.txt": [("Cache-Control",
+                                                 "max-age=50")],
+            "http://b.example.com/robots.txt": [
+                    ("Date", time2netscape(now[0])),
+                    ("Expires", time2netscape(now[0] + 5))],
+            }
+        o.open("http://a.example.com/")
+        o.open("http://b.example.com/")
+        now[0] += 20
+        o.open("http://a.example.com/")
+        o.open("http://b.example.com/")
+        self.assertEqual(len(hh.robots_requests), 3)
+        now[0] += 31
+        o.open("http://a.example.com/")
+        self.assertEqual(len(hh.robots_requests), 4)
+
+        # negative caching of unreachable robots.txt
+        cache.clear()
+        hh.robots_requests = []
+        for ii in range(2):
+            try:
+                o.open("http://down.example.com/")
+            except mechanize.RobotExclusionError:
+                pass
+        self.assertEqual(len(hh.robots_requests), 1)
+        now[0] += 100
+        try:
+            o.open("http://down.example.com/")
+        except mechanize.RobotExclusionError:
+            pass
+        self.assertEqual(len(hh.robots_requests), 2)
+
+    def test_robots_crawl_delay(self):
+        try:
+            import robotparser
+        except ImportError:
+            return  # skip test
+        from mechanize import HTTPRobotRulesProcessor, RobotRulesCache
+
+        class RobotsHTTPHandler(mechanize.BaseHandler):
+            def http_open(self, req):
+                url = req.get_full_url()
+                if url.endswith("/robots.txt"):
+                    return test_response("User-agent: *\nCrawl-delay: 10\n",
+                                         [], url)
+                return test_response("", [], url)
+
+        now = [1e9]
+        sleeps = []
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+        cache = RobotRulesCache()
+        cache._time = lambda: now[0]
+        rp = HTTPRobotRulesProcessor(cache=cache, honor_crawl_delay=True,
+                                    max_crawl_delay=7)
+        rp._sleep = sleep
+        rp2 = HTTPRobotRulesProcessor(cache=cache, honor_crawl_delay=True)
+        rp2._sleep = sleep
+        o = build_test_opener(RobotsHTTPHandler(), rp)
+        o2 = build_test_opener(RobotsHTTPHandler(), rp2)
+        o.open("http://example.com/")
+        o.open("http://example.org/")
+        self.assertEqual(sleeps, [])
+        now[0] += 2
+        o.open("http://example.com/")
+        self.assertEqual(sleeps, [5])
+        # delay is shared by processors with the same cache
+        o2.open("http://example.com/")
+        self.assertEqual(sleeps, [5, 7])
+        now[0] += 100
+        o.open("http://example.com/")
+        self.assertEqual(sleeps, [5, 7])
+        rp.honor_crawl_delay = False
+        o.open("http://example.com/")
+        self.assertEqual(sleeps, [5, 7])
+
     def test_cookies(self):
         cj = MockCookieJar()
         h = HTTPCookieProcessor(cj)
@@ -908,6 +1113,96 @@ class HandlerTests(unittest.TestCase):
         self.assertEqual(new_headers.getheaders("Refresh"),
                          ["blah", "spam&eggs"])
 
+    def test_gzip(self):
+        import gzip, zlib
+        from mechanize import _response
+        h = HTTPGzipProcessor()
+        o = h.parent = MockOpener()
+
+        req = Request("http://example.com/")
+        newreq = h.http_request(req)
+        self.assertEqual(newreq.get_header("Accept-encoding"),
+                         "gzip, deflate")
+        req = Request("http://example.com/",
+                      headers={"Accept-encoding": "identity"})
+        newreq = h.http_request(req)
+        self.assertEqual(newreq.get_header("Accept-encoding"), "identity")
+        identity_req = req
+        req = h.http_request(Request("http://example.com/"))
+
+        data = "".join(["line %d\n" % ii for ii in range(5000)])
+        f = StringIO.StringIO()
+        gzf = gzip.GzipFile(fileobj=f, mode="wb")
+        gzf.write(data)
+        gzf.close()
+        gzipped = f.getvalue()
+        deflated = zlib.compress(data)
+        raw_deflated = deflated[2:-4]
+        url = "http://example.com/"
+        for encoding, encoded in [("gzip", gzipped),
+                                  ("x-gzip", gzipped),
+                                  ("deflate", deflated),
+                                  ("Deflate", raw_deflated),
+                                  ]:
+            def make_response():
+                r = _response.make_response(
+                    encoded, [("Content-encoding", encoding)], url, 200, "OK")
+                return h.http_response(req, r)
+            self.assertEqual(make_response().read(), data)
+            # no identity allowed: the body is left alone
+            r = _response.make_response(
+                encoded, [("Content-encoding", encoding)], url, 200, "OK")
+            self.assertEqual(h.http_response(identity_req, r).read(), encoded)
+
+            # data is decoded incrementally
+            newr = make_response()
+            self.assertEqual(newr.read(3), "lin")
+            self.assert_(newr._response.tell() < len(encoded))
+            self.assertEqual(newr.readline(), "e 0\n")
+            self.assertEqual(newr.readline(3), "lin")
+            self.assertEqual(newr.readline(), "e 1\n")
+            self.assertEqual(newr.readlines()[-1], "line 4999\n")
+            self.assertEqual(newr.read(), "")
+            self.assertEqual(newr.readline(), "")
+
+            newr = make_response()
+            self.assertEqual(list(newr), data.splitlines(True))
+            newr = make_response()
+            self.assertEqual(newr.readlines(10), ["line 0\n", "line 1\n"])
+
+            # works with seek_wrapper
+            newr = _response.seek_wrapped_response(make_response())
+            self.assertEqual(newr.readline(), "line 0\n")
+            newr.seek(0)
+            self.assertEqual(newr.read(), data)
+            newr.seek(5)
+            self.assertEqual(newr.readline(), "0\n")
+            self.assertEqual(newr.get_data(), data)
+
+        # headers describe the decoded body
+        r = _response.make_response(
+            zlib.compress(gzipped),
+            [("Content-Length", str(len(gzipped))),
+             ("Content-Encoding", "compress, gzip"),
+             ("Content-Encoding", "deflate"),
+             ("Content-Type", "text/plain"),
+             ("X-Continued", "a\n b")],
+            url, 200, "OK")
+        newr = h.http_response(req, r)
+        self.assertEqual(newr.read(), data)
+        headers = newr.info()
+        self.assertEqual(headers.getheaders("Content-encoding"), ["compress"])
+        self.assert_("Content-length" not in headers)
+        self.assertEqual(headers["Content-type"], "text/plain")
+        self.assertEqual(headers["X-continued"], "a\n b")
+        self.assertEqual(r.info()["Content-encoding"], "deflate")
+
+        # other encodings are left alone
+        for headers in [[], [("Content-encoding", "identity")],
+                        [("Content-encoding", "compress")]]:
+            r = _response.make_response(data, headers, url, 200, "OK")
+            self.assertEqual(h.http_response(req, r).read(), data)
+
     def test_refresh(self):
         # XXX test processor constructor optional args
         h = HTTPRefreshProcessor(max_time=None, honor_time=False)
@@ -1215,6 +1510,481 @@ class HandlerTests(unittest.TestCase):
         self.failIf(http_handler.requests[0].has_header(auth_header))
 
 
+class MockKeepAliveSocket:
+    # Serves a canned sequence of raw HTTP responses, one per .makefile()
+    # call (httplib makes one per response).  .fileno() returns the read end
+    # of a pipe, so that the socket looks idle (not readable) to select()
+    # until .make_readable() is called.
+    def __init__(self, responses):
+        self.responses = responses
+        self.sent = []
+        self.closed = False
+        self.timeouts = []
+        self._read_fd, self._write_fd = os.pipe()
+    def sendall(self, data):
+        self.sent.append(data)
+    def settimeout(self, timeout):
+        self.timeouts.append(timeout)
+    def makefile(self, mode, bufsize=None):
+        return StringIO.StringIO(self.responses.pop(0))
+    def fileno(self):
+        return self._read_fd
+    def make_readable(self):
+        os.write(self._write_fd, "x")
+    def close(self):
+        self.closed = True
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+
+def make_keep_alive_http_class(responses):
+    class MockKeepAliveHTTPConnection(httplib.HTTPConnection):
+        sockets = []
+        def connect(self):
+            self.sock = MockKeepAliveSocket(responses)
+            self.sockets.append(self.sock)
+    return MockKeepAliveHTTPConnection
+
+def keep_alive_response(body, headers=()):
+    lines = ["HTTP/1.1 200 OK", "Content-Length: %d" % len(body)]
+    lines.extend(headers)
+    return "\r\n".join(lines) + "\r\n\r\n" + body
+
+class ConnectionCacheTests(unittest.TestCase):
+
+    def _make_handler(self, cache):
+        h = AbstractHTTPHandler()
+        h.parent = MockOpener()
+        h.set_connection_cache(cache)
+        return h
+
+    def test_reuse(self):
+        cache = mechanize.ConnectionCache()
+        h = self._make_handler(cache)
+        http_class = make_keep_alive_http_class(
+            [keep_alive_response("spam"), keep_alive_response("eggs")])
+        r = h.do_open(http_class, Request("http://example.com/a"))
+        self.assertEqual(r.read(), "spam")
+        self.assertEqual(cache.nr_idle(), 1)
+        r = h.do_open(http_class, Request("http://example.com/b"))
+        self.assertEqual(cache.nr_idle(), 0)
+        self.assertEqual(r.read(), "eggs")
+        self.assertEqual(cache.nr_idle(), 1)
+        self.assertEqual(len(http_class.sockets), 1)
+        sock = http_class.sockets[0]
+        self.assertEqual(len(sock.sent), 2)
+        for request_text in sock.sent:
+            self.assert_("Connection: close" not in request_text)
+        cache.close()
+        self.assert_(sock.closed)
+
+    def test_keys(self):
+        cache = mechanize.ConnectionCache()
+        h = self._make_handler(cache)
+        http_class = make_keep_alive_http_class(
+            [keep_alive_response("spam"), keep_alive_response("eggs")])
+        h.do_open(http_class, Request("http://example.com/")).read()
+        h.do_open(http_class, Request("http://example.com:8080/")).read()
+        self.assertEqual(len(http_class.sockets), 2)
+        self.assertEqual(cache.nr_idle(), 2)
+
+    def test_drain_on_close(self):
+        cache = mechanize.ConnectionCache(max_drain=10)
+        h = self._make_handler(cache)
+        http_class = make_keep_alive_http_class(
+            [keep_alive_response("0123456789"),
+             keep_alive_response("0123456789-"),
+             keep_alive_response("")])
+        # small unread body: drained and connection reused
+        h.do_open(http_class, Request("http://example.com/")).close()
+        self.assertEqual(cache.nr_idle(), 1)
+        # unread body too big to drain: connection discarded
+        h.do_open(http_class, Request("http://example.com/")).close()
+        self.assertEqual(cache.nr_idle(), 0)
+        self.assert_(http_class.sockets[0].closed)
+        h.do_open(http_class, Request("http://example.com/")).read()
+        self.assertEqual(len(http_class.sockets), 2)
+
+    def test_connection_close_not_cached(self):
+        cache = mechanize.ConnectionCache()
+        h = self._make_handler(cache)
+        http_class = make_keep_alive_http_class(
+            [keep_alive_response("spam", ["Connection: close"])])
+        r = h.do_open(http_class, Request("http://example.com/"))
+        self.assertEqual(r.read(), "spam")
+        self.assertEqual(cache.nr_idle(), 0)
+
+    def test_evict_stale(self):
+        cache = mechanize.ConnectionCache(idle_timeout=10)
+        now = [0]
+        cache._time = lambda: now[0]
+        h = self._make_handler(cache)
+        http_class = make_keep_alive_http_class(
+            [keep_alive_response("a"), keep_alive_response("b"),
+             keep_alive_response("c")])
+        h.do_open(http_class, Request("http://example.com/")).read()
+        # server closed idle connection
+        http_class.sockets[0].make_readable()
+        h.do_open(http_class, Request("http://example.com/")).read()
+        self.assertEqual(len(http_class.sockets), 2)
+        self.assert_(http_class.sockets[0].closed)
+        # connection idle for too long
+        now[0] = 11
+        h.do_open(http_class, Request("http://example.com/")).read()
+        self.assertEqual(len(http_class.sockets), 3)
+        self.assert_(http_class.sockets[1].closed)
+
+    def test_max_idle_per_host(self):
+        cache = mechanize.ConnectionCache(max_idle_per_host=1)
+        h = self._make_handler(cache)
+        http_class = make_keep_alive_http_class(
+            [keep_alive_response("a"), keep_alive_response("b")])
+        r1 = h.do_open(http_class, Request("http://example.com/"))
+        r2 = h.do_open(http_class, Request("http://example.com/"))
+        r1.read()
+        r2.read()
+        self.assertEqual(cache.nr_idle(), 1)
+        self.assert_(http_class.sockets[1].closed)
+
+    def test_retry(self):
+        cache = mechanize.ConnectionCache()
+        h = self._make_handler(cache)
+        # server closes the idle connection without the client noticing
+        http_class = make_keep_alive_http_class(
+            [keep_alive_response("a"), "", keep_alive_response("b"),
+             keep_alive_response("c"), ""])
+        h.do_open(http_class, Request("http://example.com/")).read()
+        # GET is retried on a new connection
+        r = h.do_open(http_class, Request("http://example.com/"))
+        self.assertEqual(r.read(), "b")
+        self.assertEqual(len(http_class.sockets), 2)
+        self.assert_(http_class.sockets[0].closed)
+        # POST is not
+        h.do_open(http_class, Request("http://example.com/")).read()
+        self.assertRaises(httplib.HTTPException, h.do_open, http_class,
+                          Request("http://example.com/", "data"))
+        self.assertEqual(len(http_class.sockets), 2)
+
+    def test_reuse_timeout(self):
+        cache = mechanize.ConnectionCache()
+        h = self._make_handler(cache)
+        http_class = make_keep_alive_http_class(
+            [keep_alive_response("a"), keep_alive_response("b")])
+        h.do_open(http_class, Request("http://example.com/", timeout=5.)
+                  ).read()
+        h.do_open(http_class, Request("http://example.com/", timeout=10.)
+                  ).read()
+        self.assertEqual(http_class.sockets[0].timeouts, [10.])
+
+    def test_unreleased_response(self):
+        import gc
+        from mechanize._conncache import connection_releasing_response
+        cache = mechanize.ConnectionCache(max_per_host=1)
+        h = self._make_handler(cache)
+        http_class = make_keep_alive_http_class(
+            [keep_alive_response("a"), keep_alive_response("b")])
+        # response dropped without being read or closed: the connection is
+        # given back rather than blocking the next request forever
+        r = h.do_open(http_class, Request("http://example.com/"))
+        del r
+        gc.collect()
+        r = h.do_open(http_class, Request("http://example.com/"))
+        self.assertEqual(r.read(), "b")
+        self.assertEqual(len(http_class.sockets), 1)
+
+        class Connection:
+            closed = False
+            def close(self): self.closed = True
+        conn, reused = cache.get_connection("key", Connection)
+        r = connection_releasing_response(
+            httplib.HTTPResponse(MockKeepAliveSocket([""])), cache, "key",
+            conn)
+        r.recv = r.read  # reference cycle
+        del r
+        gc.collect()
+        self.assert_(conn.closed)
+        self.assertEqual(cache.get_connection("key", Connection)[1], False)
+
+    def test_useragent(self):
+        cache = mechanize.ConnectionCache()
+        ua = mechanize.UserAgent()
+        ua.set_http_connection_cache(cache)
+        self.assert_(ua._ua_handlers["http"]._connection_cache is cache)
+        ua.set_handled_schemes(["http"])
+        self.assert_(ua._ua_handlers["http"]._connection_cache is cache)
+
+
+class CannedHTTPHandler(mechanize.BaseHandler):
+    # returns the given (code, headers, body) responses in turn
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+    def http_open(self, req):
+        self.requests.append(req)
+        code, headers, body = self.responses.pop(0)
+        return mechanize.make_response(body, headers, req.get_full_url(),
+                                       code, "msg")
+
+class HTTPCacheTests(unittest.TestCase):
+
+    def _make_opener(self, responses, cache=None):
+        if cache is None:
+            cache = mechanize.MemoryResponseCache()
+        ch = mechanize.HTTPCacheHandler(cache)
+        self.now = [1e9]
+        ch._time = lambda: self.now[0]
+        hh = CannedHTTPHandler(responses)
+        return build_test_opener(ch, hh), ch, hh
+
+    def test_fresh_hit(self):
+        o, ch, hh = self._make_opener(
+            [(200, [("Cache-Control", "max-age=60"),
+                    ("Set-Cookie", "spam=eggs")], "data"),
+             (200, [], "new data")])
+        self.assertEqual(o.open("http://example.com/#frag").read(), "data")
+        self.now[0] += 59
+        r = o.open("http://example.com/")
+        self.assertEqual(r.read(), "data")
+        self.assertEqual(r.code, 200)
+        self.assertEqual(r.info()["Cache-Control"], "max-age=60")
+        self.assertEqual(r.info().get("Set-Cookie"), None)
+        self.assertEqual(len(hh.requests), 1)
+        self.assertEqual((ch.hits, ch.misses, ch.revalidated), (1, 1, 0))
+        # request no-cache bypasses the cache
+        o.open(Request("http://example.com/",
+                       headers={"Cache-Control": "no-cache"}))
+        self.assertEqual(len(hh.requests), 2)
+
+    def test_revalidate(self):
+        o, ch, hh = self._make_opener(
+            [(200, [("Cache-Control", "max-age=60"), ("ETag", '"v1"'),
+                    ("X-Spam", "1")], "data"),
+             (304, [("Cache-Control", "max-age=60"), ("X-Spam", "2")], ""),
+             (200, [("ETag", '"v2"')], "new data"),
+             ])
+        o.open("http://example.com/").read()
+        entry = ch.cache.get("http://example.com/")
+        self.now[0] += 61
+        r = o.open("http://example.com/")
+        self.assertEqual(hh.requests[1].get_header("If-none-match"), '"v1"')
+        # the stored entry was replaced, not changed in place
+        self.assert_(ch.cache.get("http://example.com/") is not entry)
+        self.assertEqual(entry.headers().getheaders("X-Spam"), ["1"])
+        self.assertEqual(entry.response_time, 1e9)
+        self.assertEqual(r.code, 200)
+        self.assertEqual(r.read(), "data")
+        self.assertEqual(r.info().getheaders("X-Spam"), ["2"])
+        self.assertEqual(r.info()["ETag"], '"v1"')
+        self.assertEqual((ch.hits, ch.misses, ch.revalidated), (0, 1, 1))
+        # updated entry is fresh again
+        self.now[0] += 30
+        o.open("http://example.com/")
+        self.assertEqual(len(hh.requests), 2)
+        self.now[0] += 31
+        self.assertEqual(o.open("http://example.com/").read(), "new data")
+        self.assertEqual((ch.hits, ch.misses, ch.revalidated), (1, 2, 1))
+
+    def test_not_stored(self):
+        for headers, code in [
+            ([("Cache-Control", "no-store, max-age=60")], 200),
+            ([("Cache-Control", "max-age=60"), ("Vary", "*")], 200),
+            ([("Cache-Control", "max-age=60")], 404),
+            ([], 200),
+            ]:
+            o, ch, hh = self._make_opener([(code, headers, "a"),
+                                           (code, headers, "b")])
+            o.open("http://example.com/").read()
+            self.assertEqual(o.open("http://example.com/").read(), "b")
+        # body not read to the end: not stored
+        headers = [("Cache-Control", "max-age=60")]
+        o, ch, hh = self._make_opener([(200, headers, "abc"),
+                                       (200, headers, "def")])
+        r = o.open("http://example.com/")
+        r.read(1)
+        r.close()
+        self.assertEqual(o.open("http://example.com/").read(), "def")
+
+    def test_vary(self):
+        headers = [("Cache-Control", "max-age=60"), ("Vary", "Accept")]
+        o, ch, hh = self._make_opener([(200, headers, "a"),
+                                       (200, headers, "b")])
+        o.open(Request("http://example.com/",
+                       headers={"Accept": "text/html"})).read()
+        r = o.open(Request("http://example.com/",
+                           headers={"Accept": "text/plain"}))
+        self.assertEqual(r.read(), "b")
+        r = o.open(Request("http://example.com/",
+                           headers={"Accept": "text/plain"}))
+        self.assertEqual(r.read(), "b")
+        self.assertEqual(len(hh.requests), 2)
+
+    def test_post_invalidates(self):
+        headers = [("Cache-Control", "max-age=60")]
+        o, ch, hh = self._make_opener([(200, headers, "a"),
+                                       (200, headers, "b"),
+                                       (200, headers, "c")])
+        o.open("http://example.com/").read()
+        o.open("http://example.com/", "data").read()
+        self.assertEqual(o.open("http://example.com/").read(), "c")
+
+    def test_heuristic_freshness(self):
+        from mechanize._util import time2netscape
+        headers = [("Date", time2netscape(1e9)),
+                   ("Last-Modified", time2netscape(1e9 - 1000))]
+        o, ch, hh = self._make_opener([(200, headers, "a"),
+                                       (304, [], "")])
+        o.open("http://example.com/").read()
+        self.now[0] += 99
+        o.open("http://example.com/").read()
+        self.assertEqual(len(hh.requests), 1)
+        self.now[0] += 2
+        self.assertEqual(o.open("http://example.com/").read(), "a")
+        self.assertEqual(len(hh.requests), 2)
+        self.assertEqual(hh.requests[1].get_header("If-modified-since"),
+                         time2netscape(1e9 - 1000))
+        # no heuristic freshness for URLs with a query (RFC 2616 13.9)
+        o, ch, hh = self._make_opener([(200, headers, "a"),
+                                       (304, [], "")])
+        o.open("http://example.com/?q=1").read()
+        self.assertEqual(o.open("http://example.com/?q=1").read(), "a")
+        self.assertEqual(len(hh.requests), 2)
+        self.assertEqual(hh.requests[1].get_header("If-modified-since"),
+                         time2netscape(1e9 - 1000))
+
+    def test_memory_cache_lru(self):
+        from mechanize._httpcache import CacheEntry
+        cache = mechanize.MemoryResponseCache(max_entries=2)
+        def entry(body):
+            return CacheEntry("url", 200, "OK", [], body, 0, 0, {})
+        cache.set("a", entry("a"))
+        cache.set("b", entry("b"))
+        cache.get("a")
+        cache.set("c", entry("c"))
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a").body, "a")
+        self.assertEqual(len(cache), 2)
+        cache = mechanize.MemoryResponseCache(max_bytes=3)
+        cache.set("a", entry("aa"))
+        cache.set("b", entry("bb"))
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.get("b").body, "bb")
+
+    def _check_persistent(self, make_cache):
+        headers = [("Cache-Control", "max-age=60")]
+        o, ch, hh = self._make_opener([(200, headers, "data")],
+                                      make_cache())
+        o.open("http://example.com/").read()
+        o, ch, hh = self._make_opener([], make_cache())
+        self.assertEqual(o.open("http://example.com/").read(), "data")
+        self.assertEqual(ch.hits, 1)
+        ch.cache.delete("http://example.com/")
+        self.assertEqual(ch.cache.get("http://example.com/"), None)
+
+    def test_directory_cache(self):
+        import shutil, tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            self._check_persistent(
+                lambda: mechanize.DirectoryResponseCache(directory))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_sqlite_cache(self):
+        try:
+            import sqlite3
+        except ImportError:
+            return
+        import tempfile
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self._check_persistent(
+                lambda: mechanize.SQLiteResponseCache(filename))
+        finally:
+            os.remove(filename)
+
+    def test_useragent(self):
+        ua = mechanize.UserAgent()
+        cache = mechanize.MemoryResponseCache()
+        ua.set_http_cache(cache)
+        self.assert_(ua._ua_handlers["_cache"].cache is cache)
+        self.assert_(ua._ua_handlers["_cache"] in ua.handlers)
+        ua.set_http_cache(None)
+        self.assert_(ua._ua_handlers["_cache"] not in ua.handlers)
+
+
+class RateLimitTests(unittest.TestCase):
+
+    def _make_limiter(self, *args, **kwds):
+        limiter = mechanize.RateLimiter(*args, **kwds)
+        self.now = [1e9]
+        self.sleeps = []
+        def sleep(seconds):
+            self.assertEqual(limiter.queue_depth(), 1)
+            self.sleeps.append(seconds)
+            self.now[0] += seconds
+        limiter._time = lambda: self.now[0]
+        limiter._sleep = sleep
+        return limiter
+
+    def test_host_rate(self):
+        limiter = self._make_limiter(rate=0.5, burst=2)
+        o = build_test_opener(mechanize.HTTPRateLimitHandler(limiter),
+                              CannedHTTPHandler([(200, [], "")]*8))
+        for ii in range(3):
+            o.open("http://example.com/")
+        self.assertEqual(self.sleeps, [2])
+        o.open("http://example.org/")
+        self.assertEqual(self.sleeps, [2])
+        self.now[0] += 1
+        o.open("http://example.com/")
+        self.assertEqual(self.sleeps, [2, 1])
+        # bucket refills to burst size, no more
+        self.now[0] += 100
+        for ii in range(3):
+            o.open("http://example.com/")
+        self.assertEqual(self.sleeps, [2, 1, 2])
+        self.assertEqual(limiter.queue_depth(), 0)
+        self.assertEqual((limiter.nr_requests, limiter.nr_waits), (8, 3))
+        self.assertEqual((limiter.total_wait, limiter.max_wait), (5, 2))
+
+    def test_proxy_rate(self):
+        limiter = self._make_limiter(proxy_rate=1)
+        h = mechanize.HTTPRateLimitHandler(limiter)
+        for url in ["http://example.com/", "http://example.org/"]:
+            req = Request(url)
+            req.set_proxy("proxy.example.com:3128", "http")
+            h.http_open(req)
+        self.assertEqual(self.sleeps, [1])
+        self.assertEqual(limiter.queue_depths(), {})
+        # no proxy, no limit
+        h.http_open(Request("http://example.com/"))
+        self.assertEqual(self.sleeps, [1])
+
+    def test_robots_crawl_delay(self):
+        class MockRobotRulesCache:
+            def get(self, scheme, host):
+                if host == "slow.example.com":
+                    return self
+            def crawl_interval(self, useragent):
+                return 5
+        limiter = self._make_limiter(rate=1,
+                                     robots_cache=MockRobotRulesCache())
+        h = mechanize.HTTPRateLimitHandler(limiter)
+        for ii in range(2):
+            h.http_open(Request("http://slow.example.com/"))
+            h.http_open(Request("http://example.com/"))
+        self.assertEqual(self.sleeps, [5])
+
+    def test_useragent(self):
+        limiter = mechanize.RateLimiter(rate=1)
+        ua = mechanize.UserAgent()
+        ua.set_rate_limiter(limiter)
+        self.assert_(ua._ua_handlers["_ratelimit"].limiter is limiter)
+        self.assert_(ua._ua_handlers["_ratelimit"] in ua.handlers)
+        ua.set_rate_limiter(None)
+        self.assert_(ua._ua_handlers["_ratelimit"] not in ua.handlers)
+
+
 class HeadParserTests(unittest.TestCase):
 
     def test(self):
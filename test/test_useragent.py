@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 
+import sys
+import threading
+import time
 from unittest import TestCase
 
 import mechanize
+from mechanize._response import test_response
 
 from test_browser import make_mock_handler
 
@@ -52,6 +56,234 @@ class UserAgentTests(TestCase):
             self.assertEqual(expect, got[1:])
         ua._set_handler("_blah", True)
 
+    def test_robots_options(self):
+        ua = mechanize.UserAgentBase()
+        rp = ua._ua_handlers["_robots"]
+        self.assertEqual(rp.honor_crawl_delay, False)
+        self.assertEqual(rp.longest_match, False)
+        cache = mechanize.RobotRulesCache()
+        ua.set_robots_options(cache, honor_crawl_delay=True,
+                              max_crawl_delay=5, longest_match=True)
+        rp = ua._ua_handlers["_robots"]
+        self.assert_(rp.cache is cache)
+        self.assertEqual(rp.honor_crawl_delay, True)
+        self.assertEqual(rp.max_crawl_delay, 5)
+        self.assertEqual(rp.longest_match, True)
+        # options are kept when robots.txt handling is turned off and on
+        ua.set_handle_robots(False)
+        ua.set_robots_options(cache)
+        self.assert_(ua._ua_handlers["_robots"] not in ua.handlers)
+        ua.set_handle_robots(True)
+        rp = ua._ua_handlers["_robots"]
+        self.assert_(rp.cache is cache)
+        self.assertEqual(rp.honor_crawl_delay, False)
+
+
+class ConcurrentHTTPHandler(mechanize.BaseHandler):
+    # records the greatest number of concurrent requests to each host
+    handler_order = 100  # before the real HTTPHandler
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.active = {}
+        self.max_active = {}
+
+    def http_open(self, req):
+        host = req.get_host()
+        self._lock.acquire()
+        try:
+            self.active[host] = self.active.get(host, 0) + 1
+            self.max_active[host] = max(self.max_active.get(host, 0),
+                                        self.active[host])
+        finally:
+            self._lock.release()
+        time.sleep(0.01)
+        self._lock.acquire()
+        try:
+            self.active[host] -= 1
+        finally:
+            self._lock.release()
+        if req.get_selector() == "/missing":
+            return test_response("", [], req.get_full_url(), 404, "Not Found")
+        return test_response(
+            req.get_full_url(),
+            [("Set-Cookie", "spam%s=eggs" % req.get_selector()[1:])], req.get_full_url())
+
+
+class OpenManyTests(TestCase):
+
+    def make_user_agent(self):
+        ua = mechanize.UserAgentBase()
+        ua.set_handle_robots(False)
+        handler = ConcurrentHTTPHandler()
+        ua.add_handler(handler)
+        return ua, handler
+
+    def test_open_many(self):
+        ua, handler = self.make_user_agent()
+        urls = ["http://example.com/%d" % ii for ii in range(10)]
+        urls += ["http://example.org/%d" % ii for ii in range(10)]
+        urls.append("http://example.com/missing")
+        results = list(ua.open_many(urls, max_workers=5))
+        self.assertEqual(len(results), len(urls))
+        got = []
+        for url, response, error in results:
+            got.append(url)
+            if url.endswith("missing"):
+                self.assertEqual(response, None)
+                self.assert_(isinstance(error, mechanize.HTTPError))
+                self.assertEqual(error.code, 404)
+            else:
+                self.assertEqual(error, None)
+                self.assertEqual(response.read(), url)
+        got.sort()
+        urls.sort()
+        self.assertEqual(got, urls)
+        # every response set a cookie
+        self.assertEqual(len(ua._ua_handlers["_cookies"].cookiejar), 20)
+        self.assert_(max(handler.max_active.values()) > 1)
+
+    def test_max_per_host(self):
+        ua, handler = self.make_user_agent()
+        urls = ["http://example.com/%d" % ii for ii in range(10)]
+        urls += ["http://example.org/%d" % ii for ii in range(10)]
+        list(ua.open_many(urls, max_workers=6, max_per_host=2))
+        self.assertEqual(handler.max_active["example.com"], 2)
+        self.assertEqual(handler.max_active["example.org"], 2)
+
+    def test_open_async(self):
+        ua, handler = self.make_user_agent()
+        future = ua.open_async("http://example.com/1")
+        self.assertEqual(future.result(5).read(), "http://example.com/1")
+        self.assert_(future.done())
+        self.assertEqual(future.exception(), None)
+        done = []
+        future.add_done_callback(done.append)
+        self.assertEqual(done, [future])
+
+        future = ua.open_async("http://example.com/missing")
+        self.assertRaises(mechanize.HTTPError, future.result, 5)
+        self.assertEqual(future.exception().code, 404)
+
+        # callbacks run once the request completes
+        finished = threading.Event()
+        done = []
+        def callback(future):
+            done.append(future)
+            finished.set()
+        future = ua.open_async("http://example.com/2")
+        future.add_done_callback(callback)
+        finished.wait(5)
+        self.assertEqual(done, [future])
+        self.assertEqual(len(ua._ua_handlers["_cookies"].cookiejar), 2)
+
+    def test_future_timeout(self):
+        from mechanize._workerpool import call_async, TimeoutError
+        release = threading.Event()
+        future = call_async(release.wait)
+        self.assertRaises(TimeoutError, future.result, 0.01)
+        self.assert_(not future.done())
+        release.set()
+        future.result(5)
+        self.assert_(future.done())
+
+    def test_retrieve_async(self):
+        ua, handler = self.make_user_agent()
+        future = ua.retrieve_async("http://example.com/1")
+        filename, headers = future.result(5)
+        f = open(filename)
+        try:
+            self.assertEqual(f.read(), "http://example.com/1")
+        finally:
+            f.close()
+        ua.close()
+
+    def test_async_traceback(self):
+        import traceback
+        from mechanize._workerpool import call_async
+        def fail():
+            raise ValueError("spam")
+        future = call_async(fail)
+        try:
+            future.result(5)
+        except ValueError:
+            tb = traceback.extract_tb(sys.exc_info()[2])
+            self.assertEqual(tb[-1][2], "fail")
+        else:
+            self.fail("ValueError not raised")
+
+    def test_async_pool(self):
+        # added jobs run on a bounded number of threads, which are started
+        # as needed
+        from mechanize._workerpool import WorkerPool
+        lock = threading.Lock()
+        state = {"active": 0, "max_active": 0}
+        release = threading.Event()
+        finished = []
+        def function(job):
+            lock.acquire()
+            try:
+                state["active"] += 1
+                state["max_active"] = max(state["max_active"],
+                                          state["active"])
+            finally:
+                lock.release()
+            release.wait(5)
+            lock.acquire()
+            try:
+                state["active"] -= 1
+                finished.append(job)
+            finally:
+                lock.release()
+        pool = WorkerPool(function, [], 2, keep_results=False)
+        for job in range(5):
+            pool.add(job)
+        time.sleep(0.05)
+        self.assertEqual(state["active"], 2)
+        release.set()
+        pool.join()
+        finished.sort()
+        self.assertEqual(finished, range(5))
+        self.assertEqual(state["max_active"], 2)
+        self.assertEqual(list(pool), [])
+
+    def test_base_exception(self):
+        # errors that aren't Exceptions still end the job, and the remaining
+        # jobs still run
+        from mechanize._workerpool import WorkerPool, call_async
+        def function(job):
+            if job == 1:
+                raise SystemExit()
+            return job
+        pool = WorkerPool(function, range(3), max_workers=1)
+        results = list(pool)
+        pool.join()
+        self.assertEqual(len(results), 3)
+        results.sort()
+        self.assertEqual(results[0][:2], (0, 0))
+        self.assertEqual(results[1][:2], (1, None))
+        self.assert_(isinstance(results[1][2], SystemExit))
+        self.assertEqual(results[2][:2], (2, 2))
+        future = call_async(function, 1)
+        self.assertRaises(SystemExit, future.result, 5)
+
+    def test_browser_state_unchanged(self):
+        browser = mechanize.Browser()
+        browser.set_handle_robots(False)
+        browser.add_handler(ConcurrentHTTPHandler())
+        urls = ["http://example.com/%d" % ii for ii in range(3)]
+        for url, response, error in browser.open_many(urls):
+            self.assertEqual(error, None)
+        self.assertRaises(mechanize.BrowserStateError, browser.geturl)
+
+    def test_close(self):
+        ua, handler = self.make_user_agent()
+        urls = ["http://example.com/%d" % ii for ii in range(10)]
+        results = ua.open_many(urls, max_workers=1)
+        results.next()
+        results.close()
+        self.assertEqual(list(results), [])
+
 
 if __name__ == "__main__":
     import unittest